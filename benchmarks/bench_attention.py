@@ -0,0 +1,66 @@
+"""Peak memory, time and error of the pure PyTorch attention backends against sdpa.
+
+Each backend runs in a fresh process, so host memory peaks (RSS) are comparable on CPU;
+on CUDA the peak of allocated device memory is reported.
+    python benchmarks/bench_attention.py --device cpu --tokens 8192
+"""
+import argparse
+import subprocess
+import sys
+
+import common
+import torch
+
+from mochi_preview.dit.joint_model.attention_backends import get_attention_backend
+
+
+def run_one(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    qkv = torch.randn(args.tokens, 3, args.heads, 128, device=device, dtype=torch.bfloat16)
+    backend = get_attention_backend(args.backend)
+
+    def fn():
+        return backend(qkv, cu_seqlens=None, max_seqlen_in_batch=args.tokens)
+
+    if device.type == "cuda":
+        peak = common.peak_memory(fn, device=device)
+    else:
+        base = common.peak_rss()
+        fn()
+        peak = common.peak_rss() - base
+    seconds = common.timeit(fn, device=device, warmup=0, iters=args.iters)
+
+    error = "-"
+    if args.backend != "sdpa":
+        ref = get_attention_backend("sdpa")(qkv, cu_seqlens=None, max_seqlen_in_batch=args.tokens)
+        error = f"{(fn().float() - ref.float()).abs().max().item():.4f}"
+    print("{:>10} {:>14} {:>12.1f}ms {:>10}".format(args.backend, common.mib(peak), seconds * 1000, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--tokens", type=int, default=8192, help="Packed sequence length")
+    parser.add_argument("--heads", type=int, default=24)
+    parser.add_argument("--iters", type=int, default=1)
+    parser.add_argument("--backends", default="sdpa,chunked,blocked")
+    parser.add_argument("--backend", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend is not None:
+        run_one(args)
+        return
+
+    print(f"{args.tokens} tokens, {args.heads} heads of 128, bf16, {args.device}")
+    print("{:>10} {:>14} {:>14} {:>10}".format("backend", "peak", "time", "max err"))
+    for backend in args.backends.split(","):
+        subprocess.run(
+            [sys.executable, __file__, "--backend", backend.strip()]
+            + [f"--{k}={v}" for k, v in vars(args).items() if k not in ("backends", "backend")],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Peak memory and throughput of the visual MLP (ff_block_x) for several chunk budgets.
+
+Each budget runs in a fresh process, so host memory peaks (RSS) are comparable on CPU;
+on CUDA the peak of allocated device memory is reported.
+    python benchmarks/bench_feedforward.py --device cpu --num_frames 25 --budgets 0,1024,256,64
+"""
+import argparse
+import subprocess
+import sys
+
+import common
+import torch
+
+from mochi_preview.dit.joint_model.asymm_models_joint import AsymmetricJointBlock
+
+
+def run_one(args):
+    device = torch.device(args.device)
+    T = (args.num_frames - 1) // 6 + 1
+    N = T * (args.height // 16) * (args.width // 16)
+
+    block = AsymmetricJointBlock(3072, 1536, 24, mlp_ratio_x=4.0, mlp_ratio_y=4.0, device="meta", qk_norm=True)
+    block = block.to_empty(device=device).to(torch.bfloat16)
+    with torch.no_grad():
+        for param in block.parameters():
+            param.normal_(0, 0.02)
+    block.mlp_chunk_bytes = args.budget_mb * 1024**2 or None
+
+    x = torch.randn(1, N, 3072, device=device, dtype=torch.bfloat16)
+    scale = torch.randn(1, 3072, device=device, dtype=torch.bfloat16) * 0.1
+    gate = torch.randn(1, 3072, device=device, dtype=torch.bfloat16)
+    chunk = block.mlp_x.chunk_size(N, x.dtype, block.mlp_chunk_bytes)
+
+    def fn():
+        with torch.inference_mode():
+            block.ff_block_x(x, scale, gate)
+
+    if device.type == "cuda":
+        peak = common.peak_memory(fn, device=device)
+    else:
+        base = common.peak_rss()
+        fn()
+        peak = common.peak_rss() - base
+    seconds = common.timeit(fn, device=device, warmup=1, iters=args.iters)
+    budget = f"{args.budget_mb} MiB" if args.budget_mb else "off"
+    print("{:>10} {:>8} {:>14} {:>12.1f}ms {:>12.0f}".format(
+        budget, chunk, common.mib(peak), seconds * 1000, N / seconds
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_frames", type=int, default=25)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=848)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--budgets", default="0,2048,1024,512,256,128", help="Comma separated MiB, 0 is unchunked")
+    parser.add_argument("--budget_mb", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.budget_mb is not None:
+        run_one(args)
+        return
+
+    T = (args.num_frames - 1) // 6 + 1
+    N = T * (args.height // 16) * (args.width // 16)
+    print(f"ff_block_x, N={N} visual tokens, bf16, {args.device}")
+    print("{:>10} {:>8} {:>14} {:>14} {:>12}".format("budget", "chunk", "peak", "time", "tokens/s"))
+    for budget in args.budgets.split(","):
+        subprocess.run(
+            [sys.executable, __file__, "--budget_mb", budget.strip()]
+            + [f"--{k}={v}" for k, v in vars(args).items() if k not in ("budgets", "budget_mb")],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
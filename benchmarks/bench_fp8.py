@@ -0,0 +1,64 @@
+"""FP8Linear at the shapes of Mochi's block linears.
+
+Measures the quantization error of per-tensor and per-channel weight scales against the
+bf16 layer, the difference to the dequantizing reference (on a GPU with fp8 matmuls) and the
+time per call against bf16 nn.Linear. On CPU only the reference path runs.
+tests/test_fp8_linear.py checks correctness.
+"""
+import argparse
+
+import common
+import torch
+import torch.nn as nn
+
+from fp8_optimization import FP8Linear, scaled_mm_support
+
+# (in_features, out_features) of qkv_x, proj_x, mlp_x.w1 and mlp_x.w2.
+SHAPES = [(3072, 9216), (3072, 3072), (3072, 16384), (8192, 3072)]
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    return ((actual.float() - expected.float()).norm() / expected.float().norm()).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    support = scaled_mm_support(device)
+    print(f"{args.tokens} tokens, {device}, torch._scaled_mm: {support or 'unavailable, reference path only'}")
+    print("{:<14} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+        "shape", "err tensor", "err channel", "bf16", "fp8", "vs ref"
+    ))
+    torch.manual_seed(0)
+    for in_features, out_features in SHAPES:
+        linear = nn.Linear(in_features, out_features, device=device, dtype=torch.bfloat16)
+        with torch.no_grad():
+            # Spread the channel magnitudes like trained weights, where per-channel scales pay off.
+            linear.weight.mul_(torch.logspace(-1, 1, out_features, device=device, dtype=torch.bfloat16)[:, None])
+        x = torch.randn(args.tokens, in_features, device=device, dtype=torch.bfloat16)
+        x[:, :8] *= 20  # Outlier features.
+
+        with torch.no_grad():
+            expected = linear(x)
+            errors = []
+            for per_channel in (False, True):
+                fp8 = FP8Linear.from_linear(linear, per_channel=per_channel)
+                errors.append(relative_error(fp8(x), expected))
+
+            vs_reference = "-"
+            if support is not None:
+                vs_reference = f"{relative_error(fp8(x), fp8.forward_reference(x)):.2e}"
+
+            bf16_time = common.timeit(lambda: linear(x), device=device)
+            fp8_time = common.timeit(lambda: fp8(x), device=device)
+        print("{:<14} {:>12.2e} {:>12.2e} {:>10.2f}ms {:>10.2f}ms {:>12}".format(
+            f"{in_features}x{out_features}", errors[0], errors[1], bf16_time * 1000, fp8_time * 1000, vs_reference
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""GGUF linears at the shapes of Mochi's qkv and MLP layers on CPU.
+
+Compares the old Q4_0/Q8_0 dequantize-then-matmul path with the current chunked
+dequantization (full) and with tiled dequant-matmul, which never materializes the whole
+weight. Checks that the dequantizers match the old ones exactly and that the tiled output
+matches the full one. The other qtypes have no old path and only run full and tiled. Each configuration runs in its own process so the RSS peaks
+are comparable.
+    python benchmarks/bench_gguf.py --tokens 1024
+"""
+import argparse
+import subprocess
+import sys
+
+import common
+import torch
+import torch.nn.functional as F
+
+from mz_gguf_loader import GGML_QUANT_SIZES, WQLinear_GGUF, dequantize_blocks, quant_shape_to_byte_shape
+
+# (in_features, out_features) of qkv_x, mlp_x.w1 and mlp_x.w2.
+SHAPES = [(3072, 9216), (3072, 16384), (8192, 3072)]
+MODES = ["legacy", "full", "tiled"]
+# Byte offsets of the fp16 scales (and mins) in a block of each qtype.
+SCALE_OFFSETS = {
+    "Q4_0": (0,), "Q4_1": (0, 2), "Q5_0": (0,), "Q5_1": (0, 2), "Q8_0": (0,),
+    "Q4_K": (0, 2), "Q5_K": (0, 2), "Q6_K": (208,),
+}
+
+
+def legacy_dequantize_Q4_0(data, dtype):
+    """dequantize_blocks_Q4_0 before chunking, with full-size temporaries."""
+    block_size, type_size = GGML_QUANT_SIZES["Q4_0"]
+    blocks = data.reshape(-1, type_size)
+    d, qs = blocks[:, :2].view(torch.float16), blocks[:, 2:]
+    qs = qs.reshape((blocks.shape[0], -1, 1, block_size // 2)) >> torch.tensor(
+        [0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
+    qs = (qs & 0x0F).reshape((blocks.shape[0], -1)).to(torch.int8) - 8
+    return (d * qs).reshape(data.shape[0], -1).to(dtype)
+
+
+def legacy_dequantize_Q8_0(data, dtype):
+    """dequantize_blocks_Q8_0 before chunking, with full-size temporaries."""
+    _, type_size = GGML_QUANT_SIZES["Q8_0"]
+    blocks = data.reshape(-1, type_size)
+    d = blocks[:, :2].view(torch.float16).to(torch.float32)
+    qs = blocks[:, 2:].view(torch.int8).to(torch.float32)
+    return (d * qs).reshape(data.shape[0], -1).to(dtype)
+
+
+LEGACY = {"Q4_0": legacy_dequantize_Q4_0, "Q8_0": legacy_dequantize_Q8_0}
+
+
+def random_qweight(out_features, in_features, qtype):
+    """Random quantized weight with sane fp16 block scales."""
+    block_size, type_size = GGML_QUANT_SIZES[qtype]
+    shape = quant_shape_to_byte_shape((out_features, in_features), qtype)
+    blocks = torch.randint(0, 256, shape, dtype=torch.uint8).reshape(-1, type_size)
+    for offset in SCALE_OFFSETS[qtype]:
+        blocks[:, offset:offset + 2] = (torch.rand(blocks.shape[0], 1) * 0.01).half().view(torch.uint8)
+    return blocks.reshape(shape)
+
+
+def make_layer(in_features, out_features, qtype, tile_rows):
+    layer = WQLinear_GGUF(in_features, out_features, True, "cpu", qtype=qtype)
+    getattr(layer, f"{qtype}_qweight").copy_(random_qweight(out_features, in_features, qtype))
+    layer.bias.normal_()
+    layer.tile_rows = tile_rows
+    return layer
+
+
+def run_one(args):
+    torch.manual_seed(0)
+    in_features, out_features = SHAPES[args.shape]
+    layer = make_layer(in_features, out_features, args.qtype, args.tile_rows if args.mode == "tiled" else None)
+    qweight = getattr(layer, f"{args.qtype}_qweight")
+    x = torch.randn(args.tokens, in_features, dtype=torch.bfloat16)
+
+    if args.mode == "legacy":
+        def fn():
+            return F.linear(x, LEGACY[args.qtype](qweight, x.dtype), layer.bias.to(x.dtype))
+    else:
+        def fn():
+            return layer(x)
+
+    base = common.peak_rss()
+    out = fn()
+    peak = common.peak_rss() - base
+    seconds = common.timeit(fn, device="cpu", warmup=0, iters=args.iters)
+
+    check = "-"
+    if args.mode == "full":
+        # Same dequantized values, so the same output.
+        if args.qtype in LEGACY:
+            assert torch.equal(dequantize_blocks(qweight, args.qtype, torch.bfloat16), LEGACY[args.qtype](qweight, torch.bfloat16))
+            check = "exact"
+    elif args.mode == "tiled":
+        layer.tile_rows = None
+        check = f"{(out.float() - layer(x).float()).abs().max().item():.1e}"
+    print("{:<6} {:<12} {:>8} {:>14} {:>10.1f}ms {:>10}".format(
+        args.qtype, f"{in_features}x{out_features}", args.mode, common.mib(peak), seconds * 1000, check
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--tile_rows", type=int, default=1024)
+    parser.add_argument("--iters", type=int, default=2)
+    parser.add_argument("--qtypes", default="Q4_0,Q8_0", help=f"Comma separated, from {','.join(GGML_QUANT_SIZES)}")
+    parser.add_argument("--qtype", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--shape", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--mode", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_one(args)
+        return
+
+    print(f"{args.tokens} tokens, bf16 activations, tiles of {args.tile_rows} rows, cpu")
+    print("{:<6} {:<12} {:>8} {:>14} {:>12} {:>10}".format("qtype", "shape", "mode", "peak RSS", "time", "check"))
+    for qtype in args.qtypes.split(","):
+        for shape in range(len(SHAPES)):
+            for mode in MODES:
+                if mode == "legacy" and qtype not in LEGACY:
+                    continue
+                subprocess.run(
+                    [sys.executable, __file__, f"--qtype={qtype}", f"--shape={shape}", f"--mode={mode}",
+                     f"--tokens={args.tokens}", f"--tile_rows={args.tile_rows}", f"--iters={args.iters}"],
+                    check=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Loading a DiT-like safetensors checkpoint into an empty model on CPU.
+
+Compares reading the whole state dict with safetensors' load_file and then casting and
+assigning it, as the loader did before, with streaming it from the memory-mapped file
+through checkpoint_loader.stream_into_module. Weights are cast from bf16 to fp8 like with
+the fp8 checkpoint dtype. Each mode runs in its own process so the RSS peaks are comparable,
+the checksum column shows that they load the same values.
+    python benchmarks/bench_loading.py --blocks 8 --workers 1,4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file, save_file
+
+from mochi_preview.checkpoint_loader import SafetensorsFile, peak_rss, stream_into_module
+
+
+def make_model(blocks, hidden):
+    """Linears shaped like the x stream of Mochi's blocks, scaled by hidden / 3072."""
+    return nn.Sequential(*(
+        nn.ModuleDict({
+            "qkv": nn.Linear(hidden, hidden * 3, bias=False),
+            "proj": nn.Linear(hidden, hidden),
+            "w1": nn.Linear(hidden, hidden * 16 // 3, bias=False),
+            "w2": nn.Linear(hidden * 8 // 3, hidden, bias=False),
+        })
+        for _ in range(blocks)
+    ))
+
+
+def placement(name):
+    return (torch.float8_e4m3fn if name.endswith("weight") else torch.bfloat16), torch.device("cpu")
+
+
+def checksum(model):
+    return sum(t.float().sum().item() for t in model.state_dict().values())
+
+
+def write_checkpoint(args):
+    torch.manual_seed(0)
+    save_file(make_model(args.blocks, args.hidden).to(torch.bfloat16).state_dict(), args.path)
+
+
+def run_one(args):
+    if args.mode == "write":
+        write_checkpoint(args)
+        return
+    with torch.device("meta"):
+        model = make_model(args.blocks, args.hidden)
+    base = peak_rss()
+    start = time.perf_counter()
+    if args.mode == "load_file":
+        state_dict = load_file(args.path)
+        model.load_state_dict({name: tensor.to(placement(name)[0]) for name, tensor in state_dict.items()}, assign=True)
+        del state_dict
+    else:
+        checkpoint = SafetensorsFile(args.path)
+        stream_into_module(model, checkpoint, placement, workers=args.workers, window_bytes=args.window_mb * 1024**2)
+        checkpoint.close()
+    seconds = time.perf_counter() - start
+    print("{:<10} {:>8} {:>10.2f}s {:>14} {:>14.6e}".format(
+        args.mode, args.workers if args.mode == "stream" else "-", seconds, common.mib(peak_rss() - base), checksum(model)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=8)
+    parser.add_argument("--hidden", type=int, default=3072)
+    parser.add_argument("--workers", default="1,4", help="Comma separated worker counts of the streaming runs")
+    parser.add_argument("--window_mb", type=int, default=256)
+    parser.add_argument("--mode", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        args.workers = int(args.workers)
+        run_one(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "dit.safetensors")
+
+        def run(mode, workers=1):
+            subprocess.run(
+                [sys.executable, __file__, f"--mode={mode}", f"--path={path}", f"--workers={workers}",
+                 f"--blocks={args.blocks}", f"--hidden={args.hidden}", f"--window_mb={args.window_mb}"],
+                check=True,
+            )
+
+        # Children start from the peak RSS of their parent, so the parent never holds the model.
+        run("write")
+        print(f"{os.path.getsize(path) / 1024**3:.2f} GB bf16 checkpoint, weights cast to fp8, "
+              f"{args.window_mb} MiB window, cpu")
+        print("{:<10} {:>8} {:>11} {:>14} {:>14}".format("mode", "workers", "time", "peak RSS", "checksum"))
+        run("load_file")
+        for workers in args.workers.split(","):
+            run("stream", workers)
+
+
+if __name__ == "__main__":
+    main()
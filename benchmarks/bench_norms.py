@@ -0,0 +1,94 @@
+"""Modulated RMSNorm and tanh-gated residual RMSNorm at Mochi's activation shapes.
+
+Compares the fp32 autograd.Function versions with the fused functions used by the blocks:
+bytes allocated, largest temporary and peak memory of a call, time per sampling step
+(4 calls per block, 48 blocks) and max error against an fp64 reference.
+"""
+import argparse
+
+import common
+import torch
+
+from mochi_preview.dit.joint_model.mod_rmsnorm import ModulatedRMSNorm, modulated_rmsnorm
+from mochi_preview.dit.joint_model.residual_tanh_gated_rmsnorm import (
+    ResidualTanhGatedRMSNorm,
+    residual_tanh_gated_rmsnorm,
+)
+
+DEPTH = 48
+HIDDEN = 3072
+
+
+def reference(x, x_res, scale, gate, eps=1e-6):
+    x, x_res, scale, gate = (t.double() for t in (x, x_res, scale, gate))
+    mod = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + eps) * (1 + scale.unsqueeze(1))
+    res = x + x_res * torch.rsqrt(x_res.pow(2).mean(-1, keepdim=True) + eps) * torch.tanh(gate).unsqueeze(1)
+    return mod, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_frames", type=int, default=25)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=848)
+    parser.add_argument("--compile", action="store_true", help="Also time the torch.compile path")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    T = (args.num_frames - 1) // 6 + 1
+    N = T * (args.height // 16) * (args.width // 16)
+    dtype = torch.bfloat16
+
+    x = torch.randn(1, N, HIDDEN, device=device, dtype=dtype)
+    x_res = torch.randn(1, N, HIDDEN, device=device, dtype=dtype) * 3
+    scale = torch.randn(1, HIDDEN, device=device, dtype=dtype) * 0.1
+    gate = torch.randn(1, HIDDEN, device=device, dtype=dtype)
+    ref_mod, ref_res = reference(x, x_res, scale, gate)
+
+    def old_mod():
+        return ModulatedRMSNorm.apply(x, scale)
+
+    def old_res():
+        return ResidualTanhGatedRMSNorm.apply(x, x_res, gate)
+
+    def new_mod():
+        with torch.no_grad():
+            return modulated_rmsnorm(x, scale)
+
+    # The fused residual updates x in place, time it on copies.
+    x_copy, x_res_copy = x.clone(), x_res.clone()
+
+    def new_res():
+        x_copy.copy_(x)
+        x_res_copy.copy_(x_res)
+        with torch.no_grad():
+            return residual_tanh_gated_rmsnorm(x_copy, x_res_copy, gate)
+
+    cases = [("ModulatedRMSNorm.apply", old_mod, ref_mod), ("modulated_rmsnorm", new_mod, ref_mod),
+             ("ResidualTanhGated.apply", old_res, ref_res), ("residual_tanh_gated", new_res, ref_res)]
+    if args.compile:
+        compiled_mod = torch.compile(modulated_rmsnorm)
+        compiled_res = torch.compile(residual_tanh_gated_rmsnorm)
+        cases += [("modulated_rmsnorm compiled", lambda: compiled_mod(x, scale), ref_mod),
+                  ("residual_tanh_gated compiled", lambda: compiled_res(x, x_res, gate), ref_res)]
+
+    print(f"(1, {N}, {HIDDEN}) {dtype}, {DEPTH} blocks x 2 calls each, {device}")
+    print("{:<30} {:>14} {:>14} {:>14} {:>12} {:>10}".format(
+        "", "alloc/step", "largest temp", "peak/call", "time/step", "max err"
+    ))
+    for name, fn, ref in cases:
+        err = (fn().double() - ref).abs().max().item()
+        with common.AllocationCounter() as counter:
+            fn()
+        # new_res copies its inputs first, those copies aren't part of the op.
+        peak = common.peak_memory(fn, device=device)
+        seconds = common.timeit(fn, device=device)
+        print("{:<30} {:>14} {:>14} {:>14} {:>10.1f}ms {:>10.4f}".format(
+            name, common.mib(counter.bytes * DEPTH * 2), common.mib(counter.largest), common.mib(peak),
+            seconds * DEPTH * 2 * 1000, err
+        ))
+
+
+if __name__ == "__main__":
+    main()
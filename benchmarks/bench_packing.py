@@ -0,0 +1,72 @@
+"""Bytes allocated per sampling step by the qkv packing and output splitting of the 48 blocks.
+
+Compares unify_streams / pad_and_split_xy with pack_qkv / split_xy at Mochi's shapes.
+"""
+import argparse
+
+import common
+import torch
+
+from mochi_preview.dit.joint_model.utils import (
+    compute_packed_indices,
+    pack_qkv,
+    pad_and_split_xy,
+    split_xy,
+    unify_streams,
+)
+
+DEPTH = 48
+NUM_HEADS = 24
+HEAD_DIM = 128
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_frames", type=int, default=25)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=848)
+    parser.add_argument("--text_len", type=int, default=256, help="Valid T5 tokens out of 256")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    T = (args.num_frames - 1) // 6 + 1
+    N = T * (args.height // 16) * (args.width // 16)
+    L = 256
+    mask = torch.zeros(1, L, dtype=torch.bool, device=device)
+    mask[:, :args.text_len] = True
+    packed_indices = compute_packed_indices(N, [mask])
+    indices = packed_indices["valid_token_indices_kv"]
+
+    def make(n):
+        return torch.randn(1, n, NUM_HEADS, HEAD_DIM, device=device, dtype=torch.bfloat16)
+
+    qkv_x = [make(N) for _ in range(3)]
+    qkv_y = [make(L) for _ in range(3)]
+    total = packed_indices["cu_seqlens_host"][-1]
+    out = torch.randn(total, NUM_HEADS * HEAD_DIM, device=device, dtype=torch.bfloat16)
+
+    def old():
+        qkv = unify_streams(*qkv_x, *qkv_y, indices)
+        x, y = pad_and_split_xy(out, indices, 1, N, L, out.dtype)
+        return qkv, x, y
+
+    def new():
+        qkv = pack_qkv(*qkv_x, *qkv_y, packed_indices)
+        x, y = split_xy(out, packed_indices, 1, N, L)
+        return qkv, x, y
+
+    for a, b in zip(old(), new()):
+        assert torch.equal(a, b)
+
+    print(f"N={N} visual tokens, {args.text_len}/{L} text tokens, {DEPTH} blocks, {device}")
+    print("{:<26} {:>16} {:>12}".format("", "alloc/step", "time/step"))
+    for name, fn in (("unify_streams+pad_split", old), ("pack_qkv+split_xy", new)):
+        with common.AllocationCounter() as counter:
+            fn()
+        seconds = common.timeit(fn, device=device)
+        print("{:<26} {:>16} {:>10.1f}ms".format(name, common.mib(counter.bytes * DEPTH), seconds * DEPTH * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""QK-norm and rotary embedding of the visual stream at Mochi's shapes.
+
+Compares apply_qk_norm_rotary_emb_ with the RMSNorm + apply_rotary_emb_qk_real sequence it
+replaces in AsymmetricAttention.prepare_qkv: bytes allocated and time per sampling step
+(48 blocks). tests/test_qk_norm_rope.py checks the values.
+"""
+import argparse
+
+import common
+import torch
+
+from mochi_preview.dit.joint_model.layers import RMSNorm
+from mochi_preview.dit.joint_model.rope_mixed import compute_mixed_rotation, create_position_matrix
+from mochi_preview.dit.joint_model.temporal_rope import apply_qk_norm_rotary_emb_, apply_rotary_emb_qk_real
+
+DEPTH = 48
+NUM_HEADS = 24
+HEAD_DIM = 128
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_frames", type=int, default=25)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=848)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    T = (args.num_frames - 1) // 6 + 1
+    pH, pW = args.height // 16, args.width // 16
+    N = T * pH * pW
+
+    torch.manual_seed(0)
+    q_norm = RMSNorm(HEAD_DIM, device=device).to(torch.bfloat16)
+    k_norm = RMSNorm(HEAD_DIM, device=device).to(torch.bfloat16)
+    with torch.no_grad():
+        q_norm.weight.uniform_(0.5, 1.5)
+        k_norm.weight.uniform_(0.5, 1.5)
+    freqs = torch.rand(3, NUM_HEADS, HEAD_DIM // 2, device=device)
+    pos = create_position_matrix(T, pH=pH, pW=pW, device=device, dtype=torch.float32)
+    rope_cos, rope_sin = compute_mixed_rotation(freqs=freqs, pos=pos)
+
+    # Same layout as in prepare_qkv: (3, B=1, N, heads, head_dim) view of the qkv_x linear output.
+    qkv_x = torch.randn(1, N, 3 * NUM_HEADS * HEAD_DIM, device=device, dtype=torch.bfloat16) * 4
+    qkv_x = qkv_x.view(1, N, 3, NUM_HEADS, HEAD_DIM).permute(2, 0, 1, 3, 4)
+    packed = torch.empty(N, 3, NUM_HEADS, HEAD_DIM, device=device, dtype=torch.bfloat16)
+    norm_weight = torch.stack([q_norm.weight, k_norm.weight])
+
+    def old():
+        q_x, k_x, _ = qkv_x.unbind(0)
+        q_x = apply_rotary_emb_qk_real(q_norm(q_x), rope_cos, rope_sin)
+        k_x = apply_rotary_emb_qk_real(k_norm(k_x), rope_cos, rope_sin)
+        packed[:, 0] = q_x[0]
+        packed[:, 1] = k_x[0]
+        return packed[:, :2].clone()
+
+    def new():
+        out = packed.transpose(0, 1)[:2]
+        apply_qk_norm_rotary_emb_(qkv_x[:2, 0], norm_weight, rope_cos, rope_sin, out=out, eps=q_norm.eps)
+        return packed[:, :2]
+
+    with torch.no_grad():
+        # The fused op rounds once instead of after the norm and after the rotation.
+        print(f"max abs diff {(new().float() - old().float()).abs().max().item():.4f}")
+
+        print(f"N={N} visual tokens, {NUM_HEADS} heads, {DEPTH} blocks, {device}")
+        print("{:<28} {:>14} {:>14} {:>12}".format("", "alloc/step", "peak/call", "time/step"))
+        for name, fn in (("RMSNorm + apply_rotary_emb", old), ("apply_qk_norm_rotary_emb_", new)):
+            with common.AllocationCounter() as counter:
+                fn()
+            # old() clones its result for the comparison above, don't count it.
+            clone_bytes = N * 2 * NUM_HEADS * HEAD_DIM * 2 if fn is old else 0
+            peak = common.peak_memory(fn, device=device)
+            seconds = common.timeit(fn, device=device)
+            print("{:<28} {:>14} {:>14} {:>10.1f}ms".format(
+                name, common.mib((counter.bytes - clone_bytes) * DEPTH), common.mib(peak), seconds * DEPTH * 1000
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Sharded DiT checkpoints (shard_dit.py) against the monolithic file on CPU.
+
+Builds a DiT checkpoint of the real architecture with fewer, narrower blocks, mixing bf16
+layers with a scaled fp8 and a GGUF layer, and splits it into shards. Then compares full
+load times of both layouts, each in its own process. tests/test_sharding.py checks the
+round trip.
+    python benchmarks/bench_sharding.py --depth 8 --hidden 1536 --workers 1,4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import torch
+from safetensors.torch import load_file, save_file
+
+from fp8_optimization import FP8Linear
+from mochi_preview.checkpoint_loader import (
+    SafetensorsFile,
+    ShardedCheckpoint,
+    open_checkpoint,
+    stream_into_module,
+)
+from mochi_preview.dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from mz_gguf_loader import quantize_blocks
+import shard_dit
+
+
+def model_config(args):
+    # The blocks expect Mochi's MLP width of 8192.
+    return {**MOCHI_PREVIEW_CONFIG, "depth": args.depth, "hidden_size_x": args.hidden, "hidden_size_y": args.hidden // 2,
+            "mlp_ratio_x": 4.0 * 3072 / args.hidden}
+
+
+def write_checkpoint(args, path):
+    torch.manual_seed(0)
+    model = AsymmDiTJoint(**model_config(args), attention_mode="sdpa")
+    state_dict = {name: tensor.to(torch.bfloat16) for name, tensor in model.state_dict().items()}
+    # One scaled fp8 and one GGUF layer, as quantize_dit.py writes them.
+    fp8 = FP8Linear.from_linear(model.blocks[0].attn.qkv_x, out_dtype=torch.bfloat16)
+    state_dict.update({f"blocks.0.attn.qkv_x.{name}": tensor for name, tensor in fp8.state_dict().items()})
+    del state_dict["blocks.1.attn.qkv_x.weight"]
+    state_dict["blocks.1.attn.qkv_x.Q8_0_qweight"] = quantize_blocks(model.blocks[1].attn.qkv_x.weight.detach(), "Q8_0")
+    del model, fp8
+    save_file(state_dict, path)
+
+
+def run_one(args):
+    if args.mode == "prepare":
+        monolithic = os.path.join(args.path, "dit.safetensors")
+        sharded_dir = os.path.join(args.path, "dit_sharded")
+        write_checkpoint(args, monolithic)
+        shard_dit.convert(monolithic, sharded_dir)
+        return
+    checkpoint = open_checkpoint(args.path, load_file)
+    assert isinstance(checkpoint, ShardedCheckpoint if args.mode == "sharded" else SafetensorsFile)
+    with torch.device("meta"):
+        model = AsymmDiTJoint(**model_config(args), attention_mode="sdpa")
+    # Keep the layers stored as fp8 or GGUF as they are, they aren't converted here.
+    for name in ("blocks.0.attn.qkv_x", "blocks.1.attn.qkv_x"):
+        parent, _, attr = name.rpartition(".")
+        setattr(model.get_submodule(parent), attr, torch.nn.Module())
+    base = common.peak_rss()
+    start = time.perf_counter()
+    stream_into_module(model, checkpoint, lambda name: (torch.bfloat16, torch.device("cpu")), workers=args.workers)
+    seconds = time.perf_counter() - start
+    checkpoint.close()
+    print("{:<10} {:>8} {:>10.2f}s {:>14}".format(args.mode, args.workers, seconds, common.mib(common.peak_rss() - base)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--hidden", type=int, default=1536)
+    parser.add_argument("--workers", default="1,4", help="Comma separated worker counts")
+    parser.add_argument("--mode", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        args.workers = int(args.workers)
+        run_one(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        monolithic = os.path.join(tmp, "dit.safetensors")
+        sharded_dir = os.path.join(tmp, "dit_sharded")
+
+        def run(mode, path, workers=1):
+            subprocess.run(
+                [sys.executable, __file__, f"--mode={mode}", f"--path={path}", f"--workers={workers}",
+                 f"--depth={args.depth}", f"--hidden={args.hidden}"],
+                check=True,
+            )
+
+        # Children start from the peak RSS of their parent, so the parent never holds the model.
+        run("prepare", tmp)
+        print(f"{os.path.getsize(monolithic) / 1024**3:.2f} GB checkpoint, depth {args.depth}, loaded as bf16 on cpu")
+        print("{:<10} {:>8} {:>11} {:>14}".format("layout", "workers", "time", "peak RSS"))
+        for workers in args.workers.split(","):
+            run("monolithic", monolithic, workers)
+            run("sharded", os.path.join(sharded_dir, "base.safetensors"), workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Helpers shared by the benchmark scripts.
+
+The scripts run from a plain checkout, without ComfyUI, e.g.
+    python benchmarks/bench_packing.py --device cpu
+"""
+import os
+import resource
+import sys
+import time
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Counts bytes of fresh tensor storage produced by ATen ops.
+
+    Views and in-place results share storage with an input and are not counted,
+    so this measures the temporaries an implementation allocates on any device.
+    The largest one bounds the peak memory from below, also where peak_memory can't measure it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+        self.largest = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {
+            t.untyped_storage().data_ptr()
+            for t in tree_flatten((args, kwargs))[0]
+            if isinstance(t, torch.Tensor)
+        }
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                self.bytes += t.untyped_storage().nbytes()
+                self.largest = max(self.largest, t.untyped_storage().nbytes())
+                inputs.add(t.untyped_storage().data_ptr())
+        return out
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, *, device, warmup=1, iters=3):
+    """Mean wall time of fn() in seconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def peak_memory(fn, *, device):
+    """Peak allocated device memory of fn() in bytes, None on CPU."""
+    if torch.device(device).type != "cuda":
+        return None
+    synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    synchronize(device)
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, it only ever grows.
+
+    Run each configuration in its own process to compare host memory peaks.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def mib(n):
+    return "-" if n is None else f"{n / 1024**2:.1f} MiB"
@@ -1,54 +1,235 @@
 #based on ComfyUI's and MinusZoneAI's fp8_linear optimization
 
+import functools
+import logging
+from typing import Callable, Optional, Set, Union
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+log = logging.getLogger(__name__)
+
+FP8_DTYPES = (torch.float8_e4m3fn, torch.float8_e5m2)
+# Smallest scale, keeps all-zero rows and channels finite.
+MIN_SCALE = 1e-12
+
+
+def fp8_max(dtype: torch.dtype) -> float:
+    return torch.finfo(dtype).max
+
+
+def quantize_fp8(x: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """x / scale, saturated to the range of dtype and rounded to it."""
+    limit = fp8_max(dtype)
+    return torch.div(x, scale).clamp_(-limit, limit).to(dtype)
+
 
-def fp8_linear_forward(cls, original_dtype, input):
-    weight_dtype = cls.weight.dtype
-    if weight_dtype in [torch.float8_e4m3fn, torch.float8_e5m2]:
-        tensor_2d = False
-        if len(input.shape) == 2:
-            tensor_2d = True
-            input = input.unsqueeze(1)
-        if len(input.shape) == 3:
-            if weight_dtype == torch.float8_e4m3fn:
-                inn = input.reshape(-1, input.shape[2]).to(torch.float8_e5m2)
-            else:
-                inn = input.reshape(-1, input.shape[2]).to(torch.float8_e4m3fn)
-            w = cls.weight.t()
-
-            scale_weight = torch.ones((1), device=input.device, dtype=torch.float32)
-            scale_input = scale_weight
-
-            bias = cls.bias.to(original_dtype) if cls.bias is not None else None
-            out_dtype = original_dtype
-
-            if bias is not None:
-                o = torch._scaled_mm(inn, w, out_dtype=out_dtype, bias=bias, scale_a=scale_input, scale_b=scale_weight)
-            else:
-                o = torch._scaled_mm(inn, w, out_dtype=out_dtype, scale_a=scale_input, scale_b=scale_weight)
-
-            if isinstance(o, tuple):
-                o = o[0]
-
-            if tensor_2d:
-                return o.reshape(input.shape[0], -1)
-
-            return o.reshape((-1, input.shape[1], cls.weight.shape[0]))
+@functools.lru_cache(maxsize=None)
+def scaled_mm_support(device: torch.device) -> Optional[str]:
+    """"rowwise" if torch._scaled_mm takes per-row scales on device, "tensorwise" if only
+    scalar scales (sm89), None if the device has no fp8 matmul."""
+    if device.type != "cuda":
+        return None
+    capability = torch.cuda.get_device_capability(device)
+    if capability >= (9, 0):
+        return "rowwise"
+    return "tensorwise" if capability >= (8, 9) else None
+
+
+class FP8Linear(nn.Module):
+    """Linear layer with fp8 weights and dynamically scaled fp8 activations.
+
+    Weights are quantized once, with one scale per output channel (or one for the whole
+    tensor) kept in `scale_weight`. Every call quantizes the input with one scale per token
+    and runs torch._scaled_mm. Elsewhere, e.g. on CPU, forward_reference computes the same
+    thing by dequantizing, which is also the reference to test the fp8 kernels against.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        *,
+        weight_dtype: torch.dtype = torch.float8_e4m3fn,
+        input_dtype: torch.dtype = torch.float8_e4m3fn,
+        out_dtype: torch.dtype = torch.bfloat16,
+        per_channel: bool = True,
+        device: Optional[torch.device] = None,
+    ):
+        super().__init__()
+        assert weight_dtype in FP8_DTYPES and input_dtype in FP8_DTYPES
+        self.in_features = in_features
+        self.out_features = out_features
+        self.input_dtype = input_dtype
+        self.out_dtype = out_dtype
+        self.per_channel = per_channel
+        self.weight = nn.Parameter(
+            torch.empty(out_features, in_features, dtype=weight_dtype, device=device), requires_grad=False
+        )
+        self.register_buffer(
+            "scale_weight",
+            torch.ones(out_features if per_channel else 1, 1, dtype=torch.float32, device=device),
+        )
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features, dtype=out_dtype, device=device), requires_grad=False)
         else:
-            cls.to(original_dtype)
-            out = cls.original_forward(input.to(original_dtype))
-            return out
-    else:
-        return cls.original_forward(input)
+            self.register_parameter("bias", None)
 
-def convert_fp8_linear(module, original_dtype):
+    @classmethod
+    def from_linear(
+        cls,
+        linear: nn.Linear,
+        *,
+        weight_dtype: torch.dtype = torch.float8_e4m3fn,
+        out_dtype: torch.dtype = torch.bfloat16,
+        per_channel: bool = True,
+        device: Optional[torch.device] = None,
+    ) -> "FP8Linear":
+        """Quantize a loaded nn.Linear.
+
+        Weights already stored in fp8 (e.g. the fp8 checkpoint) are kept as they are with
+        unit scales, requantizing them would only add rounding error.
+
+        Args:
+            device: Where to quantize and keep the weights, defaults to the linear's device.
+        """
+        device = device or linear.weight.device
+        source = linear.weight.data
+        already_fp8 = source.dtype in FP8_DTYPES
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            weight_dtype=source.dtype if already_fp8 else weight_dtype,
+            out_dtype=out_dtype,
+            per_channel=per_channel and not already_fp8,
+            device="meta",
+        )
+        if already_fp8:
+            layer.weight = nn.Parameter(source.to(device), requires_grad=False)
+            layer.scale_weight = torch.ones(1, 1, dtype=torch.float32, device=device)
+        else:
+            weight = source.to(device, torch.float32)
+            amax = weight.abs().amax(dim=1, keepdim=True) if per_channel else weight.abs().amax().view(1, 1)
+            scale = amax.div_(fp8_max(weight_dtype)).clamp_(min=MIN_SCALE)
+            layer.weight = nn.Parameter(quantize_fp8(weight, scale, weight_dtype), requires_grad=False)
+            layer.scale_weight = scale
+            del weight
+        if linear.bias is not None:
+            layer.bias = nn.Parameter(linear.bias.data.to(device, out_dtype), requires_grad=False)
+        return layer
+
+    def input_scale(self, x: torch.Tensor) -> torch.Tensor:
+        """(M, 1) fp32 per-token scales of the 2D input."""
+        amax = x.abs().amax(dim=1, keepdim=True).float()
+        return amax.div_(fp8_max(self.input_dtype)).clamp_(min=MIN_SCALE)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        support = scaled_mm_support(x.device)
+        if support is None:
+            return self.forward_reference(x)
+
+        x_2d = x.reshape(-1, self.in_features)
+        scale_input = self.input_scale(x_2d)
+        x_fp8 = quantize_fp8(x_2d, scale_input, self.input_dtype)
+        w = self.weight.t()  # Column major, as _scaled_mm wants it.
+
+        if support == "rowwise":
+            scale_weight = self.scale_weight.t().expand(1, self.out_features).contiguous()
+            out = torch._scaled_mm(
+                x_fp8, w, scale_a=scale_input, scale_b=scale_weight, bias=self.bias, out_dtype=self.out_dtype
+            )
+        else:
+            # Scalar scales only: multiply with unit scales and apply both scales afterwards.
+            one = torch.ones((), device=x.device, dtype=torch.float32)
+            out = torch._scaled_mm(x_fp8, w, scale_a=one, scale_b=one, out_dtype=torch.float32)
+            if isinstance(out, tuple):
+                out = out[0]
+            out = out.mul_(scale_input).mul_(self.scale_weight.t())
+            if self.bias is not None:
+                out = out.add_(self.bias)
+            out = out.to(self.out_dtype)
+        if isinstance(out, tuple):
+            out = out[0]
+        return out.reshape(*x.shape[:-1], self.out_features)
+
+    def forward_reference(self, x: torch.Tensor) -> torch.Tensor:
+        """Dequantize and multiply in fp32, same quantization as forward."""
+        with torch.autocast(x.device.type, enabled=False):
+            x_2d = x.reshape(-1, self.in_features)
+            scale_input = self.input_scale(x_2d)
+            x_dq = quantize_fp8(x_2d, scale_input, self.input_dtype).float().mul_(scale_input)
+            w_dq = self.weight.float().mul_(self.scale_weight)
+            bias = self.bias.float() if self.bias is not None else None
+            out = F.linear(x_dq, w_dq, bias).to(self.out_dtype)
+        return out.reshape(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, "
+            f"weight_dtype={self.weight.dtype}, per_channel={self.per_channel}"
+        )
+
+
+def convert_fp8_linear(
+    module: nn.Module,
+    original_dtype: torch.dtype,
+    *,
+    per_channel: bool = True,
+    device: Union[None, torch.device, Callable[[str], torch.device]] = None,
+):
+    """Replace the nn.Linear layers of the transformer blocks by FP8Linear.
+
+    Args:
+        original_dtype: Output dtype of the layers.
+        device: Where each layer is quantized and kept, or a function of the layer name.
+            Layers are converted one at a time, so only one layer is ever in high precision there.
+    """
     setattr(module, "fp8_matmul_enabled", True)
-    for name, module in module.named_modules():
-        
-        if isinstance(module, nn.Linear):
-            if "blocks" in name:
-                #print(module, name)
-                original_forward = module.forward
-                setattr(module, "original_forward", original_forward)
-                setattr(module, "forward", lambda input, m=module: fp8_linear_forward(m, original_dtype, input))
+    linears = [
+        (name, child) for name, child in module.named_modules()
+        if isinstance(child, nn.Linear) and "blocks" in name
+    ]
+    for name, linear in linears:
+        parent_name, _, attr = name.rpartition(".")
+        target = device(name) if callable(device) else device
+        layer = FP8Linear.from_linear(linear, out_dtype=original_dtype, per_channel=per_channel, device=target)
+        setattr(module.get_submodule(parent_name), attr, layer)
+    log.info(f"Converted {len(linears)} linear layers to FP8Linear")
+
+
+def load_scaled_fp8_linears(module: nn.Module, state_dict: dict, original_dtype: torch.dtype) -> Set[str]:
+    """Replace the linears that state_dict stores as scaled fp8 by empty FP8Linear layers.
+
+    Scaled fp8 checkpoints (see quantize_dit.py) keep a scale_weight next to the fp8 weight
+    of each such layer. The new layers are on the old weights' device, ready to be loaded.
+    Only the scales are read, so state_dict can be a lazy checkpoint such as SafetensorsFile.
+
+    Returns:
+        Names of the state_dict entries of the replaced layers, to be loaded in their stored dtype.
+    """
+    names = set()
+    layers = 0
+    for key in state_dict.keys():
+        if not key.endswith(".scale_weight"):
+            continue
+        name = key[:-len(".scale_weight")]
+        linear = module.get_submodule(name)
+        parent_name, _, attr = name.rpartition(".")
+        # The fp8 weight dtype is a placeholder until the stored weight is assigned.
+        layer = FP8Linear(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            out_dtype=original_dtype,
+            per_channel=state_dict[key].shape[0] > 1,
+            device=linear.weight.device,
+        )
+        setattr(module.get_submodule(parent_name), attr, layer)
+        names.update(f"{name}.{tensor_name}" for tensor_name in layer.state_dict())
+        layers += 1
+    if layers:
+        log.info(f"Loading {layers} scaled fp8 linear layers")
+    return names
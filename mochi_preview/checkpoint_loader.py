@@ -0,0 +1,307 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+import resource
+import struct
+import sys
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+log = logging.getLogger(__name__)
+
+LOAD_WORKERS = 4
+# Bytes of checkpoint tensors read but not yet placed in the model at any time.
+LOAD_WINDOW_BYTES = 1 << 30
+# Index of a sharded checkpoint, in the directory of its shards (see shard_dit.py).
+SHARD_INDEX = "dit_index.json"
+SHARD_FORMAT = "mochi-dit-sharded"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def read_safetensors_header(path: str) -> Tuple[Dict[str, Tuple[str, Tuple[int, ...], int, int]], Dict[str, str]]:
+    """Tensors of a safetensors file as name: (dtype, shape, start, end) with absolute byte offsets, and its metadata."""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", None) or {}
+    data_start = 8 + header_size
+    tensors = {
+        name: (info["dtype"], tuple(info["shape"]),
+               data_start + info["data_offsets"][0], data_start + info["data_offsets"][1])
+        for name, info in header.items()
+    }
+    return tensors, metadata
+
+
+class MappedCheckpoint(Mapping):
+    """Tensors at known byte ranges of memory-mapped files, read on access.
+
+    Reading a tensor copies its bytes out of the mapping and then drops those pages from the
+    process again, so the files never add up in RSS. Subclasses fill `tensors` with
+    name: (dtype, shape, start, end) and `files` with the file of each tensor.
+    """
+
+    def __init__(self):
+        self.tensors: Dict[str, Tuple[torch.dtype, Tuple[int, ...], int, int]] = {}
+        self.files: Dict[str, str] = {}
+        self._mmaps = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tensors)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tensors)
+
+    def __contains__(self, name) -> bool:
+        return name in self.tensors
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        return self.read(name)
+
+    def shape(self, name: str) -> Tuple[int, ...]:
+        return self.tensors[name][1]
+
+    def nbytes(self, name: str) -> int:
+        _, _, start, end = self.tensors[name]
+        return end - start
+
+    def order(self, name: str):
+        """Sort key to read tensors in."""
+        return self.tensors[name][2]
+
+    def read(self, name: str, *, dtype: Optional[torch.dtype] = None, device: Union[str, torch.device] = "cpu") -> torch.Tensor:
+        """A copy of tensor name, converted to dtype on device."""
+        stored_dtype, shape, start, end = self.tensors[name]
+        if end == start:
+            return torch.empty(shape, dtype=dtype or stored_dtype, device=device)
+        mapping = self._mmap(self.files[name])
+        raw = torch.frombuffer(mapping, dtype=torch.uint8, count=end - start, offset=start)
+        tensor = raw.view(stored_dtype).reshape(shape).to(device=device, dtype=dtype or stored_dtype, copy=True)
+        del raw
+        if hasattr(mmap, "MADV_DONTNEED"):
+            # The pages are never written, so a neighbouring tensor sharing one just reads it in again.
+            page_start = start - start % mmap.PAGESIZE
+            mapping.madvise(mmap.MADV_DONTNEED, page_start, end - page_start)
+        return tensor
+
+    def _mmap(self, path: str) -> mmap.mmap:
+        with self._lock:
+            if path not in self._mmaps:
+                with open(path, "rb") as f:
+                    # Copy-on-write: torch.frombuffer wants a writable buffer, nothing ever writes to it.
+                    self._mmaps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            return self._mmaps[path]
+
+    def close(self):
+        with self._lock:
+            for mapping in self._mmaps.values():
+                mapping.close()
+            self._mmaps.clear()
+
+
+class SafetensorsFile(MappedCheckpoint):
+    """Memory-mapped safetensors file, only the header is parsed up front."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        tensors, self.metadata = read_safetensors_header(path)
+        for name, (dtype, shape, start, end) in tensors.items():
+            self.tensors[name] = (SAFETENSORS_DTYPES[dtype], shape, start, end)
+            self.files[name] = path
+
+
+class ShardedCheckpoint(MappedCheckpoint):
+    """DiT checkpoint split into one safetensors shard per transformer block plus one for the rest.
+
+    The index (see shard_dit.py) gives the shard, dtype, shape and byte range of every tensor,
+    so no shard is touched before one of its tensors is read and a partial load, e.g. with
+    stream_into_module(..., prefix="blocks.3."), only opens the shards it needs.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: The index, its directory or one of the shards next to it.
+        """
+        super().__init__()
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        with open(os.path.join(directory, SHARD_INDEX)) as f:
+            index = json.load(f)
+        if index.get("format") != SHARD_FORMAT:
+            raise ValueError(f"{directory} has no {SHARD_FORMAT} index")
+        self.path = directory
+        self.metadata = index["metadata"]
+        self.shards = list(index["shards"])
+        self.quantization: Dict[str, Optional[str]] = {}
+        self._shard_position = {}
+        for name, info in index["tensors"].items():
+            self.tensors[name] = (SAFETENSORS_DTYPES[info["dtype"]], tuple(info["shape"]), *info["data_offsets"])
+            self.files[name] = os.path.join(directory, index["shards"][info["shard"]])
+            self.quantization[name] = info["quantization"]
+            self._shard_position[name] = self.shards.index(info["shard"])
+
+    def order(self, name: str):
+        # Interleave the shards so concurrent reads go to different files, each read front to back.
+        return self.tensors[name][2], self._shard_position[name]
+
+
+def is_sharded_checkpoint(path: str) -> bool:
+    """Whether path is a shard index, its directory or one of the shards it lists.
+
+    Other files next to an index, e.g. unrelated checkpoints in the same models folder, aren't.
+    """
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    index_path = os.path.join(directory, SHARD_INDEX)
+    if not os.path.isfile(index_path):
+        return False
+    if os.path.isdir(path) or os.path.basename(path) == SHARD_INDEX:
+        return True
+    try:
+        with open(index_path) as f:
+            shards = json.load(f)["shards"].values()
+    except (OSError, ValueError, KeyError, AttributeError):
+        return False
+    return os.path.basename(path) in shards
+
+
+def open_checkpoint(path: str, load_fallback: Callable[[str], Dict[str, torch.Tensor]]) -> Mapping:
+    """ShardedCheckpoint for sharded checkpoints, SafetensorsFile for .safetensors files, else
+    the state dict load_fallback returns."""
+    if is_sharded_checkpoint(path):
+        return ShardedCheckpoint(path)
+    if os.path.splitext(path)[1].lower() == ".safetensors":
+        return SafetensorsFile(path)
+    return load_fallback(path)
+
+
+class LoadStats:
+    def __init__(self, *, tensors: int, nbytes: int, seconds: float, rss_growth: int, workers: int):
+        self.tensors = tensors
+        self.nbytes = nbytes
+        self.seconds = seconds
+        self.rss_growth = rss_growth
+        self.workers = workers
+
+    def __repr__(self):
+        gbytes = self.nbytes / 1024**3
+        return (
+            f"Loaded {self.tensors} tensors ({gbytes:.2f} GB) in {self.seconds:.2f}s "
+            f"({gbytes / max(self.seconds, 1e-9):.2f} GB/s) with {self.workers} workers, "
+            f"peak RSS grew by {self.rss_growth / 1024**3:.2f} GB"
+        )
+
+
+def _assign(module: nn.Module, name: str, tensor: torch.Tensor):
+    module_name, _, tensor_name = name.rpartition(".")
+    owner = module.get_submodule(module_name)
+    if tensor_name in owner._parameters:
+        old = owner._parameters[tensor_name]
+        owner._parameters[tensor_name] = old.__class__(tensor, requires_grad=old.requires_grad)
+    else:
+        owner._buffers[tensor_name] = tensor
+
+
+def stream_into_module(
+    module: nn.Module,
+    checkpoint: Mapping,
+    placement: Callable[[str], Tuple[Optional[torch.dtype], torch.device]],
+    *,
+    prefix: str = "",
+    workers: int = LOAD_WORKERS,
+    window_bytes: int = LOAD_WINDOW_BYTES,
+) -> LoadStats:
+    """Load the parameters and buffers of a (meta) module from a checkpoint.
+
+    Worker threads read, convert and move tensors while the calling thread assigns them, with
+    at most window_bytes of checkpoint data in flight. Host memory thus grows by the window
+    plus whatever ends up on the CPU, instead of the whole state dict on top of the model.
+
+    Args:
+        checkpoint: MappedCheckpoint or a state dict.
+        placement: Target (dtype, device) of each tensor by checkpoint name, a None dtype keeps the stored one.
+        prefix: Name of module in the checkpoint's model, e.g. "blocks.3." to load a single block.
+    """
+    targets = {prefix + name: tensor for name, tensor in itertools.chain(module.named_parameters(), module.named_buffers())}
+    names = list(targets)
+    missing = [name for name in names if name not in checkpoint]
+    if missing:
+        raise KeyError(f"Missing from checkpoint: {missing[:5]}{'...' if len(missing) > 5 else ''}")
+    is_mapped = isinstance(checkpoint, MappedCheckpoint)
+    for name in names:
+        shape = checkpoint.shape(name) if is_mapped else tuple(checkpoint[name].shape)
+        if shape != tuple(targets[name].shape):
+            raise ValueError(f"{name} has shape {shape} in the checkpoint, {tuple(targets[name].shape)} in the model")
+    if is_mapped:
+        # File order turns the reads into sequential passes.
+        names.sort(key=checkpoint.order)
+
+    def nbytes(name):
+        if is_mapped:
+            return checkpoint.nbytes(name)
+        return checkpoint[name].numel() * checkpoint[name].element_size()
+
+    def load(name):
+        dtype, device = placement(name)
+        if is_mapped:
+            return checkpoint.read(name, dtype=dtype, device=device)
+        return checkpoint[name].to(device=device, dtype=dtype or checkpoint[name].dtype)
+
+    start_rss, start = peak_rss(), time.perf_counter()
+    total = 0
+    in_flight, in_flight_bytes = {}, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def finish(done):
+            nonlocal in_flight_bytes
+            for future in done:
+                name, size = in_flight.pop(future)
+                _assign(module, name[len(prefix):], future.result())
+                in_flight_bytes -= size
+
+        for name in names:
+            size = nbytes(name)
+            while in_flight and in_flight_bytes + size > window_bytes:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                finish(done)
+            in_flight[executor.submit(load, name)] = (name, size)
+            in_flight_bytes += size
+            total += size
+        finish(list(in_flight))
+
+    return LoadStats(
+        tensors=len(names),
+        nbytes=total,
+        seconds=time.perf_counter() - start,
+        rss_growth=peak_rss() - start_rss,
+        workers=workers,
+    )
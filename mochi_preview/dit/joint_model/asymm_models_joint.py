@@ -1,13 +1,16 @@
 import os
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
-from torch.nn.attention import sdpa_kernel, SDPBackend
+from torch.nn.attention import sdpa_kernel
 
+from .attention_backends import resolve_attention_backend, sdpa_backends_for
+from .block_swap import BlockSwapper
+from .conditioning import ModulationTable, PreparedConditioning
 from .context_parallel import all_to_all_collect_tokens, all_to_all_collect_heads, all_gather, get_cp_rank_size, is_cp_active
 from .layers import (
     FeedForward,
@@ -19,36 +22,37 @@ from .mod_rmsnorm import modulated_rmsnorm
 from .residual_tanh_gated_rmsnorm import (
     residual_tanh_gated_rmsnorm,
 )
-from .rope_mixed import (
-    compute_mixed_rotation,
-    create_position_matrix,
-)
-from .temporal_rope import apply_rotary_emb_qk_real
+from .rope_mixed import RopeCache
+from .step_cache import StepCache
+from .temporal_rope import apply_qk_norm_rotary_emb_
 from .utils import (
     AttentionPool,
     modulate,
-    pad_and_split_xy,
-    unify_streams,
+    pack_qkv,
+    split_xy,
+    visual_qkv,
 )
 
-try:
-    from flash_attn import flash_attn_varlen_qkvpacked_func
-    FLASH_ATTN_IS_AVAILABLE = True
-except ImportError:
-    FLASH_ATTN_IS_AVAILABLE = False
-try:
-    from sageattention import sageattn
-    SAGEATTN_IS_AVAILABLE = True
-except ImportError:
-    SAGEATTN_IS_AVAILABLE = False
-
-backends = []
-if torch.cuda.get_device_properties(0).major < 7:
-    backends.append(SDPBackend.MATH)
-if torch.cuda.get_device_properties(0).major >= 9.0:
-    backends.append(SDPBackend.CUDNN_ATTENTION)
-else:
-    backends.append(SDPBackend.EFFICIENT_ATTENTION)
+# Architecture of the released Mochi 1 preview DiT checkpoints.
+MOCHI_PREVIEW_CONFIG = dict(
+    depth=48,
+    patch_size=2,
+    num_heads=24,
+    hidden_size_x=3072,
+    hidden_size_y=1536,
+    mlp_ratio_x=4.0,
+    mlp_ratio_y=4.0,
+    in_channels=12,
+    qk_norm=True,
+    qkv_bias=False,
+    out_bias=True,
+    patch_embed_bias=True,
+    timestep_mlp_bias=True,
+    timestep_scale=1000.0,
+    t5_feat_dim=4096,
+    t5_token_length=256,
+    rope_theta=10000.0,
+)
 
 
 class AsymmetricAttention(nn.Module):
@@ -78,6 +82,7 @@ class AsymmetricAttention(nn.Module):
         self.attend_to_padding = attend_to_padding
         self.softmax_scale = softmax_scale
         self.attention_mode = attention_mode
+        self._attention_backend = None
         if dim_x % num_heads != 0:
             raise ValueError(
                 f"dim_x={dim_x} should be divisible by num_heads={num_heads}"
@@ -133,7 +138,7 @@ class AsymmetricAttention(nn.Module):
         scale_y: torch.Tensor,
         rope_cos: torch.Tensor,
         rope_sin: torch.Tensor,
-        valid_token_indices: torch.Tensor,
+        packed_indices: Dict[str, torch.Tensor],
     ):
         # Pre-norm for visual features
         x = modulated_rmsnorm(x, scale_x)  # (B, M, dim_x) where M = N / cp_group_size
@@ -151,79 +156,41 @@ class AsymmetricAttention(nn.Module):
         q_y = self.q_norm_y(q_y)
         k_y = self.k_norm_y(k_y)
 
-        # Split qkv_x into q, k, v
-        q_x, k_x, v_x = qkv_x.unbind(0)  # (B, N, local_h, head_dim)
-        q_x = self.q_norm_x(q_x)
-        q_x = apply_rotary_emb_qk_real(q_x, rope_cos, rope_sin)
-        k_x = self.k_norm_x(k_x)
-        k_x = apply_rotary_emb_qk_real(k_x, rope_cos, rope_sin)
-
-        # Unite streams
-        qkv = unify_streams(
-            q_x,
-            k_x,
-            v_x,
+        # Unite streams, the visual queries and keys are written below.
+        qkv = pack_qkv(
+            None,
+            None,
+            qkv_x[2],
             q_y,
             k_y,
             v_y,
-            valid_token_indices,
+            packed_indices,
         )
 
+        # Normalize and rotate visual queries and keys straight into the packed tensor.
+        assert self.q_norm_x.eps == self.k_norm_x.eps
+        norm_weight = torch.stack([self.q_norm_x.weight, self.k_norm_x.weight])
+        for b, qkv_b in enumerate(visual_qkv(qkv, packed_indices, qkv_x.size(2))):
+            apply_qk_norm_rotary_emb_(
+                qkv_x[:2, b],
+                norm_weight,
+                rope_cos,
+                rope_sin,
+                out=qkv_b[:2],
+                eps=self.q_norm_x.eps,
+            )
+
         return qkv
     
-    def flash_attention(self, qkv, cu_seqlens, max_seqlen_in_batch, total, local_dim):
-        # Optimisé pour bf16
-        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-            out = flash_attn_varlen_qkvpacked_func(
-                qkv,
-                cu_seqlens=cu_seqlens,
-                max_seqlen=max_seqlen_in_batch,
-                dropout_p=0.0,
-                softmax_scale=self.softmax_scale,
-                causal=False,
-                return_attn_probs=False
+    def attention_backend(self, qkv: torch.Tensor):
+        """Resolve the attention backend lazily, on the device/dtype of the first call."""
+        backend = self._attention_backend
+        if backend is None or not backend.supports(qkv.device, qkv.dtype, qkv.size(0)):
+            backend = resolve_attention_backend(
+                self.attention_mode, device=qkv.device, dtype=qkv.dtype, seqlen=qkv.size(0)
             )
-            return out.view(total, local_dim)
-        
-    def sdpa_attention(self, qkv):
-        q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
-        with torch.autocast("cuda", enabled=False):
-            with sdpa_kernel(backends):
-                out = F.scaled_dot_product_attention(
-                    q, 
-                    k, 
-                    v, 
-                    attn_mask=None, 
-                    dropout_p=0.0, 
-                    is_causal=False
-                    )
-                return rearrange(out, 'b h s d -> s (b h d)')
-        
-    def sage_attention(self, qkv):
-        q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
-        with torch.autocast("cuda", enabled=False):
-            out = sageattn(
-                q, 
-                k, 
-                v, 
-                attn_mask=None, 
-                dropout_p=0.0, 
-                is_causal=False
-                )
-            return rearrange(out, 'b h s d -> s (b h d)')
-        
-    def comfy_attention(self, qkv):
-        from comfy.ldm.modules.attention import optimized_attention
-        q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
-        with torch.autocast("cuda", enabled=False):
-            out = optimized_attention(
-                q, 
-                k, 
-                v, 
-                heads = self.num_heads,
-                skip_reshape=True
-                )
-            return out.squeeze(0)
+            self._attention_backend = backend
+        return backend
 
     @torch.compiler.disable()
     def run_attention(
@@ -233,9 +200,7 @@ class AsymmetricAttention(nn.Module):
         B: int,
         L: int,
         M: int,
-        cu_seqlens: torch.Tensor,
-        max_seqlen_in_batch: int,
-        valid_token_indices: torch.Tensor,
+        packed_indices: Dict[str, torch.Tensor],
     ):
         _, cp_size = get_cp_rank_size()
         N = cp_size * M
@@ -244,16 +209,16 @@ class AsymmetricAttention(nn.Module):
         local_dim = local_heads * self.head_dim
         total = qkv.size(0)
 
-        if self.attention_mode == "flash_attn":
-            out = self.flash_attention(qkv, cu_seqlens, max_seqlen_in_batch, total, local_dim)
-        elif self.attention_mode == "sdpa":
-            out = self.sdpa_attention(qkv)
-        elif self.attention_mode == "sage_attn":
-            out = self.sage_attention(qkv)
-        elif self.attention_mode == "comfy":
-            out = self.comfy_attention(qkv)
-        
-        x, y = pad_and_split_xy(out, valid_token_indices, B, N, L, qkv.dtype)
+        out = self.attention_backend(qkv)(
+            qkv,
+            cu_seqlens=packed_indices["cu_seqlens_kv"],
+            max_seqlen_in_batch=packed_indices["max_seqlen_in_batch_kv"],
+            softmax_scale=self.softmax_scale,
+            cu_seqlens_host=packed_indices["cu_seqlens_host"],
+        )
+        assert out.size() == (total, local_dim)
+
+        x, y = split_xy(out, packed_indices, B, N, L)
         assert x.size() == (B, N, local_dim)
         assert y.size() == (B, L, local_dim)
 
@@ -303,7 +268,7 @@ class AsymmetricAttention(nn.Module):
             scale_y=scale_y,
             rope_cos=rope_rotation.get("rope_cos"),
             rope_sin=rope_rotation.get("rope_sin"),
-            valid_token_indices=packed_indices["valid_token_indices_kv"],
+            packed_indices=packed_indices,
         )  # (total <= B * (N + L), 3, local_heads, head_dim)
 
         x, y = self.run_attention(
@@ -311,9 +276,7 @@ class AsymmetricAttention(nn.Module):
             B=B,
             L=L,
             M=M,
-            cu_seqlens=packed_indices["cu_seqlens_kv"],
-            max_seqlen_in_batch=packed_indices["max_seqlen_in_batch_kv"],
-            valid_token_indices=packed_indices["valid_token_indices_kv"],
+            packed_indices=packed_indices,
         )
         return x, y
 
@@ -336,6 +299,8 @@ class AsymmetricJointBlock(nn.Module):
         self.hidden_size_x = hidden_size_x
         self.hidden_size_y = hidden_size_y
         self.attention_mode = attention_mode
+        # Memory budget of the visual MLP activations, see ff_block_x. None runs all tokens at once.
+        self.mlp_chunk_bytes: Optional[int] = None
         self.mod_x = nn.Linear(hidden_size_x, 4 * hidden_size_x, device=device)
         if self.update_y:
             self.mod_y = nn.Linear(hidden_size_x, 4 * hidden_size_y, device=device)
@@ -375,11 +340,24 @@ class AsymmetricJointBlock(nn.Module):
                 device=device,
             )
 
+    def modulation(self, c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Modulation vectors of this block, the only part that depends on c.
+
+        Args:
+            c: (..., dim) tensor of conditioned features, any number of leading rows.
+
+        Returns:
+            mod_x: (..., 4 * dim_x), mod_y: (..., 4 * dim_y) or (..., dim_y) for the last block.
+        """
+        c = F.silu(c)
+        return self.mod_x(c), self.mod_y(c)
+
     def forward(
         self,
         x: torch.Tensor,
         c: torch.Tensor,
         y: torch.Tensor,
+        mod: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **attn_kwargs,
     ):
         """Forward pass of a block.
@@ -388,6 +366,7 @@ class AsymmetricJointBlock(nn.Module):
             x: (B, N, dim) tensor of visual tokens
             c: (B, dim) tensor of conditioned features
             y: (B, L, dim) tensor of text tokens
+            mod: Precomputed modulation(c), c is unused when given.
             num_frames: Number of frames in the video. N = num_frames * num_spatial_tokens
 
         Returns:
@@ -396,11 +375,9 @@ class AsymmetricJointBlock(nn.Module):
         """
         N = x.size(1)
 
-        c = F.silu(c)
-        mod_x = self.mod_x(c)
+        mod_x, mod_y = self.modulation(c) if mod is None else mod
         scale_msa_x, gate_msa_x, scale_mlp_x, gate_mlp_x = mod_x.chunk(4, dim=1)
 
-        mod_y = self.mod_y(c)
         if self.update_y:
             scale_msa_y, gate_msa_y, scale_mlp_y, gate_mlp_y = mod_y.chunk(4, dim=1)
         else:
@@ -428,9 +405,21 @@ class AsymmetricJointBlock(nn.Module):
         return x, y
 
     def ff_block_x(self, x, scale_x, gate_x):
-        x_mod = modulated_rmsnorm(x, scale_x)
-        x_res = self.mlp_x(x_mod)
-        x = residual_tanh_gated_rmsnorm(x, x_res, gate_x)  # Sandwich norm
+        N = x.size(1)
+        chunk = self.mlp_x.chunk_size(N, x.dtype, self.mlp_chunk_bytes)
+        if chunk >= N or torch.is_grad_enabled():
+            x_mod = modulated_rmsnorm(x, scale_x)
+            x_res = self.mlp_x(x_mod)
+            x = residual_tanh_gated_rmsnorm(x, x_res, gate_x)  # Sandwich norm
+            return x
+
+        # Norms and MLP are per token: run them on token chunks so the (chunk, 2 * hidden)
+        # activation replaces the (N, 2 * hidden) one, and update x chunk by chunk.
+        for start in range(0, N, chunk):
+            x_chunk = x[:, start:start + chunk]
+            x_res = self.mlp_x(modulated_rmsnorm(x_chunk, scale_x))
+            # In place on the view in eager mode, a copy under torch.compile.
+            x_chunk.copy_(residual_tanh_gated_rmsnorm(x_chunk, x_res, gate_x))
         return x
 
     def ff_block_y(self, y, scale_y, gate_y):
@@ -461,9 +450,13 @@ class FinalLayer(nn.Module):
             hidden_size, patch_size * patch_size * out_channels, device=device
         )
 
-    def forward(self, x, c):
-        c = F.silu(c)
-        shift, scale = self.mod(c).chunk(2, dim=1)
+    def modulation(self, c):
+        return self.mod(F.silu(c))
+
+    def forward(self, x, c, mod=None):
+        if mod is None:
+            mod = self.modulation(c)
+        shift, scale = mod.chunk(2, dim=1)
         x = modulate(self.norm_final(x), shift, scale)
         x = self.linear(x)
         return x
@@ -516,6 +509,8 @@ class AsymmDiTJoint(nn.Module):
         self.rope_theta = (
             rope_theta  # Scaling factor for frequency computation for temporal RoPE.
         )
+        # RoPE tables don't change during a run, keep them across steps and runs.
+        self.rope_cache = RopeCache()
 
         self.x_embedder = PatchEmbed(
             patch_size=patch_size,
@@ -569,11 +564,32 @@ class AsymmDiTJoint(nn.Module):
 
             blocks.append(block)
         self.blocks = nn.ModuleList(blocks)
+        # Set by enable_block_swap to stream some blocks from host memory.
+        self.block_swap: Optional[BlockSwapper] = None
 
         self.final_layer = FinalLayer(
             hidden_size_x, patch_size, self.out_channels, device=device
         )
 
+    def enable_block_swap(self, blocks_to_swap: int, *, device: torch.device, offload_device: torch.device):
+        """Keep only the first depth - blocks_to_swap blocks on `device`, see BlockSwapper."""
+        self.block_swap = None
+        if blocks_to_swap > 0:
+            self.block_swap = BlockSwapper(
+                self.blocks, blocks_to_swap=blocks_to_swap, device=device, offload_device=offload_device
+            )
+
+    def set_mlp_chunk_bytes(self, max_chunk_bytes: Optional[int]):
+        """Run the visual MLPs on token chunks whose activations fit in max_chunk_bytes, None disables."""
+        for block in self.blocks:
+            block.mlp_chunk_bytes = max_chunk_bytes
+
+    def iter_blocks(self):
+        """(index, block) pairs with each block's weights on the compute device when it's used."""
+        if self.block_swap is None:
+            return enumerate(self.blocks)
+        return iter(self.block_swap)
+
     def embed_x(self, x: torch.Tensor) -> torch.Tensor:
         """
         Args:
@@ -584,90 +600,161 @@ class AsymmDiTJoint(nn.Module):
         """
         return self.x_embedder(x)  # Convert BcTHW to BCN
 
-    def prepare(
+    def prepare_conditioning(
         self,
-        x: torch.Tensor,
-        sigma: torch.Tensor,
         t5_feat: torch.Tensor,
         t5_mask: torch.Tensor,
+        packed_indices: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> PreparedConditioning:
+        """Project and pool the T5 features once, they don't depend on the timestep.
+
+        Args:
+            t5_feat: (B, L, t5_feat_dim) tensor of T5 token features.
+            t5_mask: (B, L) boolean tensor indicating which tokens are not padding.
+            packed_indices: Result of compute_packed_indices, stored alongside for forward.
+        """
+        with torch.profiler.record_function("t5_pool"):
+            # L can be shorter when padding was trimmed, see trimmed_text_length.
+            assert (
+                t5_feat.size(1) <= self.t5_token_length
+            ), f"Expected L<={self.t5_token_length}, got {t5_feat.shape} for y_feat."
+            # Use EFFICIENT_ATTENTION backend for T5 pooling, since we have a mask.
+            # Have to call sdpa_kernel outside of a torch.compile region.
+            with sdpa_kernel(sdpa_backends_for(t5_feat.device)):
+                t5_y_pool = self.t5_y_embedder(t5_feat, t5_mask)  # (B, D)
+
+        y_feat = self.t5_yproj(t5_feat)  # (B, L, t5_feat_dim) --> (B, L, D)
+
+        return PreparedConditioning(
+            y_feat=y_feat,
+            y_pool=t5_y_pool,
+            y_mask=t5_mask,
+            packed_indices=packed_indices,
+        )
+
+    def prepare(
+        self,
+        x: torch.Tensor,
+        sigma: Optional[torch.Tensor],
+        conditioning: PreparedConditioning,
     ):
-        """Prepare input and conditioning embeddings."""
-        #("X", x.shape)
+        """Prepare input and conditioning embeddings.
+
+        With sigma None, e.g. when c comes from precompute_modulation, c isn't computed and is None.
+        """
         with torch.profiler.record_function("x_emb_pe"):
             # Visual patch embeddings with positional encoding.
             T, H, W = x.shape[-3:]
-            pH, pW = H // self.patch_size, W // self.patch_size
             x = self.embed_x(x)  # (B, N, D), where N = T * H * W / patch_size ** 2
             assert x.ndim == 3
             B = x.size(0)
 
         with torch.profiler.record_function("rope_cis"):
-            # Construct position array of size [N, 3].
-            # pos[:, 0] is the frame index for each location,
-            # pos[:, 1] is the row index for each location, and
-            # pos[:, 2] is the column index for each location.
+            # Rotation tables for the N = T * pH * pW visual tokens,
+            # only for the heads handled by this context parallel rank.
             pH, pW = H // self.patch_size, W // self.patch_size
             N = T * pH * pW
             assert x.size(1) == N
-            pos = create_position_matrix(
-                T, pH=pH, pW=pW, device=x.device, dtype=torch.float32
-            )  # (N, 3)
-            rope_cos, rope_sin = compute_mixed_rotation(
-                freqs=self.pos_frequencies, pos=pos
-            )  # Each are (N, num_heads, dim // 2)
+            cp_rank, cp_size = get_cp_rank_size()
+            assert self.num_heads % cp_size == 0
+            local_heads = self.num_heads // cp_size
+            rope_cos, rope_sin = self.rope_cache.get(
+                self.pos_frequencies,
+                T=T,
+                pH=pH,
+                pW=pW,
+                device=x.device,
+                head_start=cp_rank * local_heads,
+                num_heads=local_heads,
+            )  # Each are (N, local_heads, dim // 2)
 
-        with torch.profiler.record_function("t_emb"):
-            # Global vector embedding for conditionings.
-            c_t = self.t_embedder(1 - sigma)  # (B, D)
+        assert (
+            conditioning.y_pool.size(0) == B
+        ), f"Expected B={B}, got {conditioning.y_pool.shape} for t5_y_pool."
+        c = None
+        if sigma is not None:
+            with torch.profiler.record_function("t_emb"):
+                # Global vector embedding for conditionings.
+                c_t = self.t_embedder(1 - sigma)  # (B, D)
+            c = c_t + conditioning.y_pool
+
+        return x, c, conditioning.y_feat, rope_cos, rope_sin
+
+    def precompute_modulation(
+        self,
+        sigmas: Sequence[float],
+        conditioning: PreparedConditioning,
+    ) -> ModulationTable:
+        """Evaluate the modulation of every block for a whole sigma schedule.
 
-        with torch.profiler.record_function("t5_pool"):
-            # Pool T5 tokens using attention pooler
-            # Note y_feat[1] contains T5 token features.
-            # print("B", B)
-            # print("t5 feat shape",t5_feat.shape)
-            # print("t5 mask shape", t5_mask.shape)
-            assert (
-                t5_feat.size(1) == self.t5_token_length
-            ), f"Expected L={self.t5_token_length}, got {t5_feat.shape} for y_feat."
-            t5_y_pool = self.t5_y_embedder(t5_feat, t5_mask)  # (B, D)
-            assert (
-                t5_y_pool.size(0) == B
-            ), f"Expected B={B}, got {t5_y_pool.shape} for t5_y_pool."
+        c only depends on sigma and the pooled caption, so instead of two small GEMMs
+        per block per forward, each block's mod layers run once over all steps.
 
-        c = c_t + t5_y_pool
+        The schedule is checked here, once: forward then trusts `step` and never reads sigma
+        back from the device.
 
-        y_feat = self.t5_yproj(t5_feat)  # (B, L, t5_feat_dim) --> (B, L, D)
+        Args:
+            sigmas: Noise levels of the sampling steps, in the order forward will be called with `step`.
+            conditioning: Output of prepare_conditioning.
+        """
+        sigmas = [float(s) for s in sigmas]
+        if not sigmas or not all(0.0 <= s <= 1.0 for s in sigmas):
+            raise ValueError(f"Expected a non-empty schedule of sigmas in [0, 1], got {sigmas}")
+        y_pool = conditioning.y_pool  # (B, D)
+        sigma = torch.tensor(sigmas, device=y_pool.device, dtype=torch.float32)
+        S, B = sigma.size(0), y_pool.size(0)
+        c = self.t_embedder(1 - sigma)[:, None] + y_pool[None]  # (S, B, D)
+        c_flat = c.flatten(0, 1)
 
-        return x, c, y_feat, rope_cos, rope_sin
+        blocks = []
+        for _, block in self.iter_blocks():
+            mod_x, mod_y = block.modulation(c_flat)
+            blocks.append((mod_x.unflatten(0, (S, B)), mod_y.unflatten(0, (S, B))))
+        final = self.final_layer.modulation(c_flat).unflatten(0, (S, B))
+        return ModulationTable(sigmas=sigmas, c=c, blocks=blocks, final=final)
 
     def forward(
         self,
         x: torch.Tensor,
         sigma: torch.Tensor,
-        y_feat: List[torch.Tensor],
-        y_mask: List[torch.Tensor],
+        y_feat: Optional[List[torch.Tensor]] = None,
+        y_mask: Optional[List[torch.Tensor]] = None,
         packed_indices: Dict[str, torch.Tensor] = None,
         rope_cos: torch.Tensor = None,
         rope_sin: torch.Tensor = None,
+        conditioning: Optional[PreparedConditioning] = None,
+        modulation: Optional[ModulationTable] = None,
+        step: Optional[int] = None,
+        step_cache: Optional[StepCache] = None,
     ):
         """Forward pass of DiT.
 
         Args:
             x: (B, C, T, H, W) tensor of spatial inputs (images or latent representations of images)
-            sigma: (B,) tensor of noise standard deviations
+            sigma: (B,) tensor of noise standard deviations, unused with modulation.
             y_feat: List((B, L, y_feat_dim) tensor of caption token features. For SDXL text encoders: L=77, y_feat_dim=2048)
             y_mask: List((B, L) boolean tensor indicating which tokens are not padding)
             packed_indices: Dict with keys for Flash Attention. Result of compute_packed_indices.
+            conditioning: Output of prepare_conditioning, replaces y_feat, y_mask and packed_indices.
+            modulation: Output of precompute_modulation for this conditioning, used with step.
+            step: Index of the sampling step in the schedule passed to precompute_modulation.
+            step_cache: Reuse the blocks' residual from an earlier step when the input barely changed.
+                Use one cache per conditioning.
         """
         B, _, T, H, W = x.shape
 
-        # Use EFFICIENT_ATTENTION backend for T5 pooling, since we have a mask.
-        # Have to call sdpa_kernel outside of a torch.compile region.
-        with sdpa_kernel(backends):
-            x, c, y_feat, rope_cos, rope_sin = self.prepare(
-                x, sigma, y_feat[0], y_mask[0]
-            )
-        del y_mask
+        if conditioning is None:
+            conditioning = self.prepare_conditioning(y_feat[0], y_mask[0], packed_indices)
+        packed_indices = conditioning.packed_indices
+        del y_feat, y_mask
+
+        if modulation is not None:
+            if step is None or not 0 <= step < len(modulation):
+                raise ValueError(f"modulation needs a step in [0, {len(modulation)}), got {step}")
+            x, _, y_feat, rope_cos, rope_sin = self.prepare(x, None, conditioning)
+            c = modulation.c[step]
+        else:
+            x, c, y_feat, rope_cos, rope_sin = self.prepare(x, sigma, conditioning)
 
         cp_rank, cp_size = get_cp_rank_size()
         N = x.size(1)
@@ -676,26 +763,43 @@ class AsymmDiTJoint(nn.Module):
             N % cp_size == 0
         ), f"Visual sequence length ({x.shape[1]}) must be divisible by cp_size ({cp_size})."
 
+        mods = [modulation.block(i, step) if modulation is not None else None for i in range(len(self.blocks))]
+        compute_blocks = True
+        if step_cache is not None:
+            if mods[0] is None:
+                mods[0] = self.blocks[0].modulation(c)
+            scale_msa_x = mods[0][0].chunk(4, dim=1)[0]
+            # Decided on tokens of the whole sequence, so every context parallel rank agrees.
+            # The norm is per token, normalizing the summary gives the summary of the norm.
+            compute_blocks = step_cache.should_compute(modulated_rmsnorm(step_cache.summarize(x), scale_msa_x), step)
+
         if cp_size > 1:
             x = x.narrow(1, cp_rank * M, M)
 
-            assert self.num_heads % cp_size == 0
-            local_heads = self.num_heads // cp_size
-            rope_cos = rope_cos.narrow(1, cp_rank * local_heads, local_heads)
-            rope_sin = rope_sin.narrow(1, cp_rank * local_heads, local_heads)
-
-        for i, block in enumerate(self.blocks):
-            x, y_feat = block(
-                x,
-                c,
-                y_feat,
-                rope_cos=rope_cos,
-                rope_sin=rope_sin,
-                packed_indices=packed_indices,
-            )  # (B, M, D), (B, L, D)
+        if compute_blocks:
+            # Without autograd the blocks update x and y in place. Keep the block input
+            # for the step cache and the prepared text features for the next steps.
+            x_in = x.clone() if step_cache is not None else x
+            y_feat = y_feat.clone()
+            for i, block in self.iter_blocks():
+                x, y_feat = block(
+                    x,
+                    c,
+                    y_feat,
+                    mod=mods[i],
+                    rope_cos=rope_cos,
+                    rope_sin=rope_sin,
+                    packed_indices=packed_indices,
+                )  # (B, M, D), (B, L, D)
+            if step_cache is not None:
+                step_cache.store(x_in, x)
+        else:
+            x = step_cache.apply(x)
         del y_feat  # Final layers don't use dense text features.
 
-        x = self.final_layer(x, c)  # (B, M, patch_size ** 2 * out_channels)
+        x = self.final_layer(
+            x, c, mod=modulation.final[step] if modulation is not None else None
+        )  # (B, M, patch_size ** 2 * out_channels)
 
         patch = x.size(2)
         x = all_gather(x) 
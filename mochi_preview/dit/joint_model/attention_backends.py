@@ -0,0 +1,325 @@
+import functools
+import importlib.util
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+from torch.nn.attention import sdpa_kernel, SDPBackend
+
+try:
+    from flash_attn import flash_attn_varlen_qkvpacked_func
+    FLASH_ATTN_IS_AVAILABLE = True
+except ImportError:
+    FLASH_ATTN_IS_AVAILABLE = False
+try:
+    from sageattention import sageattn
+    SAGEATTN_IS_AVAILABLE = True
+except ImportError:
+    SAGEATTN_IS_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+# Upper bound for the fp32 score matrix of a single query chunk in the chunked backend.
+CHUNKED_ATTENTION_MAX_BYTES = 256 * 1024**2
+
+# Query and key tokens per tile, and upper bound for the fp32 scores of one tile, in the blocked backend.
+BLOCKED_ATTENTION_BLOCK_SIZE = 1024
+BLOCKED_ATTENTION_MAX_BYTES = 128 * 1024**2
+
+# Backends tried, in order, when the requested one can't run on the current device/dtype.
+FALLBACK_ORDER = ("sdpa", "chunked")
+
+
+@functools.lru_cache(maxsize=None)
+def _sdpa_backends(device_type: str, device_index: Optional[int]) -> Tuple[SDPBackend, ...]:
+    if device_type != "cuda":
+        return (SDPBackend.FLASH_ATTENTION, SDPBackend.MATH)
+    major = torch.cuda.get_device_properties(device_index or 0).major
+    backends = []
+    if major < 7:
+        backends.append(SDPBackend.MATH)
+    if major >= 9:
+        backends.append(SDPBackend.CUDNN_ATTENTION)
+    else:
+        backends.append(SDPBackend.EFFICIENT_ATTENTION)
+    return tuple(backends)
+
+
+def sdpa_backends_for(device: torch.device) -> List[SDPBackend]:
+    """SDPA kernels to enable on `device`, queried lazily and cached per device."""
+    device = torch.device(device)
+    return list(_sdpa_backends(device.type, device.index))
+
+
+class AttentionBackend:
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., torch.Tensor],
+        *,
+        devices: Sequence[str],
+        dtypes: Sequence[torch.dtype],
+        varlen: bool,
+        max_seqlen: Optional[int] = None,
+        is_available: Callable[[], bool] = lambda: True,
+    ):
+        """
+        Args:
+            name: Name selected through `attention_mode`.
+            fn: fn(qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale) -> (total, local_heads * head_dim).
+                qkv is the packed (total, 3, local_heads, head_dim) tensor.
+            devices: Device types the backend runs on.
+            dtypes: Supported qkv dtypes.
+            varlen: Whether fn handles several sequences packed along total via cu_seqlens.
+                Other backends are called once per sequence, see __call__.
+            max_seqlen: Longest packed sequence supported, None if unbounded.
+            is_available: Returns whether the backend's dependencies are importable.
+        """
+        self.name = name
+        self.fn = fn
+        self.devices = tuple(devices)
+        self.dtypes = tuple(dtypes)
+        self.varlen = varlen
+        self.max_seqlen = max_seqlen
+        self.is_available = is_available
+
+    def supports(self, device: torch.device, dtype: torch.dtype, seqlen: int) -> bool:
+        return (
+            self.is_available()
+            and torch.device(device).type in self.devices
+            and dtype in self.dtypes
+            and (self.max_seqlen is None or seqlen <= self.max_seqlen)
+        )
+
+    def __call__(self, qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale=None, cu_seqlens_host=None):
+        """Attention over the packed qkv.
+
+        Args:
+            cu_seqlens_host: cu_seqlens as a list of ints. Backends without varlen support
+                need it to attend within each sample when several are packed together.
+        """
+        if self.varlen or cu_seqlens_host is None or len(cu_seqlens_host) <= 2:
+            return self.fn(
+                qkv,
+                cu_seqlens=cu_seqlens,
+                max_seqlen_in_batch=max_seqlen_in_batch,
+                softmax_scale=softmax_scale,
+            )
+
+        total, _, local_heads, head_dim = qkv.shape
+        out = qkv.new_empty(total, local_heads * head_dim)
+        for start, end in zip(cu_seqlens_host[:-1], cu_seqlens_host[1:]):
+            out[start:end] = self.fn(
+                qkv[start:end],
+                cu_seqlens=None,
+                max_seqlen_in_batch=end - start,
+                softmax_scale=softmax_scale,
+            )
+        return out
+
+    def __repr__(self):
+        return f"AttentionBackend(name={self.name!r}, devices={self.devices}, varlen={self.varlen})"
+
+
+ATTENTION_BACKENDS: Dict[str, AttentionBackend] = {}
+
+
+def register_attention_backend(backend: AttentionBackend) -> AttentionBackend:
+    ATTENTION_BACKENDS[backend.name] = backend
+    return backend
+
+
+def get_attention_backend(name: str) -> AttentionBackend:
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unknown attention_mode {name!r}, expected one of {sorted(ATTENTION_BACKENDS)}"
+        )
+    return ATTENTION_BACKENDS[name]
+
+
+def available_attention_backends():
+    return [name for name, backend in ATTENTION_BACKENDS.items() if backend.is_available()]
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_fallback(name, device_type, dtype, fallback):
+    # Every attention layer resolves its backend, only warn once per combination.
+    log.warning(f"Attention backend {name!r} can't run on {device_type} with {dtype}, falling back to {fallback!r}")
+
+
+def resolve_attention_backend(
+    name: str, *, device: torch.device, dtype: torch.dtype, seqlen: int
+) -> AttentionBackend:
+    """Return the requested backend, or the first fallback that can run on device/dtype/seqlen."""
+    backend = get_attention_backend(name)
+    if backend.supports(device, dtype, seqlen):
+        return backend
+    for fallback in FALLBACK_ORDER:
+        candidate = ATTENTION_BACKENDS[fallback]
+        if candidate.supports(device, dtype, seqlen):
+            _warn_fallback(name, torch.device(device).type, dtype, fallback)
+            return candidate
+    raise RuntimeError(f"No attention backend supports {device}, {dtype}, seqlen={seqlen}")
+
+
+def flash_attention(qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale=None):
+    total, _, local_heads, head_dim = qkv.shape
+    with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+        out = flash_attn_varlen_qkvpacked_func(
+            qkv,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen_in_batch,
+            dropout_p=0.0,
+            softmax_scale=softmax_scale,
+            causal=False,
+            return_attn_probs=False
+        )
+    return out.view(total, local_heads * head_dim)
+
+
+def sdpa_attention(qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale=None):
+    q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
+    with torch.autocast(qkv.device.type, enabled=False):
+        with sdpa_kernel(sdpa_backends_for(qkv.device)):
+            out = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=None,
+                dropout_p=0.0,
+                is_causal=False,
+                scale=softmax_scale,
+                )
+    return rearrange(out, 'b h s d -> s (b h d)')
+
+
+def sage_attention(qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale=None):
+    q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
+    with torch.autocast(qkv.device.type, enabled=False):
+        out = sageattn(
+            q,
+            k,
+            v,
+            attn_mask=None,
+            dropout_p=0.0,
+            is_causal=False
+            )
+    return rearrange(out, 'b h s d -> s (b h d)')
+
+
+def comfy_attention(qkv, *, cu_seqlens, max_seqlen_in_batch, softmax_scale=None):
+    from comfy.ldm.modules.attention import optimized_attention
+    q, k, v = rearrange(qkv, '(b s) t h d -> t b h s d', b=1)
+    with torch.autocast(qkv.device.type, enabled=False):
+        out = optimized_attention(
+            q,
+            k,
+            v,
+            heads=qkv.size(2),
+            skip_reshape=True
+            )
+    return out.squeeze(0)
+
+
+def chunked_attention(
+    qkv,
+    *,
+    cu_seqlens,
+    max_seqlen_in_batch,
+    softmax_scale=None,
+    max_chunk_bytes: int = CHUNKED_ATTENTION_MAX_BYTES,
+):
+    """Pure PyTorch attention over query chunks.
+
+    Only a (local_heads, chunk, S) fp32 score matrix is alive at a time, with the chunk
+    size derived from `max_chunk_bytes`, so this runs on CPU without an N x N allocation.
+    """
+    S, _, H, D = qkv.shape
+    scale = softmax_scale if softmax_scale is not None else D**-0.5
+    q, k, v = rearrange(qkv, 's t h d -> t h s d')
+    k_t = k.float().transpose(1, 2)  # (H, D, S)
+    v = v.float()
+
+    out = torch.empty(S, H, D, device=qkv.device, dtype=qkv.dtype)
+    chunk = max(1, max_chunk_bytes // (H * S * 4))
+    with torch.autocast(qkv.device.type, enabled=False):
+        for start in range(0, S, chunk):
+            end = min(start + chunk, S)
+            scores = torch.matmul(q[:, start:end].float(), k_t).mul_(scale)  # (H, chunk, S)
+            scores.sub_(scores.amax(dim=-1, keepdim=True)).exp_()
+            scores.div_(scores.sum(dim=-1, keepdim=True))
+            out[start:end] = torch.matmul(scores, v).transpose(0, 1)
+            del scores
+    return out.view(S, H * D)
+
+
+def blocked_attention(
+    qkv,
+    *,
+    cu_seqlens,
+    max_seqlen_in_batch,
+    softmax_scale=None,
+    block_size: int = BLOCKED_ATTENTION_BLOCK_SIZE,
+    max_tile_bytes: int = BLOCKED_ATTENTION_MAX_BYTES,
+):
+    """Pure PyTorch attention over tiles of queries, keys and heads with an online softmax.
+
+    Unlike the chunked backend, no score row spans the whole sequence: each query block
+    visits the key blocks in turn, keeping a running max, denominator and fp32 output,
+    as in FlashAttention. Memory is O(S * block_size) whatever the sequence length.
+    """
+    S, _, H, D = qkv.shape
+    scale = softmax_scale if softmax_scale is not None else D**-0.5
+    q, k, v = rearrange(qkv, 's t h d -> t h s d')
+    head_block = max(1, min(H, max_tile_bytes // (block_size * block_size * 4)))
+
+    out = torch.empty(S, H, D, device=qkv.device, dtype=qkv.dtype)
+    with torch.autocast(qkv.device.type, enabled=False):
+        for h0 in range(0, H, head_block):
+            h1 = min(h0 + head_block, H)
+            for q0 in range(0, S, block_size):
+                q1 = min(q0 + block_size, S)
+                q_tile = q[h0:h1, q0:q1].to(torch.float32, copy=True).mul_(scale)  # (h, bq, D)
+                row_max = q_tile.new_full((h1 - h0, q1 - q0, 1), float("-inf"))
+                row_sum = q_tile.new_zeros((h1 - h0, q1 - q0, 1))
+                acc = q_tile.new_zeros((h1 - h0, q1 - q0, D))
+                for k0 in range(0, S, block_size):
+                    k1 = min(k0 + block_size, S)
+                    scores = torch.matmul(q_tile, k[h0:h1, k0:k1].float().transpose(1, 2))  # (h, bq, bk)
+                    new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+                    correction = row_max.sub_(new_max).exp_()
+                    scores.sub_(new_max).exp_()
+                    row_sum.mul_(correction).add_(scores.sum(dim=-1, keepdim=True))
+                    acc.mul_(correction).baddbmm_(scores, v[h0:h1, k0:k1].float())
+                    row_max = new_max
+                    del scores
+                out[q0:q1, h0:h1] = acc.div_(row_sum).transpose(0, 1)
+    return out.view(S, H * D)
+
+
+_HALF_DTYPES = (torch.float16, torch.bfloat16)
+_FLOAT_DTYPES = (torch.float16, torch.bfloat16, torch.float32)
+
+register_attention_backend(AttentionBackend(
+    "flash_attn", flash_attention, devices=("cuda",), dtypes=_HALF_DTYPES, varlen=True,
+    is_available=lambda: FLASH_ATTN_IS_AVAILABLE,
+))
+register_attention_backend(AttentionBackend(
+    "sdpa", sdpa_attention, devices=("cuda", "cpu", "mps"), dtypes=_FLOAT_DTYPES, varlen=False,
+))
+register_attention_backend(AttentionBackend(
+    "sage_attn", sage_attention, devices=("cuda",), dtypes=_HALF_DTYPES, varlen=False,
+    is_available=lambda: SAGEATTN_IS_AVAILABLE,
+))
+register_attention_backend(AttentionBackend(
+    "comfy", comfy_attention, devices=("cuda", "cpu", "mps"), dtypes=_FLOAT_DTYPES, varlen=False,
+    is_available=lambda: importlib.util.find_spec("comfy") is not None,
+))
+register_attention_backend(AttentionBackend(
+    "chunked", chunked_attention, devices=("cuda", "cpu", "mps"), dtypes=_FLOAT_DTYPES, varlen=False,
+))
+register_attention_backend(AttentionBackend(
+    "blocked", blocked_attention, devices=("cuda", "cpu", "mps"), dtypes=_FLOAT_DTYPES, varlen=False,
+))
@@ -0,0 +1,187 @@
+import logging
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+log = logging.getLogger(__name__)
+
+
+def _assign(module: nn.Module, name: str, tensor: torch.Tensor):
+    if name in module._parameters:
+        module._parameters[name].data = tensor
+    else:
+        module._buffers[name] = tensor
+
+
+class BlockSwapper:
+    """Keep some transformer blocks on the compute device and stream the others in.
+
+    Swapped blocks live in pinned host memory. While block i runs, the weights of the
+    next swapped block are copied on a separate CUDA stream, so the transfer overlaps with
+    compute and only the transfers that take longer than a block stall the forward. At most
+    two swapped blocks are on the device at any time.
+
+    Iterate over the swapper instead of `blocks` to get each block with its weights on
+    the device:
+
+        for i, block in swapper:
+            x, y = block(x, c, y, ...)
+    """
+
+    def __init__(
+        self,
+        blocks: nn.ModuleList,
+        *,
+        blocks_to_swap: int,
+        device: torch.device,
+        offload_device: torch.device,
+    ):
+        """
+        Args:
+            blocks: Blocks of the model, the last `blocks_to_swap` of them are streamed.
+            blocks_to_swap: Number of blocks kept off the compute device.
+            device: Compute device.
+            offload_device: Where swapped blocks are kept between uses, usually the CPU.
+        """
+        # The first block stays resident, forward may need its modulation outside the block loop.
+        assert 0 < blocks_to_swap < len(blocks), f"blocks_to_swap must be in [1, {len(blocks) - 1}], got {blocks_to_swap}"
+        self.blocks = blocks
+        self.device = torch.device(device)
+        self.offload_device = torch.device(offload_device)
+        self.swapped = list(range(len(blocks) - blocks_to_swap, len(blocks)))
+        self.use_streams = self.device.type == "cuda"
+        self.copy_stream = torch.cuda.Stream(self.device) if self.use_streams else None
+
+        # Per swapped block: (module, parameter name, host tensor).
+        self.host_tensors = {}
+        self.ready = {}  # Block index -> event recorded on copy_stream after its transfer.
+        self.loaded = set()
+        self.timings: List[Tuple[str, torch.cuda.Event, torch.cuda.Event]] = []
+        self.bytes_transferred = 0
+
+    @property
+    def resident(self) -> int:
+        return len(self.blocks) - len(self.swapped)
+
+    def setup(self):
+        """Move resident blocks to the device and swapped blocks to pinned host memory."""
+        first_setup = not self.host_tensors
+        for i, block in enumerate(self.blocks):
+            if i not in self.swapped:
+                block.to(self.device)
+                continue
+            if i in self.host_tensors:
+                self._release(i)
+                continue
+            tensors = []
+            for module in block.modules():
+                # GGUF layers keep their quantized weights in buffers.
+                named = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+                for name, tensor in named:
+                    host = tensor.data.to(self.offload_device)
+                    if self.use_streams and self.offload_device.type == "cpu":
+                        host = host.pin_memory()
+                    _assign(module, name, host)
+                    tensors.append((module, name, host))
+            self.host_tensors[i] = tensors
+        self.loaded.clear()
+        self.ready.clear()
+        if first_setup:
+            log.info(
+                f"Block swap: {self.resident} blocks resident on {self.device}, "
+                f"{len(self.swapped)} streamed ({self.swapped_bytes / 1024**3:.2f} GB)"
+            )
+
+    @property
+    def swapped_bytes(self) -> int:
+        return sum(
+            host.numel() * host.element_size()
+            for tensors in self.host_tensors.values()
+            for _, _, host in tensors
+        )
+
+    def _prefetch(self, index: int):
+        if index in self.loaded:
+            return
+        if not self.use_streams:
+            for module, name, host in self.host_tensors[index]:
+                _assign(module, name, host.to(self.device))
+            self.loaded.add(index)
+            return
+
+        # No need to wait for the compute stream: memory of released blocks is only
+        # reused once the kernels recorded in _wait are done with it.
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(self.copy_stream):
+            start.record()
+            for module, name, host in self.host_tensors[index]:
+                _assign(module, name, host.to(self.device, non_blocking=True))
+                self.bytes_transferred += host.numel() * host.element_size()
+            end.record()
+        self.timings.append(("transfer", start, end))
+        self.ready[index] = end
+        self.loaded.add(index)
+
+    def _wait(self, index: int):
+        event = self.ready.pop(index, None)
+        if event is None:
+            return
+        compute_stream = torch.cuda.current_stream(self.device)
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start.record(compute_stream)
+        compute_stream.wait_event(event)
+        end.record(compute_stream)
+        self.timings.append(("stall", start, end))
+        # The weights were allocated on copy_stream but are used on the compute stream.
+        for module, name, _ in self.host_tensors[index]:
+            getattr(module, name).data.record_stream(compute_stream)
+
+    def _release(self, index: int):
+        for module, name, host in self.host_tensors[index]:
+            _assign(module, name, host)
+        self.loaded.discard(index)
+
+    def next_swapped(self, index: int) -> int:
+        """Swapped block needed after `index`, wrapping around to the next forward."""
+        later = [i for i in self.swapped if i > index]
+        return later[0] if later else self.swapped[0]
+
+    def __iter__(self) -> Iterator[Tuple[int, nn.Module]]:
+        self._prefetch(self.swapped[0])
+        for i, block in enumerate(self.blocks):
+            if i not in self.host_tensors:
+                yield i, block
+                continue
+            self._wait(i)
+            upcoming = self.next_swapped(i)
+            self._prefetch(upcoming)
+            yield i, block
+            if upcoming != i:
+                self._release(i)
+
+    def offload(self):
+        """Move every block off the device, e.g. at the end of sampling."""
+        for i, block in enumerate(self.blocks):
+            if i in self.host_tensors:
+                self._release(i)
+            else:
+                block.to(self.offload_device)
+        self.ready.clear()
+
+    def report(self) -> Optional[str]:
+        """Summarize transfer time, compute stalls and their overlap since the last report."""
+        if not self.timings:
+            return None
+        torch.cuda.synchronize(self.device)
+        transfer = sum(s.elapsed_time(e) for kind, s, e in self.timings if kind == "transfer")
+        stall = sum(s.elapsed_time(e) for kind, s, e in self.timings if kind == "stall")
+        gbytes = self.bytes_transferred / 1024**3
+        overlap = 1.0 - min(stall / transfer, 1.0) if transfer > 0 else 1.0
+        self.timings.clear()
+        self.bytes_transferred = 0
+        return (
+            f"Block swap: {gbytes:.1f} GB transferred in {transfer / 1000:.2f}s "
+            f"({gbytes / max(transfer / 1000, 1e-9):.1f} GB/s), compute stalled {stall / 1000:.2f}s, "
+            f"{overlap:.0%} of the transfer time hidden behind compute"
+        )
@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+
+class PreparedConditioning:
+    """Step-invariant text conditioning for AsymmDiTJoint.
+
+    Built once per prompt by AsymmDiTJoint.prepare_conditioning. The projected and pooled
+    T5 features only depend on the prompt, so the same object serves every sampling step
+    and can be reused across seeds (packed_indices also depends on the latent size).
+    """
+
+    def __init__(
+        self,
+        *,
+        y_feat: torch.Tensor,
+        y_pool: torch.Tensor,
+        y_mask: torch.Tensor,
+        packed_indices: Optional[Dict[str, torch.Tensor]] = None,
+    ):
+        """
+        Args:
+            y_feat: (B, L, hidden_size_y) T5 features after t5_yproj.
+            y_pool: (B, hidden_size_x) attention pooled caption vector.
+            y_mask: (B, L) boolean tensor indicating which tokens are not padding.
+            packed_indices: Result of compute_packed_indices for this mask and latent size.
+        """
+        self.y_feat = y_feat
+        self.y_pool = y_pool
+        self.y_mask = y_mask
+        self.packed_indices = packed_indices
+
+    @property
+    def batch_size(self) -> int:
+        return self.y_feat.size(0)
+
+    def to(self, device: torch.device) -> "PreparedConditioning":
+        packed_indices = self.packed_indices
+        if packed_indices is not None:
+            packed_indices = {
+                k: v.to(device) if isinstance(v, torch.Tensor) else v
+                for k, v in packed_indices.items()
+            }
+        return PreparedConditioning(
+            y_feat=self.y_feat.to(device),
+            y_pool=self.y_pool.to(device),
+            y_mask=self.y_mask.to(device),
+            packed_indices=packed_indices,
+        )
+
+
+class ModulationTable:
+    """Modulation vectors of every block for a whole sigma schedule.
+
+    Built by AsymmDiTJoint.precompute_modulation, forward then indexes it by step
+    instead of running the mod_x / mod_y / final layer linears.
+    """
+
+    def __init__(
+        self,
+        *,
+        sigmas: List[float],
+        c: torch.Tensor,
+        blocks: List[Tuple[torch.Tensor, torch.Tensor]],
+        final: torch.Tensor,
+    ):
+        """
+        Args:
+            sigmas: Noise level of each step.
+            c: (S, B, hidden_size_x) conditioned features.
+            blocks: Per block (mod_x, mod_y), each (S, B, *).
+            final: (S, B, 2 * hidden_size_x) final layer modulation.
+        """
+        self.sigmas = sigmas
+        self.c = c
+        self.blocks = blocks
+        self.final = final
+
+    def __len__(self) -> int:
+        return len(self.sigmas)
+
+    def block(self, index: int, step: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        mod_x, mod_y = self.blocks[index]
+        return mod_x[step], mod_y[step]
+
+    @property
+    def nbytes(self) -> int:
+        tensors = [self.c, self.final] + [t for mods in self.blocks for t in mods]
+        return sum(t.numel() * t.element_size() for t in tensors)
@@ -101,6 +101,7 @@ class FeedForward(nn.Module):
             hidden_size = int(ffn_dim_multiplier * hidden_size)
         hidden_size = multiple_of * ((hidden_size + multiple_of - 1) // multiple_of)
 
+        self.in_features = in_features
         self.hidden_dim = hidden_size
         self.w1 = nn.Linear(in_features, 2 * hidden_size, bias=False, device=device)
         self.w2 = nn.Linear(hidden_size, in_features, bias=False, device=device)
@@ -110,6 +111,17 @@ class FeedForward(nn.Module):
         x = self.w2(F.silu(x) * gate)
         return x
 
+    def bytes_per_token(self, dtype: torch.dtype) -> int:
+        """Activation memory forward needs per token: w1 output, silu, gated product, input and output."""
+        element_size = torch.empty((), dtype=dtype).element_size()
+        return (4 * self.hidden_dim + 2 * self.in_features) * element_size
+
+    def chunk_size(self, num_tokens: int, dtype: torch.dtype, max_chunk_bytes: Optional[int]) -> int:
+        """Number of tokens per chunk so that a chunk's activations fit in max_chunk_bytes."""
+        if not max_chunk_bytes:
+            return num_tokens
+        return max(1, min(num_tokens, max_chunk_bytes // self.bytes_per_token(dtype)))
+
 
 class PatchEmbed(nn.Module):
     def __init__(
@@ -18,5 +18,40 @@ class ModulatedRMSNorm(torch.autograd.Function):
 
         return x_modulated.type_as(x)
 
+
+# Bytes of the fp32 temporaries of the fused norms, computed this many bytes of tokens at a time.
+CHUNK_BYTES = 32 * 1024**2
+
+
+def inv_rms(x, eps=1e-6):
+    """(..., 1) fp32 reciprocal RMS of the rows of x, without an fp32 copy of x."""
+    norm = torch.linalg.vector_norm(x, dim=-1, keepdim=True, dtype=torch.float32)
+    return torch.rsqrt(norm.square_().div_(x.size(-1)).add_(eps))
+
+
+def token_chunks(x, *tensors):
+    """Views of x and tensors split along the tokens (dim 1), an fp32 chunk of x takes at most CHUNK_BYTES."""
+    tokens = max(1, CHUNK_BYTES // (4 * x.size(0) * x.size(-1)))
+    return zip(*(t.split(tokens, dim=1) for t in (x, *tensors)))
+
+
 def modulated_rmsnorm(x, scale, eps=1e-6):
-    return ModulatedRMSNorm.apply(x, scale, eps)
+    """x / RMS(x) * (1 + scale), with scale broadcast over the tokens.
+
+    Args:
+        x: (B, N, D) tensor.
+        scale: (B, D) tensor.
+    """
+    if torch.compiler.is_compiling():
+        # Inductor fuses the fp32 formula into a single pass.
+        return ModulatedRMSNorm.forward(None, x, scale, eps)
+
+    # The products are computed in fp32 and rounded once to x.dtype. Without autograd only a
+    # chunk of tokens is in fp32 at a time.
+    factor = 1 + scale.float().unsqueeze(1)
+    if torch.is_grad_enabled():
+        return (x * inv_rms(x, eps) * factor).type_as(x)
+    out = torch.empty_like(x)
+    for x_chunk, out_chunk in token_chunks(x, out):
+        out_chunk.copy_((x_chunk * inv_rms(x_chunk, eps)).mul_(factor))
+    return out
@@ -1,5 +1,7 @@
 import torch
 
+from .mod_rmsnorm import inv_rms, token_chunks
+
 
 class ResidualTanhGatedRMSNorm(torch.autograd.Function):
     @staticmethod
@@ -24,4 +26,25 @@ class ResidualTanhGatedRMSNorm(torch.autograd.Function):
 
 
 def residual_tanh_gated_rmsnorm(x, x_res, gate, eps=1e-6):
-    return ResidualTanhGatedRMSNorm.apply(x, x_res, gate, eps)
+    """x + tanh(gate) * x_res / RMS(x_res).
+
+    Without autograd, x is updated in place.
+
+    Args:
+        x: (B, N, D) residual stream.
+        x_res: (B, N, D) branch output.
+        gate: (B, D) tensor.
+    """
+    if torch.compiler.is_compiling():
+        # Inductor fuses the fp32 formula into a single pass.
+        return ResidualTanhGatedRMSNorm.forward(None, x, x_res, gate, eps)
+
+    # x_res times its fp32 gain is accumulated into x in fp32 by addcmul and rounded once.
+    # Without autograd x is updated a chunk of tokens at a time, so only the gain of one
+    # chunk is in fp32.
+    tanh_gate = torch.tanh(gate.float()).unsqueeze(1)
+    if torch.is_grad_enabled():
+        return torch.addcmul(x, x_res, inv_rms(x_res, eps) * tanh_gate).type_as(x)
+    for x_chunk, res_chunk in token_chunks(x, x_res):
+        x_chunk.addcmul_(res_chunk, inv_rms(res_chunk, eps) * tanh_gate)
+    return x
@@ -1,3 +1,4 @@
+import collections
 import functools
 import math
 
@@ -86,3 +87,73 @@ def compute_mixed_rotation(
         freqs_cos = torch.cos(freqs_sum)
         freqs_sin = torch.sin(freqs_sum)
     return freqs_cos, freqs_sin
+
+
+def _tensor_version(t: torch.Tensor) -> int:
+    # Inference tensors don't track a version counter.
+    try:
+        return t._version
+    except RuntimeError:
+        return 0
+
+
+class RopeCache:
+    """LRU cache of RoPE rotation tables keyed by latent geometry.
+
+    The tables only depend on (T, pH, pW), the device, the heads computed locally
+    and pos_frequencies, so they are reused across sampling steps, CFG passes and runs.
+    """
+
+    def __init__(self, maxsize: int = 2):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(
+        self,
+        freqs: torch.Tensor,
+        *,
+        T: int,
+        pH: int,
+        pW: int,
+        device: torch.device,
+        head_start: int = 0,
+        num_heads: int = None,
+    ):
+        """
+        Args:
+            freqs: [3, num_heads, num_freqs] - pos_frequencies of the model
+            T, pH, pW: latent frames and patchified height/width
+            device: device to build the tables on
+            head_start, num_heads: slice of heads to compute, e.g. the local heads of a context parallel rank
+
+        Returns:
+            freqs_cos, freqs_sin: [T * pH * pW, num_heads, num_freqs]
+        """
+        if num_heads is None:
+            num_heads = freqs.size(1) - head_start
+        key = (
+            T, pH, pW, str(device), head_start, num_heads,
+            freqs.data_ptr(), _tensor_version(freqs),
+        )
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        pos = create_position_matrix(
+            T, pH=pH, pW=pW, device=device, dtype=torch.float32
+        )  # (N, 3)
+        entry = compute_mixed_rotation(
+            freqs=freqs.narrow(1, head_start, num_heads).to(device), pos=pos
+        )
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,83 @@
+from typing import Optional
+
+import torch
+
+
+class StepCache:
+    """Reuse the residual of the block stack across sampling steps (TeaCache style).
+
+    Adjacent steps feed the blocks almost the same modulated input, and then the blocks
+    add almost the same residual x_out - x_in. forward reports the modulated input of the
+    first block every step, on the evenly spaced tokens picked by `summarize`. While the
+    relative L1 change of those accumulated since the last full evaluation stays under
+    `threshold`, the stored residual is added instead of running the blocks.
+
+    One cache per stream of calls: cond, uncond and batched CFG each need their own.
+    """
+
+    def __init__(self, threshold: float, *, num_steps: Optional[int] = None, summary_tokens: int = 1024):
+        """
+        Args:
+            threshold: Accumulated relative L1 change of the block input that forces a full
+                evaluation. 0 evaluates every step, larger values skip more.
+            num_steps: Length of the schedule, the last step is always evaluated.
+            summary_tokens: Tokens the change is estimated on, the previous step's are kept
+                instead of the whole (B, N, D) input.
+        """
+        self.threshold = threshold
+        self.num_steps = num_steps
+        self.summary_tokens = summary_tokens
+        self.hits = 0
+        self.misses = 0
+        self.reset()
+
+    def reset(self):
+        self.previous_input = None
+        self.residual = None
+        self.accumulated = 0.0
+
+    def summarize(self, x: torch.Tensor) -> torch.Tensor:
+        """At most summary_tokens evenly spaced tokens of the (B, N, D) x, as a view."""
+        stride = -(-x.size(1) // self.summary_tokens)
+        return x[:, ::stride]
+
+    def should_compute(self, modulated_input: torch.Tensor, step: Optional[int] = None) -> bool:
+        """Decide whether the blocks have to run for this step.
+
+        Args:
+            modulated_input: Summarized input of the first block after its modulated norm.
+                It's kept until the next step, so it shouldn't be a view of a larger tensor.
+            step: Index in the schedule. The first and last steps are always computed.
+        """
+        previous = self.previous_input
+        self.previous_input = modulated_input
+        force = (
+            previous is None
+            or self.residual is None
+            or previous.shape != modulated_input.shape
+            or step is None
+            or step == 0
+            or (self.num_steps is not None and step == self.num_steps - 1)
+        )
+        if not force:
+            change = (modulated_input - previous).abs().mean() / previous.abs().mean()
+            self.accumulated += change.item()
+            if self.accumulated < self.threshold:
+                self.hits += 1
+                return False
+        self.accumulated = 0.0
+        self.misses += 1
+        return True
+
+    def store(self, x_in: torch.Tensor, x_out: torch.Tensor):
+        self.residual = x_out - x_in
+
+    def apply(self, x: torch.Tensor) -> torch.Tensor:
+        return x + self.residual
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        return (
+            f"StepCache(threshold={self.threshold}, skipped {self.hits}/{total} steps, "
+            f"computed {self.misses})"
+        )
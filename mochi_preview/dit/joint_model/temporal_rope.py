@@ -1,6 +1,8 @@
 # Based on Llama3 Implementation.
 import torch
 
+from .mod_rmsnorm import inv_rms
+
 
 def apply_rotary_emb_qk_real(
     xqk: torch.Tensor,
@@ -32,3 +34,49 @@ def apply_rotary_emb_qk_real(
     out = torch.stack([cos_part, sin_part], dim=-1).flatten(-2)
     assert out.dtype == torch.bfloat16
     return out
+
+
+def apply_qk_norm_rotary_emb_(
+    qk: torch.Tensor,
+    norm_weight: torch.Tensor,
+    freqs_cos: torch.Tensor,
+    freqs_sin: torch.Tensor,
+    *,
+    out: torch.Tensor,
+    eps: float = 1e-5,
+) -> torch.Tensor:
+    """RMSNorm followed by apply_rotary_emb_qk_real, for queries and keys at once.
+
+    Only one fp32 copy of qk and a half-size fp32 scratch buffer are allocated, and the
+    rotated values are rounded once, straight into `out`.
+
+    Args:
+        qk: (2, S, num_heads, D) queries and keys, any strides.
+        norm_weight: (2, D) RMSNorm weights of the queries and keys.
+        freqs_cos: (S, num_heads, D // 2)
+        freqs_sin: (S, num_heads, D // 2)
+        out: (2, S, num_heads, D) destination, e.g. a view of the packed qkv tensor.
+
+    Returns:
+        out
+    """
+    weight = norm_weight[:, None, None]  # (2, 1, 1, D)
+    if torch.compiler.is_compiling():
+        # Inductor fuses the plain formulation into a single kernel.
+        x = qk.float()
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + eps) * weight.float()
+        x_even, x_odd = x[..., 0::2], x[..., 1::2]
+        cos_part = x_even * freqs_cos - x_odd * freqs_sin
+        sin_part = x_even * freqs_sin + x_odd * freqs_cos
+        return out.copy_(torch.stack([cos_part, sin_part], dim=-1).flatten(-2))
+
+    normed = torch.empty(qk.shape, dtype=torch.float32, device=qk.device)
+    torch.mul(qk, inv_rms(qk, eps), out=normed).mul_(weight)
+    x_even, x_odd = normed[..., 0::2], normed[..., 1::2]
+
+    scratch = torch.empty_like(x_even)
+    torch.mul(x_even, freqs_cos, out=scratch).addcmul_(x_odd, freqs_sin, value=-1)
+    out[..., 0::2].copy_(scratch)
+    torch.mul(x_even, freqs_sin, out=scratch).addcmul_(x_odd, freqs_cos)
+    out[..., 1::2].copy_(scratch)
+    return out
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
@@ -97,6 +97,88 @@ class AttentionPool(nn.Module):
         return x
 
 
+# Text lengths the T5 stream is trimmed to, see trimmed_text_length.
+T5_LENGTH_BUCKETS = (32, 64, 128, 256)
+
+
+def trimmed_text_length(
+    text_mask: torch.Tensor,
+    buckets: Tuple[int, ...] = T5_LENGTH_BUCKETS,
+) -> int:
+    """Smallest bucket that keeps every valid text token.
+
+    Padding tokens are masked out of the attention pool and the joint attention,
+    so trimming them changes nothing but the work spent on them in the y stream.
+    Bucketing keeps the number of distinct shapes (and torch.compile recompiles) small.
+
+    Args:
+        text_mask: (B, L) boolean tensor indicating which text tokens are not padding.
+        buckets: Candidate lengths.
+
+    Returns:
+        length: int <= L, such that text_mask[:, length:] has no valid token.
+    """
+    L = text_mask.size(1)
+    valid = torch.nonzero(text_mask.any(dim=0), as_tuple=False)
+    needed = valid[-1].item() + 1 if valid.numel() else 1
+    for bucket in sorted(buckets):
+        if needed <= bucket <= L:
+            return bucket
+    return L
+
+
+def compute_packed_indices(
+    N: int,
+    text_mask: List[torch.Tensor],
+) -> Dict[str, torch.Tensor]:
+    """
+    Based on https://github.com/Dao-AILab/flash-attention/blob/765741c1eeb86c96ee71a3291ad6968cfbf4e4a1/flash_attn/bert_padding.py#L60-L80
+
+    Args:
+        N: Number of visual tokens.
+        text_mask: (B, L) List of boolean tensor indicating which text tokens are not padding.
+
+    Returns:
+        packed_indices: Dict with keys for Flash Attention:
+            - valid_token_indices_kv: up to (B * (N + L),) tensor of valid token indices (non-padding)
+                                   in the packed sequence.
+            - cu_seqlens_kv: (B + 1,) tensor of cumulative sequence lengths in the packed sequence.
+            - max_seqlen_in_batch_kv: int of the maximum sequence length in the batch.
+            - cu_seqlens_host: cu_seqlens_kv as a list of ints, to slice the packed sequence without syncing.
+            - text_lens_host: list of the number of valid text tokens of each sample.
+            - text_is_prefix: whether every sample's valid text tokens come before its padding.
+            - valid_text_indices: (total_text,) indices of the valid tokens in text_mask.flatten().
+    """
+    # Create an expanded token mask saying which tokens are valid across both visual and text tokens.
+    assert N > 0 and len(text_mask) == 1
+    text_mask = text_mask[0]
+
+    mask = F.pad(text_mask, (N, 0), value=True)  # (B, N + L)
+    seqlens_in_batch = mask.sum(dim=-1, dtype=torch.int32)  # (B,)
+    valid_token_indices = torch.nonzero(
+        mask.flatten(), as_tuple=False
+    ).flatten()  # up to (B * (N + L),)
+
+    assert valid_token_indices.size(0) >= text_mask.size(0) * N  # At least (B * N,)
+    cu_seqlens = F.pad(
+        torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.torch.int32), (1, 0)
+    )
+    max_seqlen_in_batch = seqlens_in_batch.max().item()
+
+    text_lens = text_mask.sum(dim=-1)  # (B,)
+    prefix = torch.arange(text_mask.size(1), device=text_mask.device) < text_lens[:, None]
+
+    return {
+        "cu_seqlens_kv": cu_seqlens,
+        "max_seqlen_in_batch_kv": max_seqlen_in_batch,
+        "valid_token_indices_kv": valid_token_indices,
+        "cu_seqlens_host": cu_seqlens.tolist(),
+        "text_lens_host": text_lens.tolist(),
+        "text_is_prefix": bool(torch.equal(prefix, text_mask.bool())),
+        "valid_text_indices": torch.nonzero(text_mask.flatten(), as_tuple=False).flatten(),
+    }
+
+
 class PadSplitXY(torch.autograd.Function):
     """
     Merge heads, pad and extract visual and text tokens,
@@ -187,3 +269,103 @@ class UnifyStreams(torch.autograd.Function):
 
 def unify_streams(q_x, k_x, v_x, q_y, k_y, v_y, indices) -> torch.Tensor:
     return UnifyStreams.apply(q_x, k_x, v_x, q_y, k_y, v_y, indices)
+
+
+def pack_qkv(
+    q_x: Optional[torch.Tensor],
+    k_x: Optional[torch.Tensor],
+    v_x: torch.Tensor,
+    q_y: torch.Tensor,
+    k_y: torch.Tensor,
+    v_y: torch.Tensor,
+    packed_indices: Dict[str, torch.Tensor],
+) -> torch.Tensor:
+    """Write visual and valid text tokens straight into the packed qkv tensor.
+
+    Same result as unify_streams, without the concatenated and stacked (B * (N + L), 3, D)
+    intermediates: each stream is copied once into its slice of the packed sequence.
+
+    Args:
+        q_x, k_x, v_x: (B, N, num_heads, head_dim). q_x and k_x can be None, their slices
+            are then left uninitialized for the caller to fill, see visual_qkv.
+        q_y, k_y, v_y: (B, L, num_heads, head_dim)
+        packed_indices: Result of compute_packed_indices.
+
+    Returns:
+        qkv: (total <= B * (N + L), 3, num_heads, head_dim)
+    """
+    B, N, num_heads, head_dim = v_x.size()
+    cu_seqlens = packed_indices["cu_seqlens_host"]
+    qkv = v_x.new_empty(cu_seqlens[-1], 3, num_heads, head_dim)
+
+    streams = ((q_x, q_y), (k_x, k_y), (v_x, v_y))
+    if not packed_indices["text_is_prefix"]:
+        valid_text = packed_indices["valid_text_indices"]
+        streams = tuple(
+            (t_x, t_y.flatten(0, 1).index_select(0, valid_text)) for t_x, t_y in streams
+        )
+
+    text_start = 0
+    for b in range(B):
+        start, end = cu_seqlens[b], cu_seqlens[b + 1]
+        text_len = end - start - N
+        for i, (t_x, t_y) in enumerate(streams):
+            if t_x is not None:
+                qkv[start:start + N, i] = t_x[b]
+            if packed_indices["text_is_prefix"]:
+                qkv[start + N:end, i] = t_y[b, :text_len]
+            else:
+                qkv[start + N:end, i] = t_y[text_start:text_start + text_len]
+        text_start += text_len
+    return qkv
+
+
+def visual_qkv(qkv: torch.Tensor, packed_indices: Dict[str, torch.Tensor], N: int) -> List[torch.Tensor]:
+    """Views of the visual tokens of each sample in the packed qkv tensor.
+
+    Returns:
+        B views of shape (3, N, num_heads, head_dim) into qkv.
+    """
+    cu_seqlens = packed_indices["cu_seqlens_host"]
+    return [qkv[start:start + N].transpose(0, 1) for start in cu_seqlens[:-1]]
+
+
+def split_xy(
+    xy: torch.Tensor,
+    packed_indices: Dict[str, torch.Tensor],
+    B: int,
+    N: int,
+    L: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Inverse of pack_qkv for the attention output, the counterpart of pad_and_split_xy.
+
+    Visual tokens are returned as a view of xy for a single sample, and so are
+    text tokens when there is no padding. Padding text tokens are zero.
+
+    Args:
+        xy: Packed tokens. Shape: (total <= B * (N + L), num_heads * head_dim).
+
+    Returns:
+        x: Visual tokens. Shape: (B, N, num_heads * head_dim).
+        y: Text tokens. Shape: (B, L, num_heads * head_dim).
+    """
+    cu_seqlens = packed_indices["cu_seqlens_host"]
+    text_lens = packed_indices["text_lens_host"]
+    D = xy.size(1)
+
+    if B == 1:
+        x = xy[:N].unsqueeze(0)
+    else:
+        x = torch.stack([xy[cu_seqlens[b]:cu_seqlens[b] + N] for b in range(B)])
+
+    if B == 1 and text_lens[0] == L:
+        return x, xy[N:].unsqueeze(0)
+
+    y = xy.new_zeros(B, L, D)
+    text = [xy[cu_seqlens[b] + N:cu_seqlens[b + 1]] for b in range(B)]
+    if packed_indices["text_is_prefix"]:
+        for b in range(B):
+            y[b, :text_lens[b]] = text[b]
+    else:
+        y.view(B * L, D)[packed_indices["valid_text_indices"]] = torch.cat(text)
+    return x, y
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import folder_paths
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file, save_file
+
+from .checkpoint_loader import read_safetensors_header
+
+log = logging.getLogger(__name__)
+
+# Elements hashed from the start and the end of every weight for the encoder identity.
+IDENTITY_SAMPLE = 256
+# Bytes of entries kept on disk, the least recently used files are deleted past it.
+DISK_CACHE_BYTES = 2 * 1024**3
+
+_identities: "weakref.WeakKeyDictionary[nn.Module, str]" = weakref.WeakKeyDictionary()
+
+
+def encoder_identity(model: nn.Module, patches: Optional[str] = None) -> str:
+    """Fingerprint of a text encoder's weights, from every tensor's name, shape, dtype and a sample of values.
+
+    Hashing all of T5-XXL's weights would take longer than encoding a prompt, the sample tells
+    different checkpoints and precisions apart. Memoized per module.
+
+    Args:
+        patches: Identifies patches applied on the fly, e.g. the LoRAs of a ComfyUI ModelPatcher.
+    """
+    if model not in _identities:
+        digest = hashlib.sha256()
+        for name, tensor in model.state_dict().items():
+            digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+            if tensor.device.type != "meta" and tensor.numel() > 0:
+                flat = tensor.detach().flatten()
+                sample = torch.cat([flat[:IDENTITY_SAMPLE], flat[-IDENTITY_SAMPLE:]]).cpu()
+                digest.update(sample.view(torch.uint8).numpy().tobytes())
+        _identities[model] = digest.hexdigest()
+    return _identities[model] if patches is None else f"{_identities[model]}:{patches}"
+
+
+def embedding_key(tokens, identity: str, strength: float) -> str:
+    """Content address of an encoding: the token ids and weights, the encoder and the strength."""
+    ids = [[(int(token[0]), float(token[1])) for token in batch] for batch in tokens]
+    payload = json.dumps({"tokens": ids, "encoder": identity, "strength": float(strength)})
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """T5 embeddings by content address, in memory in least recently used order and on disk.
+
+    An entry is the {"embeds", "attention_mask"} conditioning of one prompt. On disk it's a
+    safetensors file holding only the embeddings of the valid tokens, padded back to the full
+    length with zeros and a False mask when read: the DiT never attends to padding tokens.
+    Reads touch the file, so past max_disk_bytes the files with the oldest mtime go first.
+    """
+
+    def __init__(self, directory: Optional[str], max_entries: int = 64, max_disk_bytes: int = DISK_CACHE_BYTES):
+        """
+        Args:
+            directory: Where entries are written, None keeps them in memory only.
+            max_entries: Entries kept in memory.
+            max_disk_bytes: Bytes of entries kept in directory.
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.entries: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._disk_bytes: Optional[int] = None  # Scanned on the first write.
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.safetensors")
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        if key in self.entries:
+            self.memory_hits += 1
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+        elif self.directory is not None and os.path.exists(self.path(key)):
+            try:
+                entry = self._read(self.path(key))
+                os.utime(self.path(key))
+            except Exception as e:
+                log.warning(f"Ignoring unreadable T5 cache entry {self.path(key)}: {e}")
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, entry)
+        else:
+            self.misses += 1
+            return None
+        return {"embeds": entry["embeds"].clone(), "attention_mask": entry["attention_mask"].clone()}
+
+    def put(self, key: str, entry: Dict[str, torch.Tensor]):
+        entry = {"embeds": entry["embeds"].detach().cpu(), "attention_mask": entry["attention_mask"].cpu()}
+        self._remember(key, entry)
+        if self.directory is not None:
+            try:
+                self._write(self.path(key), entry)
+                self._evict(os.path.getsize(self.path(key)))
+            except OSError as e:
+                log.warning(f"Could not write T5 cache entry {self.path(key)}: {e}")
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".safetensors"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield stat.st_mtime_ns, stat.st_size, path
+
+    def _evict(self, written: int):
+        """Delete the least recently used files once the directory holds more than max_disk_bytes."""
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in self._files())
+        else:
+            self._disk_bytes += written
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        files = sorted(self._files())
+        self._disk_bytes = sum(size for _, size, _ in files)
+        freed = 0
+        for _, size, path in files[:-1]:  # The newest is the entry just written.
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            self._disk_bytes -= size
+            freed += size
+        log.info(f"T5 embedding cache: deleted {freed / 1024**2:.1f} MB of least recently used entries, "
+                 f"{self._disk_bytes / 1024**2:.1f} MB left in {self.directory}")
+
+    def _remember(self, key: str, entry: Dict[str, torch.Tensor]):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def _write(path: str, entry: Dict[str, torch.Tensor]):
+        embeds, mask = entry["embeds"], entry["attention_mask"]
+        # Valid tokens come first, the count of the longest row is enough to re-pad.
+        valid = int(mask.sum(dim=1).max())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        save_file(
+            {"embeds": embeds[:, :valid].contiguous(), "attention_mask": mask[:, :valid].contiguous()},
+            tmp,
+            metadata={"length": str(mask.shape[1])},
+        )
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path: str) -> Dict[str, torch.Tensor]:
+        _, metadata = read_safetensors_header(path)
+        length = int(metadata["length"])
+        tensors = load_file(path)
+        pad = length - tensors["embeds"].shape[1]
+        return {
+            "embeds": torch.nn.functional.pad(tensors["embeds"], (0, 0, 0, pad)),
+            "attention_mask": torch.nn.functional.pad(tensors["attention_mask"], (0, pad), value=False),
+        }
+
+    def __repr__(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        rate = (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        return (
+            f"T5 embedding cache: {rate:.0%} hit rate, {self.memory_hits} memory hits, {self.disk_hits} disk hits, "
+            f"{self.misses} misses, {len(self.entries)} entries in memory"
+        )
+
+
+# Shared by all text encode nodes of the process, kept in ComfyUI's user directory across restarts.
+T5_EMBEDDING_CACHE = EmbeddingCache(os.path.join(folder_paths.get_user_directory(), "mochi_t5_cache"))
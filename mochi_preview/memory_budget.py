@@ -0,0 +1,320 @@
+import gc
+import itertools
+import logging
+import os
+import weakref
+from typing import Callable, Dict, Iterable, List, Optional
+
+import comfy.model_management as mm
+import torch
+import torch.nn as nn
+
+log = logging.getLogger(__name__)
+
+# Device memory kept free on top of a stage's estimated needs, for allocator fragmentation.
+DEVICE_RESERVE_BYTES = 1 << 30
+# Offloaded weights are pinned, for fast transfers back, up to this fraction of the RAM.
+PINNED_BUDGET_FRACTION = 0.25
+# Models kept in host memory, past this fraction of the RAM the least recently used are evicted.
+HOST_BUDGET_FRACTION = 0.5
+
+
+def _gb(n: int) -> str:
+    return f"{n / 1024**3:.2f} GB"
+
+
+def _ram_bytes(fraction: float) -> Optional[int]:
+    if not hasattr(os, "sysconf"):
+        return None
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * fraction)
+
+
+def module_bytes(modules: Iterable[nn.Module]) -> Dict[str, int]:
+    """Bytes of the parameters and buffers of modules by device type, shared storage counted once."""
+    seen = set()
+    sizes: Dict[str, int] = {}
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            storage = tensor.untyped_storage()
+            key = (tensor.device, storage.data_ptr())
+            if tensor.device.type == "meta" or key in seen:
+                continue
+            seen.add(key)
+            sizes[tensor.device.type] = sizes.get(tensor.device.type, 0) + storage.nbytes()
+    return sizes
+
+
+def _named_tensors(module: nn.Module):
+    for submodule in module.modules():
+        for name, tensor in itertools.chain(submodule._parameters.items(), submodule._buffers.items()):
+            if tensor is not None:
+                yield submodule, name, tensor
+
+
+class Component:
+    """A model part the budget places, e.g. the DiT of a T2VSynthMochiModel.
+
+    Only a weak reference to the owner is kept, so registering doesn't keep models alive.
+    Components with an `evict` callback can be dropped from the host memory: the callback
+    releases the owner, e.g. ModelResidency forgets it and loads it from disk when asked again.
+    """
+
+    def __init__(
+        self,
+        owner,
+        name: str,
+        modules: Callable[[object], Iterable[nn.Module]],
+        load: Optional[Callable[[object, torch.device], None]],
+        offload: Optional[Callable[[object], None]],
+        footprint: Optional[Callable[[object], int]],
+        pin: bool = True,
+    ):
+        self.owner = weakref.ref(owner)
+        self.name = name
+        self._modules = modules
+        self._load = load
+        self._offload = offload
+        self._footprint = footprint
+        self.pin = pin
+        self.evict: Optional[Callable[[object], None]] = None
+        self.last_used = 0
+
+    def modules(self) -> List[nn.Module]:
+        owner = self.owner()
+        return [] if owner is None else list(self._modules(owner))
+
+    def device_bytes(self) -> int:
+        return sum(size for device_type, size in module_bytes(self.modules()).items() if device_type != "cpu")
+
+    def host_bytes(self) -> int:
+        return module_bytes(self.modules()).get("cpu", 0)
+
+    def footprint(self) -> int:
+        """Device bytes once loaded, block swap e.g. keeps most blocks on the host."""
+        owner = self.owner()
+        if owner is not None and self._footprint is not None:
+            return self._footprint(owner)
+        return sum(module_bytes(self.modules()).values())
+
+    def load(self, device: torch.device):
+        if self._load is not None:
+            self._load(self.owner(), device)
+        else:
+            for module in self.modules():
+                module.to(device)
+
+    def offload(self):
+        if self._offload is not None:
+            self._offload(self.owner())
+        for module in self.modules():
+            module.to("cpu")
+
+
+class MemoryBudget:
+    """Decides where the DiT, VAE and T5 live: on the device, in (pinned) host memory or only on disk.
+
+    prepare() moves the components a stage needs to the device. When the device doesn't have
+    their footprint and the stage's workspace free, the least recently used other components
+    are moved to the host first, pinned while the pinned budget allows, so nothing moves
+    unless the memory is needed. Past the host budget the least recently used evictable
+    components are dropped from the host, their loaders read them from disk again (see
+    residency.py). Every move is logged with its byte counts.
+    """
+
+    def __init__(
+        self,
+        reserve_bytes: int = DEVICE_RESERVE_BYTES,
+        pinned_budget: Optional[int] = None,
+        host_budget: Optional[int] = None,
+    ):
+        """
+        Args:
+            reserve_bytes: Device memory left free on top of each stage's needs.
+            pinned_budget: Bytes of pinned host memory for offloaded weights, by default a fraction of the RAM.
+            host_budget: Bytes of host memory for the models, by default a fraction of the RAM.
+        """
+        self.reserve_bytes = reserve_bytes
+        self.pinned_budget = pinned_budget if pinned_budget is not None else _ram_bytes(PINNED_BUDGET_FRACTION) or 0
+        self.host_budget = host_budget if host_budget is not None else _ram_bytes(HOST_BUDGET_FRACTION)
+        self.components: "weakref.WeakKeyDictionary[object, Component]" = weakref.WeakKeyDictionary()
+        self._clock = itertools.count(1)
+
+    def register(
+        self,
+        owner,
+        name: str,
+        *,
+        modules: Callable[[object], Iterable[nn.Module]] = lambda owner: [owner],
+        load: Optional[Callable[[object, torch.device], None]] = None,
+        offload: Optional[Callable[[object], None]] = None,
+        footprint: Optional[Callable[[object], int]] = None,
+        pin: bool = True,
+    ) -> Component:
+        """Track owner, called again it replaces the previous registration.
+
+        Args:
+            modules: The modules holding the component's tensors.
+            load: Moves the component to the device, by default all of its modules.
+            offload: Called before the modules are moved to the host, e.g. to drop device-side caches.
+            footprint: Device bytes of the loaded component, by default the bytes of its modules.
+            pin: Pin the host copy when offloading, off for weights the wrapper doesn't own.
+        """
+        component = Component(owner, name, modules, load, offload, footprint, pin)
+        component.last_used = next(self._clock)
+        self.components[owner] = component
+        return component
+
+    def touch(self, owner):
+        """Mark owner's component as just used, e.g. when a loader hands it out again."""
+        if owner in self.components:
+            self.components[owner].last_used = next(self._clock)
+
+    def prepare(self, stage: str, owners: Iterable, *, device: torch.device, workspace_bytes: int = 0):
+        """Move the components of owners to device, making room for them and workspace_bytes first."""
+        device = torch.device(device)
+        needed = []
+        for owner in owners:
+            if owner not in self.components:
+                self.register(owner, type(owner).__name__)
+            component = self.components[owner]
+            component.last_used = next(self._clock)
+            needed.append(component)
+
+        missing = sum(max(c.footprint() - c.device_bytes(), 0) for c in needed)
+        self._make_room(stage, device, missing + workspace_bytes + self.reserve_bytes, needed)
+        self._enforce_host_budget(stage, needed)
+
+        for component in needed:
+            before = component.device_bytes()
+            component.load(device)
+            moved = component.device_bytes() - before
+            if moved > 0:
+                log.info(f"{stage}: moved {component.name} to {device} ({_gb(moved)})")
+
+    def make_room(self, stage: str, *, device: torch.device, size_bytes: int, keep: Iterable = ()):
+        """Move other components off device until size_bytes are free, e.g. before loading a model there."""
+        keep = [self.components[owner] for owner in keep if owner in self.components]
+        self._make_room(stage, torch.device(device), size_bytes + self.reserve_bytes, keep)
+
+    def offload(self, owner, *, reason: str):
+        """Move owner's component to the host now, e.g. when a node is asked to free memory."""
+        if owner in self.components:
+            self._offload(self.components[owner], reason)
+            mm.soft_empty_cache()
+
+    def enforce_host_budget(self, stage: str, keep: Iterable = ()):
+        """Evict the least recently used components from the host until the models fit the host budget."""
+        self._enforce_host_budget(stage, [self.components[owner] for owner in keep if owner in self.components])
+
+    def evict(self, owner, *, reason: str):
+        """Drop owner's component from the host, if it's evictable."""
+        component = self.components.get(owner)
+        if component is not None and component.evict is not None:
+            self._evict(component, reason)
+
+    def _make_room(self, stage: str, device: torch.device, required: int, keep: List[Component]):
+        if device.type != "cuda":
+            return
+        free = mm.get_free_memory(device)
+        if required <= free:
+            return
+        others = sorted(
+            (c for c in self.components.values() if c not in keep and c.device_bytes() > 0),
+            key=lambda c: c.last_used,
+        )
+        for component in others:
+            if required <= free:
+                break
+            self._offload(component, f"{stage} needs {_gb(required)} with {_gb(free)} free")
+            mm.soft_empty_cache()
+            free = mm.get_free_memory(device)
+        if required > free:
+            log.warning(f"{stage}: needs {_gb(required)} of device memory, {_gb(free)} free after offloading "
+                        "everything else, consider block swap or tiling")
+
+    def _enforce_host_budget(self, stage: str, keep: List[Component]):
+        if self.host_budget is None:
+            return
+        used = sum(c.host_bytes() for c in self.components.values())
+        evictable = sorted(
+            (c for c in self.components.values() if c.evict is not None and c not in keep),
+            key=lambda c: c.last_used,
+        )
+        for component in evictable:
+            if used <= self.host_budget:
+                break
+            size = component.host_bytes()
+            if size:
+                self._evict(component, f"{stage}: {_gb(used)} of models in host memory, over the budget of "
+                                       f"{_gb(self.host_budget)}")
+                used -= size
+
+    def _offload(self, component: Component, reason: str):
+        freed = component.device_bytes()
+        component.offload()
+        pinned = component.pin and self._pin(component)
+        if freed:
+            placement = "pinned host memory" if pinned else "host memory"
+            log.info(f"Moved {component.name} to {placement}, freeing {_gb(freed)} of device memory: {reason}")
+
+    def _evict(self, component: Component, reason: str):
+        owner = component.owner()
+        if owner is None:
+            return
+        component.offload()
+        size = component.host_bytes()
+        del self.components[owner]
+        component.evict(owner)
+        # The callback released the last references the pipeline holds, free the weights now.
+        del owner
+        gc.collect()
+        mm.soft_empty_cache()
+        log.info(f"Evicted {component.name} from host memory ({_gb(size)}), "
+                 f"it's loaded from disk when needed again: {reason}")
+
+    def _pin(self, component: Component) -> bool:
+        """Pin the host tensors of component if they fit the pinned budget and the free RAM.
+
+        Tensors are pinned one at a time and each original is released as soon as its pinned
+        copy replaces it, so the host holds one extra tensor at most, not a second model.
+        """
+        if not torch.cuda.is_available():
+            return False
+        # Names and sizes only: references to the tensors would keep every original alive.
+        unpinned = [
+            (module, name, tensor.untyped_storage().nbytes())
+            for m in component.modules() for module, name, tensor in _named_tensors(m)
+            if tensor.device.type == "cpu" and not tensor.is_pinned()
+        ]
+        if not unpinned:
+            return True
+        size = sum(nbytes for _, _, nbytes in unpinned)
+        if self.pinned_bytes() + size > self.pinned_budget:
+            return False
+        largest = max(nbytes for _, _, nbytes in unpinned)
+        free = mm.get_free_memory(torch.device("cpu"))
+        if free < largest:
+            log.info(f"Not pinning {component.name}: {_gb(free)} of RAM free, copying its largest tensor takes {_gb(largest)}")
+            return False
+        for module, name, _ in unpinned:
+            if name in module._parameters:
+                module._parameters[name].data = module._parameters[name].data.pin_memory()
+            else:
+                module._buffers[name] = module._buffers[name].pin_memory()
+        return True
+
+    def pinned_bytes(self) -> int:
+        seen = set()
+        total = 0
+        for component in self.components.values():
+            for m in component.modules():
+                for _, _, tensor in _named_tensors(m):
+                    storage = tensor.untyped_storage()
+                    if tensor.device.type == "cpu" and tensor.is_pinned() and storage.data_ptr() not in seen:
+                        seen.add(storage.data_ptr())
+                        total += storage.nbytes()
+        return total
+
+
+# Shared by all pipelines of the process.
+MEMORY_BUDGET = MemoryBudget()
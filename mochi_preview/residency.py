@@ -0,0 +1,125 @@
+import gc
+import json
+import logging
+import os
+from typing import Callable, Dict, Hashable, Iterable, Optional
+
+import torch
+import torch.nn as nn
+
+from .checkpoint_loader import SHARD_INDEX, is_sharded_checkpoint
+from .memory_budget import MEMORY_BUDGET, MemoryBudget, module_bytes
+
+log = logging.getLogger(__name__)
+
+def checkpoint_identity(path: str) -> tuple:
+    """Path, size and mtime of a checkpoint, or of the index of a sharded one (see shard_dit.py)."""
+    if is_sharded_checkpoint(path):
+        path = os.path.join(path if os.path.isdir(path) else os.path.dirname(path), SHARD_INDEX)
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+
+def checkpoint_bytes(path: str) -> int:
+    """Size of a checkpoint on disk, all shards for a sharded one, as an estimate of its loaded size."""
+    if is_sharded_checkpoint(path):
+        directory = path if os.path.isdir(path) else os.path.dirname(path)
+        with open(os.path.join(directory, SHARD_INDEX)) as f:
+            shards = json.load(f)["shards"].values()
+        return sum(os.path.getsize(os.path.join(directory, shard)) for shard in shards)
+    return os.path.getsize(path)
+
+
+def freeze(value) -> Hashable:
+    """Hashable stand-in for node arguments such as the compile_args dict."""
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+class ModelResidency:
+    """Loaded models kept across node executions, by key.
+
+    A loader asks for its model by key, e.g. (checkpoint identity, precision, attention mode,
+    compile args), and gets the loaded one back when the key matches. Where the models live is
+    up to the memory budget alone: on a miss MEMORY_BUDGET moves the least recently used
+    components off the device to fit the new model, and past its host budget it evicts the
+    least recently used resident models, which this cache then forgets so they are loaded from
+    disk again. ComfyUI may still cache an evicted model as an output of an old node execution,
+    only the pipeline's references are dropped for sure.
+    """
+
+    def __init__(self, budget: MemoryBudget = MEMORY_BUDGET):
+        self.budget = budget
+        self.entries: Dict[Hashable, object] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(
+        self,
+        key: Hashable,
+        loader: Callable[[], object],
+        *,
+        name: str,
+        modules: Callable[[object], Iterable[nn.Module]] = lambda model: [model],
+        demote: Optional[Callable[[object], None]] = None,
+        device: Optional[torch.device] = None,
+        size_bytes: int = 0,
+        keep: Iterable = (),
+    ):
+        """The model for key, from the cache or from loader().
+
+        Args:
+            name: For the log.
+            modules: The modules holding the model's tensors, unless the loader registers the model with the budget itself.
+            demote: Called before the modules are moved to the host, e.g. to drop device-side caches.
+            device: The device the model is loaded to, to make room on.
+            size_bytes: Expected device footprint of the model, e.g. its checkpoint size, to make room for.
+            keep: Models never offloaded or evicted for this one, e.g. the DiT loaded by the same node.
+        """
+        keep = list(keep)
+        if key in self.entries:
+            self.hits += 1
+            model = self.entries[key]
+            self.budget.touch(model)
+            log.info(f"Reusing loaded {name} ({self})")
+            return model
+
+        self.misses += 1
+        if device is not None:
+            self.budget.make_room(f"Loading {name}", device=device, size_bytes=size_bytes, keep=keep)
+
+        model = loader()
+        if model not in self.budget.components:
+            self.budget.register(model, name, modules=modules, offload=demote)
+        self.budget.components[model].evict = lambda model, key=key: self.entries.pop(key, None)
+        self.entries[key] = model
+        self.budget.enforce_host_budget(f"Loading {name}", keep=[model, *keep])
+        log.info(f"Loaded {name} ({self})")
+        return model
+
+    def drop(self, key: Hashable, *, reason: str = "dropped"):
+        model = self.entries[key]
+        if model in self.budget.components:
+            self.budget.evict(model, reason=reason)
+        self.entries.pop(key, None)
+        del model
+        gc.collect()
+
+    def clear(self):
+        for key in list(self.entries):
+            self.drop(key, reason="cleared")
+
+    def __repr__(self):
+        sizes = [module_bytes(self.budget.components[model].modules()) for model in self.entries.values()
+                 if model in self.budget.components]
+        device = sum(size for s in sizes for device_type, size in s.items() if device_type != "cpu")
+        host = sum(s.get("cpu", 0) for s in sizes)
+        return (
+            f"{len(self.entries)} resident, {device / 1024**3:.2f} GB on device, {host / 1024**3:.2f} GB on host, "
+            f"{self.hits} hits, {self.misses} misses"
+        )
+
+
+# Shared by all loader nodes of the process.
+MODEL_RESIDENCY = ModelResidency()
@@ -33,6 +33,7 @@ except:
     pass
 
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data
 from einops import rearrange, repeat
@@ -42,22 +43,26 @@ from tqdm import tqdm
 from comfy.utils import ProgressBar, load_torch_file
 import comfy.model_management as mm 
 
-from contextlib import nullcontext
-try:
-    from accelerate import init_empty_weights
-    from accelerate.utils import set_module_tensor_to_device
-    is_accelerate_available = True
-except:
-    is_accelerate_available = False
-    pass
-
-from .dit.joint_model.asymm_models_joint import AsymmDiTJoint
+from .checkpoint_loader import MappedCheckpoint, open_checkpoint, stream_into_module
+from .memory_budget import MEMORY_BUDGET, module_bytes
+from .dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from .dit.joint_model.conditioning import PreparedConditioning
+from .dit.joint_model.step_cache import StepCache
+from .dit.joint_model.utils import compute_packed_indices, trimmed_text_length
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
 MAX_T5_TOKEN_LENGTH = 256
+# Rough peak of live activations in a block per visual token and batch element, in bf16:
+# qkv, the SwiGLU hidden state and a few copies of the residual stream.
+DIT_ACTIVATION_BYTES_PER_TOKEN = (3 * 3072 + 2 * 8192 + 4 * 3072) * 2
+
+def check_batch_size(conditioning: PreparedConditioning, expected: int, name: str):
+    if conditioning.batch_size != expected:
+        raise ValueError(f"{name} has a batch of {conditioning.batch_size}, expected {expected}")
+
 
 def unnormalize_latents(
     z: torch.Tensor,
@@ -81,46 +86,6 @@ def unnormalize_latents(
 
 
 
-def compute_packed_indices(
-    N: int,
-    text_mask: List[torch.Tensor],
-) -> Dict[str, torch.Tensor]:
-    """
-    Based on https://github.com/Dao-AILab/flash-attention/blob/765741c1eeb86c96ee71a3291ad6968cfbf4e4a1/flash_attn/bert_padding.py#L60-L80
-
-    Args:
-        N: Number of visual tokens.
-        text_mask: (B, L) List of boolean tensor indicating which text tokens are not padding.
-
-    Returns:
-        packed_indices: Dict with keys for Flash Attention:
-            - valid_token_indices_kv: up to (B * (N + L),) tensor of valid token indices (non-padding)
-                                   in the packed sequence.
-            - cu_seqlens_kv: (B + 1,) tensor of cumulative sequence lengths in the packed sequence.
-            - max_seqlen_in_batch_kv: int of the maximum sequence length in the batch.
-    """
-    # Create an expanded token mask saying which tokens are valid across both visual and text tokens.
-    assert N > 0 and len(text_mask) == 1
-    text_mask = text_mask[0]
-
-    mask = F.pad(text_mask, (N, 0), value=True)  # (B, N + L)
-    seqlens_in_batch = mask.sum(dim=-1, dtype=torch.int32)  # (B,)
-    valid_token_indices = torch.nonzero(
-        mask.flatten(), as_tuple=False
-    ).flatten()  # up to (B * (N + L),)
-
-    assert valid_token_indices.size(0) >= text_mask.size(0) * N  # At least (B * N,)
-    cu_seqlens = F.pad(
-        torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.torch.int32), (1, 0)
-    )
-    max_seqlen_in_batch = seqlens_in_batch.max().item()
-
-    return {
-        "cu_seqlens_kv": cu_seqlens,
-        "max_seqlen_in_batch_kv": max_seqlen_in_batch,
-        "valid_token_indices_kv": valid_token_indices,
-    }
-
 class T2VSynthMochiModel:
     def __init__(
         self,
@@ -133,65 +98,82 @@ class T2VSynthMochiModel:
         fp8_fastmode: bool = False,
         attention_mode: str = "sdpa",
         compile_args: Optional[Dict] = None,
+        blocks_to_swap: int = 0,
+        dequant_cache_bytes: int = 0,
+        dequant_tile_rows: int = 0,
     ):
+        """
+        Args:
+            blocks_to_swap: Number of transformer blocks streamed from pinned host memory
+                instead of staying on `device`, trades speed for VRAM. 0 keeps all blocks on the device.
+            dequant_cache_bytes: Memory for keeping dequantized weights of GGUF checkpoints
+                between calls instead of dequantizing them every step, 0 disables it.
+            dequant_tile_rows: GGUF layers the cache doesn't hold are dequantized and multiplied
+                this many output rows at a time, bounding their temporary memory. 0 dequantizes whole weights.
+        """
         super().__init__()
         self.device = device
         self.offload_device = offload_device
 
         logging.info("Initializing model...")
-        with (init_empty_weights() if is_accelerate_available else nullcontext()):
-            model = AsymmDiTJoint(
-                depth=48,
-                patch_size=2,
-                num_heads=24,
-                hidden_size_x=3072,
-                hidden_size_y=1536,
-                mlp_ratio_x=4.0,
-                mlp_ratio_y=4.0,
-                in_channels=12,
-                qk_norm=True,
-                qkv_bias=False,
-                out_bias=True,
-                patch_embed_bias=True,
-                timestep_mlp_bias=True,
-                timestep_scale=1000.0,
-                t5_feat_dim=4096,
-                t5_token_length=256,
-                rope_theta=10000.0,
-                attention_mode=attention_mode,
-            )
+        with torch.device("meta"):
+            model = AsymmDiTJoint(**MOCHI_PREVIEW_CONFIG, attention_mode=attention_mode)
 
         params_to_keep = {"t_embedder", "x_embedder", "pos_frequencies", "t5", "norm"}
+        # Streamed blocks, the last blocks_to_swap as in enable_block_swap, are loaded straight to the offload device.
+        depth = len(model.blocks)
+        swapped_prefixes = tuple(f"blocks.{i}." for i in range(depth - blocks_to_swap, depth)) if blocks_to_swap else ()
         logging.info(f"Loading model state_dict from {dit_checkpoint_path}...")
-        dit_sd = load_torch_file(dit_checkpoint_path)
-        if "gguf" in dit_checkpoint_path.lower():
+        # safetensors (single or sharded, see shard_dit.py) are memory-mapped and read tensor by tensor while loading.
+        dit_sd = open_checkpoint(dit_checkpoint_path, load_torch_file)
+        is_gguf = "gguf" in dit_checkpoint_path.lower() or any(key.endswith("_qweight") for key in dit_sd)
+        # Layers stored as scaled fp8 (quantize_dit.py) are loaded as they are.
+        from ..fp8_optimization import load_scaled_fp8_linears
+        scaled_fp8_params = set() if is_gguf else load_scaled_fp8_linears(model, dit_sd, torch.bfloat16)
+        # fp8_fastmode quantizes the block linears from the checkpoint's own precision, keep them
+        # as they are on the host until convert_fp8_linear moves them one layer at a time.
+        fp8_linear_params = set()
+        if fp8_fastmode:
+            for module_name, module in model.named_modules():
+                if isinstance(module, nn.Linear) and "blocks" in module_name:
+                    fp8_linear_params.update(f"{module_name}.{p}" for p, _ in module.named_parameters())
+        self.dequant_cache = None
+        if is_gguf:
             logging.info("Loading GGUF model state_dict...")
             from .. import mz_gguf_loader
             import importlib
             importlib.reload(mz_gguf_loader)
             with mz_gguf_loader.quantize_lazy_load():
-                model = mz_gguf_loader.quantize_load_state_dict(model, dit_sd, device="cpu")
-        elif is_accelerate_available:
-            logging.info("Using accelerate to load and assign model weights to device...")
-            for name, param in model.named_parameters():
-                if not any(keyword in name for keyword in params_to_keep):
-                    set_module_tensor_to_device(model, name, dtype=weight_dtype, device=self.device, value=dit_sd[name])
-                else:
-                    set_module_tensor_to_device(model, name, dtype=torch.bfloat16, device=self.device, value=dit_sd[name])
+                model = mz_gguf_loader.quantize_load_state_dict(model, dict(dit_sd), device="cpu")
+            self.dequant_cache = mz_gguf_loader.enable_dequant_cache(model, dequant_cache_bytes)
+            mz_gguf_loader.enable_tiled_dequant(model, dequant_tile_rows)
         else:
-            logging.info("Loading state_dict without accelerate...")
-            model.load_state_dict(dit_sd)
-            for name, param in model.named_parameters():
+            def placement(name):
+                load_device = self.offload_device if name.startswith(swapped_prefixes) else self.device
+                if name in scaled_fp8_params:
+                    return None, load_device
+                if name in fp8_linear_params:
+                    return None, self.offload_device
                 if not any(keyword in name for keyword in params_to_keep):
-                    param.data = param.data.to(weight_dtype)
-                else:
-                    param.data = param.data.to(torch.bfloat16)
-        
+                    return weight_dtype, load_device
+                return torch.bfloat16, load_device
+
+            logging.info(stream_into_module(model, dit_sd, placement))
+        if isinstance(dit_sd, MappedCheckpoint):
+            dit_sd.close()
+        del dit_sd
+
         if fp8_fastmode:
             from ..fp8_optimization import convert_fp8_linear
-            convert_fp8_linear(model, torch.bfloat16)
+            convert_fp8_linear(
+                model,
+                torch.bfloat16,
+                device=lambda name: self.offload_device if f"{name}.".startswith(swapped_prefixes) else self.device,
+            )
 
-        model = model.eval().to(self.device)
+        model = model.eval()
+        if not blocks_to_swap:
+            model = model.to(self.device)
 
         #torch.compile
         if compile_args is not None:
@@ -201,7 +183,16 @@ class T2VSynthMochiModel:
             if compile_args["compile_final_layer"]:
                 model.final_layer = torch.compile(model.final_layer, fullgraph=compile_args["fullgraph"], dynamic=False, backend=compile_args["backend"])        
 
+        model.enable_block_swap(blocks_to_swap, device=self.device, offload_device=self.offload_device)
         self.dit = model
+        MEMORY_BUDGET.register(
+            self,
+            "DiT",
+            modules=lambda t2v: [t2v.dit],
+            load=lambda t2v, device: t2v.load_dit(),
+            offload=lambda t2v: t2v.offload_dit(),
+            footprint=lambda t2v: t2v.device_footprint(),
+        )
         
         vae_stats = json.load(open(vae_stats_path))
         self.vae_mean = torch.Tensor(vae_stats["mean"]).to(self.device)
@@ -260,6 +251,104 @@ class T2VSynthMochiModel:
         self.move_to_device_(packed_indices)
         return packed_indices
 
+    def get_latent_dims(self, *, num_frames, height, width):
+        spatial_downsample = 8
+        temporal_downsample = 6
+        T = (num_frames - 1) // temporal_downsample + 1
+        H = height // spatial_downsample
+        W = width // spatial_downsample
+        return dict(lT=T, lW=W, lH=H)
+
+    def prepare_conditioning(
+        self, embeds, *, num_frames, height, width, text_length_buckets=None
+    ) -> PreparedConditioning:
+        """Project and pool T5 embeddings for the DiT once.
+
+        The result is valid for every sampling step and can be passed to `run` as
+        positive_conditioning / negative_conditioning to reuse it across seeds of the same size.
+
+        Args:
+            embeds: {"embeds": (B, L, 4096), "attention_mask": (B, L)} as returned by MochiTextEncode
+            text_length_buckets: If set, trim the padding of the text stream to the smallest
+                of these lengths that keeps every valid token.
+        """
+        latent_dims = self.get_latent_dims(num_frames=num_frames, height=height, width=width)
+        y_feat = embeds["embeds"].to(self.device)
+        y_mask = embeds["attention_mask"].to(self.device)
+        if text_length_buckets:
+            L = trimmed_text_length(y_mask, text_length_buckets)
+            y_feat, y_mask = y_feat[:, :L], y_mask[:, :L]
+        packed_indices = self.get_packed_indices([y_mask], **latent_dims)
+        self.prepare_dit("conditioning")
+        with torch.autocast(mm.get_autocast_device(self.device), dtype=torch.bfloat16):
+            return self.dit.prepare_conditioning(y_feat, y_mask, packed_indices)
+
+    def concat_embeds(self, *embeds):
+        """Stack the embeds of several prompts along the batch, padding them to a common length."""
+        L = max(e["embeds"].size(1) for e in embeds)
+        y_feat, y_mask = [], []
+        for e in embeds:
+            pad = L - e["embeds"].size(1)
+            y_feat.append(F.pad(e["embeds"].to(self.device), (0, 0, 0, pad)))
+            y_mask.append(F.pad(e["attention_mask"].to(self.device), (0, pad), value=False))
+        return {"embeds": torch.cat(y_feat), "attention_mask": torch.cat(y_mask)}
+
+    @staticmethod
+    def expand_embeds(embeds, batch_size: int):
+        """Repeat the embeds of a single prompt batch_size times, embeds of batch_size prompts are returned as is."""
+        B = embeds["embeds"].size(0)
+        if B == batch_size:
+            return embeds
+        if B != 1:
+            raise ValueError(f"Expected the negative conditioning to have 1 or {batch_size} prompts, got {B}")
+        return {key: torch.cat([value] * batch_size) for key, value in embeds.items()}
+
+    def prepare_dit(self, stage: str, workspace_bytes: int = 0):
+        """Move the DiT to the device through the memory budget, making room for it and workspace_bytes."""
+        MEMORY_BUDGET.prepare(stage, [self], device=self.device, workspace_bytes=workspace_bytes)
+
+    def device_footprint(self) -> int:
+        """Bytes of the loaded DiT on the device, with a full GGUF dequant cache."""
+        total = sum(module_bytes([self.dit]).values())
+        swapper = self.dit.block_swap
+        if swapper is not None:
+            # Streamed blocks stay on the host except for the two in flight.
+            swapped = [sum(module_bytes([self.dit.blocks[i]]).values()) for i in swapper.swapped]
+            total -= sum(swapped) - 2 * max(swapped)
+        if self.dequant_cache is not None:
+            total += self.dequant_cache.max_bytes
+        return total
+
+    def load_dit(self):
+        """Move the DiT to the device, except for the blocks streamed by block swap."""
+        swapper = self.dit.block_swap
+        if swapper is None:
+            self.dit.to(self.device)
+            return
+        for child in self.dit.children():
+            if child is not self.dit.blocks:
+                child.to(self.device)
+        for param in self.dit.parameters(recurse=False):
+            param.data = param.data.to(self.device)
+        swapper.setup()
+
+    def offload_dit(self):
+        if self.dequant_cache is not None:
+            self.dequant_cache.clear()
+        swapper = self.dit.block_swap
+        if swapper is None:
+            self.dit.to(self.offload_device)
+            return
+        report = swapper.report()
+        if report is not None:
+            logging.info(report)
+        swapper.offload()
+        for child in self.dit.children():
+            if child is not self.dit.blocks:
+                child.to(self.offload_device)
+        for param in self.dit.parameters(recurse=False):
+            param.data = param.data.to(self.offload_device)
+
     def move_to_device_(self, sample):
         if isinstance(sample, dict):
             for key in sample.keys():
@@ -298,16 +387,16 @@ class T2VSynthMochiModel:
         #     sample = self.get_conditioning([prompt], zero_last_n_prompts=0)
         #     sample_null = self.get_conditioning([neg_prompt] * B, zero_last_n_prompts=B if neg_prompt == "" else 0)
 
+        # One latent per positive prompt, e.g. the prompts of MochiTextEncodeBatch. A single
+        # negative prompt is shared by all of them.
+        B = args["positive_embeds"]["embeds"].size(0)
+        negative_embeds = self.expand_embeds(args["negative_embeds"], B)
+
         # create z
-        spatial_downsample = 8
-        temporal_downsample = 6
         in_channels = 12
-        B = 1
         C = in_channels
-        T = (num_frames - 1) // temporal_downsample + 1
-        H = height // spatial_downsample
-        W = width // spatial_downsample
-        latent_dims = dict(lT=T, lW=W, lH=H)
+        latent_dims = self.get_latent_dims(num_frames=num_frames, height=height, width=width)
+        T, H, W = latent_dims["lT"], latent_dims["lH"], latent_dims["lW"]
         
         z = torch.randn(
             (B, C, T, H, W),
@@ -316,57 +405,85 @@ class T2VSynthMochiModel:
             dtype=torch.float32,
         )
 
-        if batch_cfg: #WIP
-            pos_embeds = args["positive_embeds"]["embeds"].to(self.device)
-            neg_embeds = args["negative_embeds"]["embeds"].to(self.device)
-            pos_attention_mask = args["positive_embeds"]["attention_mask"].to(self.device)
-            neg_attention_mask = args["negative_embeds"]["attention_mask"].to(self.device)
-            print(neg_embeds.shape)
-            y_feat = torch.cat((pos_embeds, neg_embeds))
-            y_mask = torch.cat((pos_attention_mask, neg_attention_mask))
-            zero_last_n_prompts = B# if neg_prompt == "" else 0
-            y_feat[-zero_last_n_prompts:] = 0
-            y_mask[-zero_last_n_prompts:] = False
-   
-            sample_batched = {
-                "y_mask": [y_mask],
-                "y_feat": [y_feat]
-            }
-            sample_batched["packed_indices"] = self.get_packed_indices(
-                sample_batched["y_mask"], **latent_dims
+        # CFG only within the sigma interval, and only where it changes the prediction.
+        # Elsewhere pred is the conditional output and the uncond forward is skipped.
+        cfg_sigma_min, cfg_sigma_max = args["mochi_args"].get("cfg_interval") or (0.0, 1.0)
+        guided = [
+            cfg_schedule[i] != 1.0 and cfg_sigma_min <= sigma_schedule[i] <= cfg_sigma_max
+            for i in range(sample_steps)
+        ]
+        if not all(guided):
+            logging.info(
+                f"CFG applied on {sum(guided)}/{sample_steps} steps, "
+                f"{sample_steps - sum(guided)} uncond DiT evaluations saved"
             )
-            z = repeat(z, "b ... -> (repeat b) ...", repeat=2)
-            print("sample_batched y_mask",sample_batched["y_mask"])
-            print("y_mask type",type(sample_batched["y_mask"])) #<class 'list'>"
-            print("ymask 0 shape",sample_batched["y_mask"][0].shape)#torch.Size([2, 256])
-        else:
-            sample = {
-            "y_mask": [args["positive_embeds"]["attention_mask"].to(self.device)],
-            "y_feat": [args["positive_embeds"]["embeds"].to(self.device)]
-            }
-            sample_null = {
-                "y_mask": [args["negative_embeds"]["attention_mask"].to(self.device)],
-                "y_feat": [args["negative_embeds"]["embeds"].to(self.device)]
-            }
-
-            sample["packed_indices"] = self.get_packed_indices(
-                sample["y_mask"], **latent_dims
+
+        size = dict(
+            num_frames=num_frames,
+            height=height,
+            width=width,
+            text_length_buckets=args["mochi_args"].get("text_length_buckets"),
+        )
+        cond = cond_null = cond_batched = None
+        if batch_cfg and any(guided):
+            # Cond and uncond run as one B=2 forward, their text lengths are
+            # kept apart by the varlen packing (cu_seqlens).
+            cond_batched = args.get("batched_conditioning") or self.prepare_conditioning(
+                self.concat_embeds(args["positive_embeds"], negative_embeds), **size
+            )
+            check_batch_size(cond_batched, 2 * B, "batched_conditioning")
+        if not batch_cfg or not all(guided):
+            cond = args.get("positive_conditioning") or self.prepare_conditioning(
+                args["positive_embeds"], **size
             )
-            sample_null["packed_indices"] = self.get_packed_indices(
-                sample_null["y_mask"], **latent_dims
+            check_batch_size(cond, B, "positive_conditioning")
+        if not batch_cfg and any(guided):
+            cond_null = args.get("negative_conditioning") or self.prepare_conditioning(negative_embeds, **size)
+            check_batch_size(cond_null, B, "negative_conditioning")
+
+        batch = 2 * B if batch_cfg and any(guided) else B
+        self.prepare_dit("sampling", workspace_bytes=batch * (T * H * W // 4) * DIT_ACTIVATION_BYTES_PER_TOKEN)
+        self.dit.set_mlp_chunk_bytes(args["mochi_args"].get("mlp_chunk_bytes"))
+        mod = mod_null = mod_batched = None
+        if args["mochi_args"].get("precompute_modulation", True):
+            with torch.autocast(mm.get_autocast_device(self.device), dtype=torch.bfloat16):
+                mod, mod_null, mod_batched = (
+                    self.dit.precompute_modulation(sigma_schedule[:-1], c) if c is not None else None
+                    for c in (cond, cond_null, cond_batched)
+                )
+            mod_bytes = sum(m.nbytes for m in (mod, mod_null, mod_batched) if m is not None)
+            logging.info(f"Precomputed modulation for {sample_steps} steps ({mod_bytes / 1024**2:.1f} MB)")
+
+        # One step cache per kind of DiT call, their block inputs aren't comparable.
+        step_cache_threshold = args["mochi_args"].get("step_cache_threshold", 0.0)
+        cache = cache_null = cache_batched = None
+        if step_cache_threshold > 0:
+            cache, cache_null, cache_batched = (
+                StepCache(step_cache_threshold, num_steps=sample_steps) for _ in range(3)
             )
 
-        def model_fn(*, z, sigma, cfg_scale):
-            self.dit.to(self.device)
+        def model_fn(*, z, sigma, cfg_scale, step):
+            if not guided[step]:
+                with torch.autocast(mm.get_autocast_device(self.device), dtype=torch.bfloat16):
+                    out_cond = self.dit(z, sigma, conditioning=cond, modulation=mod, step=step, step_cache=cache)
+                return out_cond, out_cond
             if batch_cfg:
                 with torch.autocast(mm.get_autocast_device(self.device), dtype=torch.bfloat16):
-                    out = self.dit(z, sigma, **sample_batched)
+                    out = self.dit(
+                        repeat(z, "b ... -> (repeat b) ...", repeat=2),
+                        repeat(sigma, "b -> (repeat b)", repeat=2),
+                        conditioning=cond_batched,
+                        modulation=mod_batched,
+                        step=step,
+                        step_cache=cache_batched,
+                    )
                 out_cond, out_uncond = torch.chunk(out, chunks=2, dim=0)
             else:
-                nonlocal sample, sample_null
                 with torch.autocast(mm.get_autocast_device(self.device), dtype=torch.bfloat16):
-                    out_cond = self.dit(z, sigma, **sample)
-                    out_uncond = self.dit(z, sigma, **sample_null)
+                    out_cond = self.dit(z, sigma, conditioning=cond, modulation=mod, step=step, step_cache=cache)
+                    out_uncond = self.dit(
+                        z, sigma, conditioning=cond_null, modulation=mod_null, step=step, step_cache=cache_null
+                    )
 
             assert out_cond.shape == out_uncond.shape
             return out_uncond + cfg_scale * (out_cond - out_uncond), out_cond
@@ -379,10 +496,9 @@ class T2VSynthMochiModel:
             # `pred` estimates `z_0 - eps`.
             pred, output_cond = model_fn(
                 z=z,
-                sigma=torch.full(
-                    [B] if not batch_cfg else [B * 2], sigma, device=z.device
-                ),
+                sigma=torch.full([B], sigma, device=z.device),
                 cfg_scale=cfg_schedule[i],
+                step=i,
             )
             pred = pred.to(z)
             output_cond = output_cond.to(z)
@@ -390,11 +506,19 @@ class T2VSynthMochiModel:
             z = z + dsigma * pred
             comfy_pbar.update(1)
 
+        for name, step_cache in (("cond", cache), ("uncond", cache_null), ("batched", cache_batched)):
+            if step_cache is not None and step_cache.hits + step_cache.misses > 0:
+                logging.info(f"{name} {step_cache}")
+        if self.dequant_cache is not None:
+            logging.info(self.dequant_cache)
+
         cp_rank, cp_size = get_cp_rank_size()
-        if batch_cfg:
-            z = z[:B]
         z = z.tensor_split(cp_size, dim=2)[cp_rank]  # split along temporal dim
-        self.dit.to(self.offload_device)
+        # The DiT stays on the device until another stage needs the memory, see memory_budget.py.
+        swapper = self.dit.block_swap
+        report = swapper.report() if swapper is not None else None
+        if report is not None:
+            logging.info(report)
     
         samples = unnormalize_latents(z.float(), self.vae_mean, self.vae_std)
         logging.info(f"samples shape: {samples.shape}")
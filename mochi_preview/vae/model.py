@@ -663,6 +663,18 @@ class Decoder(nn.Module):
         return self.output_proj(x).contiguous()
 
 
+# Rough peak of live activations per output pixel of a decode in bf16: a few tensors with
+# the 128 channels of the last, full resolution stage.
+DECODE_BYTES_PER_PIXEL = 128 * 2 * 4
+
+
+def decode_workspace_bytes(latent_shape, num_tiles_h: int = 1, num_tiles_w: int = 1) -> int:
+    """Rough device memory one Decoder call takes on latents of shape [B, C, t, h, w], split into tiles."""
+    B, _, t, h, w = latent_shape
+    frames = (t - 1) * 6 + 1
+    return B * frames * (h * 8 // num_tiles_h) * (w * 8 // num_tiles_w) * DECODE_BYTES_PER_PIXEL
+
+
 def make_broadcastable(
     tensor: torch.Tensor,
     axis: int,
@@ -1,9 +1,15 @@
 # https://github.com/MinusZoneAI/ComfyUI-CogVideoX-MZ/blob/9616415220fd09388622f40f6609e4ed81f048a5/mz_gguf_loader.py
 
+import logging
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
 import torch
 import torch.nn as nn
 import gc
 
+log = logging.getLogger(__name__)
+
 
 class quantize_lazy_load():
     def __init__(self):
@@ -19,24 +25,27 @@ class quantize_lazy_load():
 
 
 def quantize_load_state_dict(model, state_dict, device="cpu"):
-    quant_keys = []
+    # Each quantized module has one "<name>.<qtype>_qweight" tensor, checkpoints may mix qtypes.
+    qtypes = {}
     for key in state_dict.keys():
-        if key.endswith(".Q4_0_qweight"):
-            quant_keys.append(key.replace(".Q4_0_qweight", ""))
-            qtype = "Q4_0"
-        elif key.endswith(".Q8_0_qweight"):
-            quant_keys.append(key.replace(".Q8_0_qweight", ""))
-            qtype = "Q8_0"
+        if not key.endswith("_qweight"):
+            continue
+        name, _, attr = key.rpartition(".")
+        qtype = attr[:-len("_qweight")]
+        if qtype not in GGML_QUANT_SIZES:
+            raise ValueError(f"Unsupported GGUF qtype {qtype} for {name}")
+        qtypes[name] = qtype
 
     for name, module in model.named_modules():
-        if name in quant_keys:
-            #print(name)
+        if name in qtypes:
             q_linear = WQLinear_GGUF.from_linear(
                 linear=module,
                 device=device,
-                qtype=qtype,
+                qtype=qtypes[name],
             )
             set_op_by_name(model, name, q_linear)
+    counts = {qtype: list(qtypes.values()).count(qtype) for qtype in sorted(set(qtypes.values()))}
+    log.info(f"GGUF layers by qtype: {counts}")
 
     model.to_empty(device=device)
     model.load_state_dict(state_dict, strict=False)
@@ -61,7 +70,97 @@ def set_op_by_name(layer, name, new_module):
 import torch.nn.functional as F
 
 
+class DequantCache:
+    """Dequantized GGUF weights kept between calls, within a byte budget.
+
+    Two policies:
+        "pin": layers are cached in the order they are first used until the budget is
+            full and then stay. Sampling runs the layers in the same order every step,
+            and under that pattern LRU always evicts the layer that is needed next. Pinning
+            turns the budget into a steady hit rate of budget / total.
+        "lru": evict the least recently used layer, for when the hot set fits the budget.
+    """
+
+    def __init__(self, max_bytes: int, *, policy: str = "pin"):
+        assert policy in ("pin", "lru"), f"Unknown dequant cache policy: {policy}"
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, dequantize: Callable[[], torch.Tensor]) -> torch.Tensor:
+        weight = self.entries.get(key)
+        if weight is not None:
+            self.hits += 1
+            if self.policy == "lru":
+                self.entries.move_to_end(key)
+            return weight
+
+        self.misses += 1
+        weight = dequantize()
+        size = weight.numel() * weight.element_size()
+        if size > self.max_bytes:
+            return weight
+        if self.policy == "lru":
+            while self.bytes + size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+        elif self.bytes + size > self.max_bytes:
+            return weight
+        self.entries[key] = weight
+        self.bytes += size
+        return weight
+
+    def admits(self, key: Hashable, size: int) -> bool:
+        """Whether get would keep (or already holds) a weight of size bytes under key."""
+        if key in self.entries:
+            return True
+        if self.policy == "lru":
+            return size <= self.max_bytes
+        return self.bytes + size <= self.max_bytes
+
+    def clear(self):
+        """Drop the cached weights, the counters are kept."""
+        self.entries.clear()
+        self.bytes = 0
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        return (
+            f"DequantCache(policy={self.policy}, {len(self.entries)} layers, "
+            f"{self.bytes / 1024**2:.0f}/{self.max_bytes / 1024**2:.0f} MB, "
+            f"hits {self.hits}/{total}, evictions {self.evictions})"
+        )
+
+
+def enable_dequant_cache(model: nn.Module, max_bytes: int, *, policy: str = "pin") -> Optional[DequantCache]:
+    """Share one DequantCache between all GGUF linears of model, None if there are none or max_bytes is 0."""
+    layers = [module for module in model.modules() if isinstance(module, WQLinear_GGUF)]
+    if not layers or max_bytes <= 0:
+        return None
+    cache = DequantCache(max_bytes, policy=policy)
+    for layer in layers:
+        layer.dequant_cache = cache
+    log.info(f"GGUF dequant cache: {max_bytes / 1024**2:.0f} MB for {len(layers)} layers, policy {policy}")
+    return cache
+
+
+def enable_tiled_dequant(model: nn.Module, tile_rows: int):
+    """Make the GGUF linears of model dequantize and multiply tile_rows output rows at a time, 0 turns it off."""
+    for module in model.modules():
+        if isinstance(module, WQLinear_GGUF):
+            module.tile_rows = tile_rows or None
+
+
 class WQLinear_GGUF(nn.Module):
+    dequant_cache: Optional[DequantCache] = None
+    # Output rows dequantized at a time, None dequantizes the whole weight at once.
+    tile_rows: Optional[int] = None
+
     def __init__(
         self, in_features, out_features, bias, dev, qtype="Q4_0"
     ):
@@ -111,28 +210,40 @@ class WQLinear_GGUF(nn.Module):
 
     def extra_repr(self) -> str:
         return (
-            "in_features={}, out_features={}, bias={}, w_bit={}, group_size={}".format(
+            "in_features={}, out_features={}, bias={}, qtype={}".format(
                 self.in_features,
                 self.out_features,
                 self.bias is not None,
-                self.w_bit,
-                self.group_size,
+                self.qtype,
             )
         )
 
+    def dequantize(self, dtype, rows=slice(None)):
+        return dequantize_blocks(getattr(self, f"{self.qtype}_qweight")[rows], self.qtype, dtype)
+
     @torch.no_grad()
     def forward(self, x):
-        # x = torch.matmul(x, dequantize_blocks_Q4_0(self.qweight))
-        if self.qtype == "Q4_0":
-            x = F.linear(x, dequantize_blocks_Q4_0(
-                self.Q4_0_qweight, x.dtype), self.bias.to(x.dtype) if self.bias is not None else None)
-        elif self.qtype == "Q8_0":
-            x = F.linear(x, dequantize_blocks_Q8_0(
-                self.Q8_0_qweight, x.dtype), self.bias.to(x.dtype) if self.bias is not None else None)
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        cache = self.dequant_cache
+        key = (id(self), x.dtype, x.device)
+        weight_bytes = self.in_features * self.out_features * x.element_size()
+        if cache is not None and (self.tile_rows is None or cache.admits(key, weight_bytes)):
+            weight = cache.get(key, lambda: self.dequantize(x.dtype))
+        elif self.tile_rows is not None and self.tile_rows < self.out_features:
+            if cache is not None:
+                cache.misses += 1
+            return self.forward_tiled(x, bias)
         else:
-            raise ValueError(f"Unknown qtype: {self.qtype}")
+            weight = self.dequantize(x.dtype)
+        return F.linear(x, weight, bias)
 
-        return x
+    def forward_tiled(self, x, bias):
+        """Dequantize and multiply tile_rows output rows at a time, the full weight never exists."""
+        out = x.new_empty(*x.shape[:-1], self.out_features)
+        for start in range(0, self.out_features, self.tile_rows):
+            rows = slice(start, min(start + self.tile_rows, self.out_features))
+            out[..., rows] = F.linear(x, self.dequantize(x.dtype, rows), bias[rows] if bias is not None else None)
+        return out
 
 
 def split_block_dims(blocks, *args):
@@ -159,63 +270,222 @@ def quant_shape_from_byte_shape(shape, qtype) -> tuple[int, ...]:
     return (*shape[:-1], shape[-1] // type_size * block_size)
 
 
+# qtype: (values per block, bytes per block), as in ggml.
 GGML_QUANT_SIZES = {
     "Q4_0": (32, 2 + 16),
+    "Q4_1": (32, 2 + 2 + 16),
+    "Q5_0": (32, 2 + 4 + 16),
+    "Q5_1": (32, 2 + 2 + 4 + 16),
     "Q8_0": (32, 2 + 32),
+    "Q4_K": (256, 2 + 2 + 12 + 128),
+    "Q5_K": (256, 2 + 2 + 12 + 32 + 128),
+    "Q6_K": (256, 128 + 64 + 16 + 2),
 }
-def dequantize_blocks_Q4_0(data, dtype=torch.float16):
-    block_size, type_size = GGML_QUANT_SIZES["Q4_0"]
+# Values dequantized at a time, bounds the temporaries to a few MB whatever the weight size.
+DEQUANT_CHUNK_VALUES = 1 << 21
+
+
+def _dequantize_chunked(data, qtype, dtype, dequantize_chunk):
+    block_size, type_size = GGML_QUANT_SIZES[qtype]
+    blocks = data.to(torch.uint8).reshape(-1, type_size)
+    out = torch.empty((blocks.shape[0], block_size), dtype=dtype, device=data.device)
+    chunk_blocks = DEQUANT_CHUNK_VALUES // block_size
+    for start in range(0, blocks.shape[0], chunk_blocks):
+        chunk = slice(start, start + chunk_blocks)
+        out[chunk] = dequantize_chunk(blocks[chunk]).reshape(-1, block_size)
+    return out.reshape(quant_shape_from_byte_shape(data.shape, qtype=qtype))
+
+
+def _f16(blocks, start):
+    return blocks[:, start:start + 2].view(torch.float16).float()
+
+
+def _nibbles(qs, groups):
+    """(n, groups * 2, qs.shape[1] // groups) values: the low nibbles of each group of bytes, then the high ones."""
+    qs = qs.reshape(qs.shape[0], groups, 1, -1)
+    return torch.cat([qs & 0x0F, qs >> 4], dim=2).reshape(qs.shape[0], 2 * groups, -1)
+
+
+def _bits(qh, shifts, mask):
+    """(n, len(shifts), qh.shape[1]) fields of each byte of qh, starting at the given bit shifts."""
+    shifts = torch.tensor(shifts, dtype=torch.uint8, device=qh.device).reshape(1, -1, 1)
+    return (qh.unsqueeze(1) >> shifts) & mask
+
+
+def _high_bits_32(qh):
+    """Bit i of the 32-bit little-endian qh of each block, as (n, 32)."""
+    return _bits(qh, range(8), 1).transpose(1, 2).reshape(qh.shape[0], 32)
+
+
+def _scale_min_K(scales):
+    """The 8 6-bit scales and mins packed in the 12 scale bytes of Q4_K and Q5_K blocks."""
+    d, m, m_d = scales.reshape(-1, 3, 4).unbind(1)
+    sc = torch.cat([d & 0x3F, (m_d & 0x0F) | ((d >> 2) & 0x30)], dim=1)
+    mn = torch.cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)], dim=1)
+    return sc.float(), mn.float()
+
+
+def _dequantize_chunk_Q4_0(blocks):
+    d, qs = blocks[:, :2].view(torch.float16), blocks[:, 2:]
+    q = _nibbles(qs, 1).reshape(blocks.shape[0], -1).view(torch.int8).sub_(8)
+    # Multiplied in float16 like ggml.
+    return d * q
+
+
+def _dequantize_chunk_Q4_1(blocks):
+    d, m = _f16(blocks, 0), _f16(blocks, 2)
+    return torch.addcmul(m, d, _nibbles(blocks[:, 4:], 1).reshape(blocks.shape[0], -1))
+
 
-    data = data.to(torch.uint8)
-    shape = data.shape
+def _dequantize_chunk_Q5_0(blocks):
+    d, qh, qs = _f16(blocks, 0), blocks[:, 2:6], blocks[:, 6:]
+    q = (_nibbles(qs, 1).reshape(blocks.shape[0], -1) | (_high_bits_32(qh) << 4)).view(torch.int8).sub_(16)
+    return d * q
 
-    rows = data.reshape(
-        (-1, data.shape[-1])
-    ).view(torch.uint8)
 
-    n_blocks = rows.numel() // type_size
-    blocks = data.reshape((n_blocks, type_size))
+def _dequantize_chunk_Q5_1(blocks):
+    d, m, qh, qs = _f16(blocks, 0), _f16(blocks, 2), blocks[:, 4:8], blocks[:, 8:]
+    q = _nibbles(qs, 1).reshape(blocks.shape[0], -1) | (_high_bits_32(qh) << 4)
+    return torch.addcmul(m, d, q)
 
+
+def _dequantize_chunk_Q8_0(blocks):
+    d, qs = blocks[:, :2].view(torch.float16), blocks[:, 2:].view(torch.int8)
+    return d.float() * qs
+
+
+def _dequantize_chunk_Q4_K(blocks):
+    d, dmin, scales, qs = _f16(blocks, 0), _f16(blocks, 2), blocks[:, 4:16], blocks[:, 16:]
+    sc, mn = _scale_min_K(scales)
+    # 8 sub-blocks of 32: low then high nibbles of each 32 bytes.
+    q = _nibbles(qs, 4)
+    return (d * sc).unsqueeze(-1) * q - (dmin * mn).unsqueeze(-1)
+
+
+def _dequantize_chunk_Q5_K(blocks):
+    d, dmin, scales = _f16(blocks, 0), _f16(blocks, 2), blocks[:, 4:16]
+    qh, qs = blocks[:, 16:48], blocks[:, 48:]
+    sc, mn = _scale_min_K(scales)
+    # Sub-block j takes its fifth bit from bit j of qh.
+    q = _nibbles(qs, 4) | (_bits(qh, range(8), 1) << 4)
+    return (d * sc).unsqueeze(-1) * q - (dmin * mn).unsqueeze(-1)
+
+
+def _dequantize_chunk_Q6_K(blocks):
+    ql, qh, scales, d = blocks[:, :128], blocks[:, 128:192], blocks[:, 192:208], _f16(blocks, 208)
     n_blocks = blocks.shape[0]
+    # Two halves of 128 values, each split in 4 runs of 32: low 4 bits from ql, 2 high bits from qh.
+    low = _nibbles(ql, 2).reshape(n_blocks, 2, 4, 32)
+    high = _bits(qh.reshape(n_blocks * 2, 32), (0, 2, 4, 6), 0x03).reshape(n_blocks, 2, 4, 32)
+    q = (low | (high << 4)).view(torch.int8).sub_(32).reshape(n_blocks, 16, 16)
+    return (d * scales.view(torch.int8)).unsqueeze(-1) * q
+
+
+DEQUANTIZERS = {
+    "Q4_0": _dequantize_chunk_Q4_0,
+    "Q4_1": _dequantize_chunk_Q4_1,
+    "Q5_0": _dequantize_chunk_Q5_0,
+    "Q5_1": _dequantize_chunk_Q5_1,
+    "Q8_0": _dequantize_chunk_Q8_0,
+    "Q4_K": _dequantize_chunk_Q4_K,
+    "Q5_K": _dequantize_chunk_Q5_K,
+    "Q6_K": _dequantize_chunk_Q6_K,
+}
 
-    d, qs = split_block_dims(blocks, 2)
-    d = d.view(torch.float16)
 
-    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor(
-        [0, 4], device=d.device, dtype=torch.uint8).reshape((1, 1, 2, 1))
-    qs = (qs & 0x0F).reshape((n_blocks, -1)).to(torch.int8) - 8
+def dequantize_blocks(data, qtype, dtype=torch.float16):
+    """Dequantize a (rows, bytes per row) tensor of ggml blocks of qtype to (rows, values per row) of dtype."""
+    if qtype not in DEQUANTIZERS:
+        raise ValueError(f"Unknown qtype: {qtype}")
+    return _dequantize_chunked(data, qtype, dtype, DEQUANTIZERS[qtype])
+
+
+def dequantize_blocks_Q4_0(data, dtype=torch.float16):
+    return dequantize_blocks(data, "Q4_0", dtype)
 
-    out = (d * qs)
 
-    out = out.reshape(quant_shape_from_byte_shape(
-        shape,
-        qtype="Q4_0",
-    )).to(dtype)
-    return out
 def dequantize_blocks_Q8_0(data, dtype=torch.float16):
-    block_size, type_size = GGML_QUANT_SIZES["Q8_0"]
+    return dequantize_blocks(data, "Q8_0", dtype)
 
-    data = data.to(torch.uint8)
-    shape = data.shape
 
-    rows = data.reshape(
-        (-1, data.shape[-1])
-    ).view(torch.uint8)
+def _pack_nibbles(q):
+    """Inverse of _nibbles(qs, 1): (n, 32) values in [0, 15] to (n, 16) bytes."""
+    return q[:, :16] | (q[:, 16:] << 4)
 
-    n_blocks = rows.numel() // type_size
-    blocks = data.reshape((n_blocks, type_size))
 
-    n_blocks = blocks.shape[0]
+def _pack_high_bits_32(q):
+    """Bit 4 of each of the (n, 32) values, as the 4 bytes of a little-endian uint32."""
+    bits = ((q >> 4) & 1).reshape(-1, 4, 8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=q.device)
+    return (bits << shifts).sum(dim=-1, dtype=torch.uint8)
+
+
+def _f16_bytes(x):
+    return x.half().reshape(-1, 1).view(torch.uint8)
+
 
-    d, qs = split_block_dims(blocks, 2)
-    d = d.view(torch.float16).to(torch.float32)
+def _safe_inverse(d):
+    return torch.where(d == 0, torch.zeros_like(d), 1.0 / d)
 
-    qs = qs.view(torch.int8).to(torch.float32)
 
-    out = (d * qs)
+def _signed_absmax(x):
+    """Per row, the value with the largest magnitude, keeping its sign like ggml does."""
+    return x.gather(1, x.abs().argmax(dim=1, keepdim=True))
 
-    out = out.reshape(quant_shape_from_byte_shape(
-        shape,
-        qtype="Q8_0",
-    )).to(dtype)
-    return out
\ No newline at end of file
+
+def _quantize_chunk_Q4_0(x):
+    d = _signed_absmax(x) / -8
+    q = (x * _safe_inverse(d) + 8.5).floor().clamp_(0, 15).to(torch.uint8)
+    return torch.cat([_f16_bytes(d), _pack_nibbles(q)], dim=1)
+
+
+def _quantize_chunk_Q4_1(x):
+    lo, hi = x.amin(dim=1, keepdim=True), x.amax(dim=1, keepdim=True)
+    d = (hi - lo) / 15
+    q = ((x - lo) * _safe_inverse(d) + 0.5).floor().clamp_(0, 15).to(torch.uint8)
+    return torch.cat([_f16_bytes(d), _f16_bytes(lo), _pack_nibbles(q)], dim=1)
+
+
+def _quantize_chunk_Q5_0(x):
+    d = _signed_absmax(x) / -16
+    q = (x * _safe_inverse(d) + 16.5).floor().clamp_(0, 31).to(torch.uint8)
+    return torch.cat([_f16_bytes(d), _pack_high_bits_32(q), _pack_nibbles(q & 0x0F)], dim=1)
+
+
+def _quantize_chunk_Q5_1(x):
+    lo, hi = x.amin(dim=1, keepdim=True), x.amax(dim=1, keepdim=True)
+    d = (hi - lo) / 31
+    q = ((x - lo) * _safe_inverse(d) + 0.5).floor().clamp_(0, 31).to(torch.uint8)
+    return torch.cat([_f16_bytes(d), _f16_bytes(lo), _pack_high_bits_32(q), _pack_nibbles(q & 0x0F)], dim=1)
+
+
+def _quantize_chunk_Q8_0(x):
+    d = x.abs().amax(dim=1, keepdim=True) / 127
+    q = (x * _safe_inverse(d)).round_().to(torch.int8)
+    return torch.cat([_f16_bytes(d), q.view(torch.uint8)], dim=1)
+
+
+# Round-to-nearest quantizers matching ggml's reference ones. K-quants need ggml's
+# iterative scale search and are only supported for loading.
+QUANTIZERS = {
+    "Q4_0": _quantize_chunk_Q4_0,
+    "Q4_1": _quantize_chunk_Q4_1,
+    "Q5_0": _quantize_chunk_Q5_0,
+    "Q5_1": _quantize_chunk_Q5_1,
+    "Q8_0": _quantize_chunk_Q8_0,
+}
+
+
+def quantize_blocks(weight, qtype):
+    """Quantize a (rows, values per row) weight to the (rows, bytes per row) uint8 blocks dequantize_blocks reads."""
+    if qtype not in QUANTIZERS:
+        raise ValueError(f"Quantizing to {qtype} is not supported, use one of {list(QUANTIZERS)}")
+    block_size, type_size = GGML_QUANT_SIZES[qtype]
+    byte_shape = quant_shape_to_byte_shape(weight.shape, qtype)
+    values = weight.reshape(-1, block_size)
+    out = torch.empty((values.shape[0], type_size), dtype=torch.uint8, device=weight.device)
+    chunk_blocks = DEQUANT_CHUNK_VALUES // block_size
+    for start in range(0, values.shape[0], chunk_blocks):
+        chunk = slice(start, start + chunk_blocks)
+        out[chunk] = QUANTIZERS[qtype](values[chunk].float())
+    return out.reshape(byte_shape)
@@ -13,7 +13,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 log = logging.getLogger(__name__)
 
 from .mochi_preview.t2v_synth_mochi import T2VSynthMochiModel
-from .mochi_preview.vae.model import Decoder
+from .mochi_preview.residency import MODEL_RESIDENCY, checkpoint_bytes, checkpoint_identity, freeze
+from .mochi_preview.memory_budget import MEMORY_BUDGET
+from .mochi_preview.embedding_cache import T5_EMBEDDING_CACHE, embedding_key, encoder_identity
+from .mochi_preview.dit.joint_model.utils import T5_LENGTH_BUCKETS
+from .mochi_preview.vae.model import Decoder, decode_workspace_bytes
 
 from contextlib import nullcontext
 try:
@@ -43,6 +47,73 @@ def linear_quadratic_schedule(num_steps, threshold_noise, linear_steps=None):
     sigma_schedule = [1.0 - x for x in sigma_schedule]
     return sigma_schedule
    
+def load_resident_dit(key, loader, *, name, device, size_bytes=0):
+    """T2VSynthMochiModel from the process-wide residency cache, loaded by loader() on a miss."""
+    return MODEL_RESIDENCY.load(
+        ("dit",) + key,
+        loader,
+        name=name,
+        modules=lambda model: [model.dit],
+        demote=lambda model: model.offload_dit(),
+        device=device,
+        size_bytes=size_bytes,
+    )
+
+
+def encode_prompts(clip, prompts, strength=1.0, *, batch_size=8, max_tokens=256, device="cpu"):
+    """T5 conditioning of each prompt, from T5_EMBEDDING_CACHE or encoded batch_size prompts per T5 forward.
+
+    T5 runs on the CPU by default, which leaves the device to the DiT. With device="gpu" it runs
+    on ComfyUI's text encoder device, the memory budget may move other models off it first.
+
+    Returns:
+        One {"embeds": [1, max_tokens, 4096], "attention_mask": [1, max_tokens]} dict per prompt.
+    """
+    clip.tokenizer.t5xxl.pad_to_max_length = True
+    clip.tokenizer.t5xxl.max_length = max_tokens
+    # Same prompt, encoder (with its LoRAs) and strength as an earlier run: skip T5 entirely.
+    patcher = getattr(clip, "patcher", None)
+    patches = str(patcher.patches_uuid) if getattr(patcher, "patches", None) else None
+    identity = encoder_identity(clip.cond_stage_model, patches)
+
+    results = [None] * len(prompts)
+    pending = {}  # Key -> first section and the indices of the prompts encoding to it
+    for i, prompt in enumerate(prompts):
+        # Keyed on all the tokens, like the entries already on disk. Tokens past max_tokens
+        # spill into further sections, only the first one is encoded.
+        sections = clip.tokenizer.t5xxl.tokenize_with_weights(prompt, return_word_ids=True)
+        key = embedding_key(sections, identity, strength)
+        if key in pending:
+            pending[key][1].append(i)
+            continue
+        results[i] = T5_EMBEDDING_CACHE.get(key)
+        if results[i] is None:
+            pending[key] = (sections[0], [i])
+    log.info(T5_EMBEDDING_CACHE)
+    if not pending:
+        return results
+
+    device = mm.text_encoder_device() if device == "gpu" else torch.device("cpu")
+    if clip.cond_stage_model not in MEMORY_BUDGET.components:
+        # ComfyUI owns the T5 weights, don't copy them into pinned memory when offloading.
+        MEMORY_BUDGET.register(clip.cond_stage_model, "T5", pin=False)
+    MEMORY_BUDGET.prepare("text encode", [clip.cond_stage_model], device=device)
+    pending = list(pending.items())
+    with torch.cuda.amp.autocast(dtype=torch.bfloat16), torch.no_grad():
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            # One forward over all sections, returned concatenated along the tokens.
+            embeds, _, extra = clip.cond_stage_model.t5xxl.encode_token_weights([section for _, (section, _) in batch])
+            embeds = embeds.cpu().reshape(len(batch), max_tokens, -1)
+            attention_mask = extra["attention_mask"].cpu().reshape(len(batch), max_tokens).bool()
+            for j, (key, (_, indices)) in enumerate(batch):
+                entry = {"embeds": embeds[j:j + 1] * strength, "attention_mask": attention_mask[j:j + 1]}
+                T5_EMBEDDING_CACHE.put(key, entry)
+                # Copies, like cache hits: the conditioning may be modified in place downstream.
+                for i in indices:
+                    results[i] = {"embeds": entry["embeds"].clone(), "attention_mask": entry["attention_mask"].clone()}
+    return results
+
 class DownloadAndLoadMochiModel:
     @classmethod
     def INPUT_TYPES(s):
@@ -66,12 +137,15 @@ class DownloadAndLoadMochiModel:
                 ),
                  "precision": (["bf16", "fp8_e4m3fn", "fp8_e4m3fn_fast", "fp16", "fp32"],
                     {"default": "bf16"}),
-                "attention_mode": (["flash_attn", "sdpa", "sage_attn", "comfy"],
+                "attention_mode": (["flash_attn", "sdpa", "sage_attn", "comfy", "chunked", "blocked"],
                     {"default": "flash_attn"}),
             },
             "optional": {
                 "trigger": ("CONDITIONING", {"tooltip": "Dummy input for forcing execution order",}),
                 "compile_args": ("MOCHICOMPILEARGS", {"tooltip": "Optional torch.compile arguments",}),
+                "blocks_to_swap": ("INT", {"default": 0, "min": 0, "max": 47, "step": 1, "tooltip": "Number of transformer blocks kept in pinned RAM and streamed to the GPU while sampling, overlapped with compute. Lowers VRAM use at some speed cost"}),
+                "gguf_dequant_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "step": 256, "tooltip": "GGUF models only: VRAM in MB for keeping dequantized weights between steps instead of dequantizing every layer on every call. Layers are kept in the order they are first used, a bf16 block takes about 400 MB"}),
+                "gguf_tile_rows": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 256, "tooltip": "GGUF models only: dequantize and multiply this many output rows at a time for layers not in the dequant cache, so no full weight is ever materialized. 0 dequantizes whole weights"}),
             },
         }
 
@@ -81,11 +155,10 @@ class DownloadAndLoadMochiModel:
     CATEGORY = "MochiWrapper"
     DESCRIPTION = "Downloads and loads the selected Mochi model from Huggingface"
 
-    def loadmodel(self, model, vae, precision, attention_mode, trigger=None, compile_args=None):
+    def loadmodel(self, model, vae, precision, attention_mode, trigger=None, compile_args=None, blocks_to_swap=0, gguf_dequant_cache_mb=0, gguf_tile_rows=0):
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
-        mm.soft_empty_cache()
 
         dtype = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
 
@@ -118,40 +191,65 @@ class DownloadAndLoadMochiModel:
                 local_dir_use_symlinks=False,
             )
 
-        model = T2VSynthMochiModel(
+        def load_dit():
+            return T2VSynthMochiModel(
+                device=device,
+                offload_device=offload_device,
+                vae_stats_path=os.path.join(script_directory, "configs", "vae_stats.json"),
+                dit_checkpoint_path=model_path,
+                weight_dtype=dtype,
+                fp8_fastmode = True if precision == "fp8_e4m3fn_fast" else False,
+                attention_mode=attention_mode,
+                compile_args=compile_args,
+                blocks_to_swap=blocks_to_swap,
+                dequant_cache_bytes=gguf_dequant_cache_mb * 1024**2,
+                dequant_tile_rows=gguf_tile_rows,
+            )
+
+        model = load_resident_dit(
+            (checkpoint_identity(model_path), precision, attention_mode, freeze(compile_args), blocks_to_swap, gguf_dequant_cache_mb, gguf_tile_rows),
+            load_dit,
+            name=os.path.basename(model_path),
             device=device,
-            offload_device=offload_device,
-            vae_stats_path=os.path.join(script_directory, "configs", "vae_stats.json"),
-            dit_checkpoint_path=model_path,
-            weight_dtype=dtype,
-            fp8_fastmode = True if precision == "fp8_e4m3fn_fast" else False,
-            attention_mode=attention_mode,
-            compile_args=compile_args
+            size_bytes=checkpoint_bytes(model_path),
+        )
+
+        def load_vae():
+            with (init_empty_weights() if is_accelerate_available else nullcontext()):
+                vae = Decoder(
+                        out_channels=3,
+                        base_channels=128,
+                        channel_multipliers=[1, 2, 4, 6],
+                        temporal_expansions=[1, 2, 3],
+                        spatial_expansions=[2, 2, 2],
+                        num_res_blocks=[3, 3, 4, 6, 3],
+                        latent_dim=12,
+                        has_attention=[False, False, False, False, False],
+                        padding_mode="replicate",
+                        output_norm=False,
+                        nonlinearity="silu",
+                        output_nonlinearity="silu",
+                        causal=True,
+                    )
+            vae_sd = load_torch_file(vae_path)
+            if is_accelerate_available:
+                for key in vae_sd:
+                    set_module_tensor_to_device(vae, key, dtype=torch.float32, device=device, value=vae_sd[key])
+            else:
+                vae.load_state_dict(vae_sd, strict=True)
+                vae.eval().to(torch.bfloat16).to(device)
+            del vae_sd
+            MEMORY_BUDGET.register(vae, "VAE")
+            return vae
+
+        vae = MODEL_RESIDENCY.load(
+            ("vae", checkpoint_identity(vae_path), device),
+            load_vae,
+            name=os.path.basename(vae_path),
+            device=device,
+            size_bytes=checkpoint_bytes(vae_path),
+            keep=[model],
         )
-        with (init_empty_weights() if is_accelerate_available else nullcontext()):
-            vae = Decoder(
-                    out_channels=3,
-                    base_channels=128,
-                    channel_multipliers=[1, 2, 4, 6],
-                    temporal_expansions=[1, 2, 3],
-                    spatial_expansions=[2, 2, 2],
-                    num_res_blocks=[3, 3, 4, 6, 3],
-                    latent_dim=12,
-                    has_attention=[False, False, False, False, False],
-                    padding_mode="replicate",
-                    output_norm=False,
-                    nonlinearity="silu",
-                    output_nonlinearity="silu",
-                    causal=True,
-                )
-        vae_sd = load_torch_file(vae_path)
-        if is_accelerate_available:
-            for key in vae_sd:
-                set_module_tensor_to_device(vae, key, dtype=torch.float32, device=device, value=vae_sd[key])
-        else:
-            vae.load_state_dict(vae_sd, strict=True)
-            vae.eval().to(torch.bfloat16).to(device)
-        del vae_sd
 
         return (model, vae,)
     
@@ -162,11 +260,14 @@ class MochiModelLoader:
             "required": { 
                 "model_name": (folder_paths.get_filename_list("diffusion_models"), {"tooltip": "The name of the checkpoint (model) to load.",}),
                 "precision": (["fp8_e4m3fn","fp8_e4m3fn_fast","fp16", "fp32", "bf16"], {"default": "fp8_e4m3fn"}),
-                "attention_mode": (["sdpa","flash_attn","sage_attn", "comfy"],),
+                "attention_mode": (["sdpa","flash_attn","sage_attn", "comfy", "chunked", "blocked"], {"tooltip": "Unavailable backends fall back to sdpa, 'chunked' and 'blocked' are pure PyTorch backends with bounded memory that also run on CPU, 'blocked' stays O(N) for long videos"}),
             },
             "optional": {
                 "trigger": ("CONDITIONING", {"tooltip": "Dummy input for forcing execution order",}),
                 "compile_args": ("MOCHICOMPILEARGS", {"tooltip": "Optional torch.compile arguments",}),
+                "blocks_to_swap": ("INT", {"default": 0, "min": 0, "max": 47, "step": 1, "tooltip": "Number of transformer blocks kept in pinned RAM and streamed to the GPU while sampling, overlapped with compute. Lowers VRAM use at some speed cost"}),
+                "gguf_dequant_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "step": 256, "tooltip": "GGUF models only: VRAM in MB for keeping dequantized weights between steps instead of dequantizing every layer on every call. Layers are kept in the order they are first used, a bf16 block takes about 400 MB"}),
+                "gguf_tile_rows": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 256, "tooltip": "GGUF models only: dequantize and multiply this many output rows at a time for layers not in the dequant cache, so no full weight is ever materialized. 0 dequantizes whole weights"}),
             },
         }
     RETURN_TYPES = ("MOCHIMODEL",)
@@ -174,24 +275,35 @@ class MochiModelLoader:
     FUNCTION = "loadmodel"
     CATEGORY = "MochiWrapper"
 
-    def loadmodel(self, model_name, precision, attention_mode, trigger=None, compile_args=None):
+    def loadmodel(self, model_name, precision, attention_mode, trigger=None, compile_args=None, blocks_to_swap=0, gguf_dequant_cache_mb=0, gguf_tile_rows=0):
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
-        mm.soft_empty_cache()
 
         dtype = {"fp8_e4m3fn": torch.float8_e4m3fn, "fp8_e4m3fn_fast": torch.float8_e4m3fn, "bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[precision]
         model_path = folder_paths.get_full_path_or_raise("diffusion_models", model_name)
 
-        model = T2VSynthMochiModel(
+        def load_dit():
+            return T2VSynthMochiModel(
+                device=device,
+                offload_device=offload_device,
+                vae_stats_path=os.path.join(script_directory, "configs", "vae_stats.json"),
+                dit_checkpoint_path=model_path,
+                weight_dtype=dtype,
+                fp8_fastmode = True if precision == "fp8_e4m3fn_fast" else False,
+                attention_mode=attention_mode,
+                compile_args=compile_args,
+                blocks_to_swap=blocks_to_swap,
+                dequant_cache_bytes=gguf_dequant_cache_mb * 1024**2,
+                dequant_tile_rows=gguf_tile_rows,
+            )
+
+        model = load_resident_dit(
+            (checkpoint_identity(model_path), precision, attention_mode, freeze(compile_args), blocks_to_swap, gguf_dequant_cache_mb, gguf_tile_rows),
+            load_dit,
+            name=os.path.basename(model_path),
             device=device,
-            offload_device=offload_device,
-            vae_stats_path=os.path.join(script_directory, "configs", "vae_stats.json"),
-            dit_checkpoint_path=model_path,
-            weight_dtype=dtype,
-            fp8_fastmode = True if precision == "fp8_e4m3fn_fast" else False,
-            attention_mode=attention_mode,
-            compile_args=compile_args
+            size_bytes=checkpoint_bytes(model_path),
         )
 
         # Optimisation du format mémoire
@@ -265,43 +377,51 @@ class MochiVAELoader:
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
-        mm.soft_empty_cache()
 
         vae_path = folder_paths.get_full_path_or_raise("vae", model_name)
 
-        with (init_empty_weights() if is_accelerate_available else nullcontext()):
-            vae = Decoder(
-                    out_channels=3,
-                    base_channels=128,
-                    channel_multipliers=[1, 2, 4, 6],
-                    temporal_expansions=[1, 2, 3],
-                    spatial_expansions=[2, 2, 2],
-                    num_res_blocks=[3, 3, 4, 6, 3],
-                    latent_dim=12,
-                    has_attention=[False, False, False, False, False],
-                    padding_mode="replicate",
-                    output_norm=False,
-                    nonlinearity="silu",
-                    output_nonlinearity="silu",
-                    causal=True,
-                )
-        vae_sd = load_torch_file(vae_path)
-        if is_accelerate_available:
-            for key in vae_sd:
-                set_module_tensor_to_device(vae, key, dtype=torch.float32, device=offload_device, value=vae_sd[key])
-        else:
-            vae.load_state_dict(vae_sd, strict=True)
-            vae.to(torch.bfloat16).to("cpu")
-        vae.eval()
-        del vae_sd
-
-        if torch_compile_args is not None:
-            vae.to(device)
-            # for i, block in enumerate(vae.blocks):
-            #     if "CausalUpsampleBlock" in str(type(block)): 
-            #         print("Compiling block", block)
-            vae = torch.compile(vae, fullgraph=torch_compile_args["fullgraph"], mode=torch_compile_args["mode"], dynamic=False, backend=torch_compile_args["backend"])
-    
+        def load_vae():
+            with (init_empty_weights() if is_accelerate_available else nullcontext()):
+                vae = Decoder(
+                        out_channels=3,
+                        base_channels=128,
+                        channel_multipliers=[1, 2, 4, 6],
+                        temporal_expansions=[1, 2, 3],
+                        spatial_expansions=[2, 2, 2],
+                        num_res_blocks=[3, 3, 4, 6, 3],
+                        latent_dim=12,
+                        has_attention=[False, False, False, False, False],
+                        padding_mode="replicate",
+                        output_norm=False,
+                        nonlinearity="silu",
+                        output_nonlinearity="silu",
+                        causal=True,
+                    )
+            vae_sd = load_torch_file(vae_path)
+            if is_accelerate_available:
+                for key in vae_sd:
+                    set_module_tensor_to_device(vae, key, dtype=torch.float32, device=offload_device, value=vae_sd[key])
+            else:
+                vae.load_state_dict(vae_sd, strict=True)
+                vae.to(torch.bfloat16).to("cpu")
+            vae.eval()
+            del vae_sd
+
+            if torch_compile_args is not None:
+                vae.to(device)
+                # for i, block in enumerate(vae.blocks):
+                #     if "CausalUpsampleBlock" in str(type(block)): 
+                #         print("Compiling block", block)
+                vae = torch.compile(vae, fullgraph=torch_compile_args["fullgraph"], mode=torch_compile_args["mode"], dynamic=False, backend=torch_compile_args["backend"])
+            MEMORY_BUDGET.register(vae, "VAE")
+            return vae
+
+        vae = MODEL_RESIDENCY.load(
+            ("vae", checkpoint_identity(vae_path), offload_device, freeze(torch_compile_args)),
+            load_vae,
+            name=os.path.basename(vae_path),
+            device=device,
+        )
 
         return (vae,)
     
@@ -313,66 +433,64 @@ class MochiTextEncode:
             "prompt": ("STRING", {"multiline": True}),
             "strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01}),
             "force_offload": ("BOOLEAN", {"default": True}),
-        }}
+            },
+            "optional": {
+                "device": (["cpu", "gpu"], {"default": "cpu", "tooltip": "Where T5 runs, the GPU is faster but may push the model to RAM"}),
+            }
+        }
 
     RETURN_TYPES = ("CONDITIONING", "CLIP")
     FUNCTION = "process"
     CATEGORY = "MochiWrapper"
 
-    def process(self, clip, prompt, strength=1.0, force_offload=True):
-        load_device = "cpu"  # Forcer le chargement sur CPU
-        max_tokens = 256
-        
+    def process(self, clip, prompt, strength=1.0, force_offload=True, device="cpu"):
         try:
-            # Configuration du tokenizer
-            clip.tokenizer.t5xxl.pad_to_max_length = True
-            clip.tokenizer.t5xxl.max_length = max_tokens
-            
-            # Tokenization sur CPU
-            tokens = clip.tokenizer.t5xxl.tokenize_with_weights(prompt, return_word_ids=True)
-            
-            # Encodage par morceaux
-            with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-                # Garder le modèle sur CPU
-                clip.cond_stage_model.to(load_device)
-                
-                # Traiter par petits lots
-                batch_size = 32
-                embeds_list = []
-                attention_masks = []
-                
-                for i in range(0, len(tokens), batch_size):
-                    batch_tokens = tokens[i:i + batch_size]
-                    with torch.no_grad():
-                        batch_embeds, _, batch_mask = clip.cond_stage_model.t5xxl.encode_token_weights(batch_tokens)
-                        embeds_list.append(batch_embeds.cpu())
-                        attention_masks.append(batch_mask["attention_mask"].cpu())
-                
-                # Concaténer les résultats
-                embeds = torch.cat(embeds_list, dim=1)
-                attention_mask = torch.cat(attention_masks, dim=1)
-                
-                # Vérification de la longueur
-                if embeds.shape[1] > max_tokens:
-                    embeds = embeds[:, :max_tokens]
-                    attention_mask = attention_mask[:, :max_tokens]
-                
-                # Application de la force
-                embeds = embeds * strength
-                
-                # Préparation du résultat
-                t5_embeds = {
-                    "embeds": embeds,
-                    "attention_mask": attention_mask.bool()
-                }
-                
-                return (t5_embeds, clip)
-                
-        except Exception as e:
+            (t5_embeds,) = encode_prompts(clip, [prompt], strength, device=device)
+            return (t5_embeds, clip)
+        finally:
+            if force_offload:
+                MEMORY_BUDGET.offload(clip.cond_stage_model, reason="text encode done, force_offload")
+
+class MochiTextEncodeBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "clip": ("CLIP",),
+            "prompts": ("STRING", {"multiline": True, "tooltip": "One prompt per line, empty lines are skipped"}),
+            "strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01}),
+            "batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "step": 1, "tooltip": "Prompts per T5 forward"}),
+            "force_offload": ("BOOLEAN", {"default": True}),
+            },
+            "optional": {
+                "prompts_file": ("STRING", {"default": "", "tooltip": "Text file with more prompts, one per line, appended to the prompts"}),
+                "device": (["cpu", "gpu"], {"default": "cpu", "tooltip": "Where T5 runs, the GPU is faster but may push the model to RAM"}),
+            }
+        }
+
+    RETURN_TYPES = ("CONDITIONING", "CLIP", "INT")
+    RETURN_NAMES = ("conditioning", "clip", "count")
+    FUNCTION = "process"
+    CATEGORY = "MochiWrapper"
+    DESCRIPTION = "Encodes many prompts in batched T5 forwards, the conditioning has one batch entry per prompt"
+
+    def process(self, clip, prompts, strength=1.0, batch_size=8, force_offload=True, prompts_file="", device="cpu"):
+        lines = prompts.splitlines()
+        if prompts_file:
+            with open(prompts_file, encoding="utf-8") as f:
+                lines += f.read().splitlines()
+        lines = [line.strip() for line in lines if line.strip()]
+        if not lines:
+            raise ValueError("No prompts given")
+        try:
+            embeds = encode_prompts(clip, lines, strength, batch_size=batch_size, device=device)
+        finally:
             if force_offload:
-                clip.cond_stage_model.to("cpu")
-                torch.cuda.empty_cache()
-            raise e
+                MEMORY_BUDGET.offload(clip.cond_stage_model, reason="text encode done, force_offload")
+        t5_embeds = {
+            "embeds": torch.cat([e["embeds"] for e in embeds]),
+            "attention_mask": torch.cat([e["attention_mask"] for e in embeds]),
+        }
+        return (t5_embeds, clip, len(lines))
 
 class MochiImageEncode:
     @classmethod 
@@ -425,6 +543,12 @@ class MochiSampler:
             "optional": {
                 "image_cond": ("CONDITIONING",),
                 "image_strength": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01}),
+                "trim_text_tokens": ("BOOLEAN", {"default": True, "tooltip": "Trim T5 padding to the longest prompt, rounded up to 32/64/128/256 tokens. Same result, less work in the text stream"}),
+                "cfg_sigma_min": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001, "tooltip": "CFG is only applied to steps with sigma in [cfg_sigma_min, cfg_sigma_max], other steps skip the negative prompt"}),
+                "cfg_sigma_max": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001, "tooltip": "CFG is only applied to steps with sigma in [cfg_sigma_min, cfg_sigma_max], other steps skip the negative prompt"}),
+                "step_cache_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "Reuse the transformer blocks' output of the previous step while the input changed less than this in total. 0 disables, higher is faster with lower quality"}),
+                "mlp_chunk_mb": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 64, "tooltip": "Run the visual MLPs on token chunks using at most this many MB of activations, lowers peak VRAM for long videos. 0 disables"}),
+                "batch_cfg": ("BOOLEAN", {"default": False, "tooltip": "Run the positive and negative prompt as one batch of 2 per step. Faster on GPUs with memory to spare"}),
             }
         }
 
@@ -433,9 +557,9 @@ class MochiSampler:
     FUNCTION = "process"
     CATEGORY = "MochiWrapper"
 
-    def process(self, model, positive, negative, steps, cfg, seed, height, width, num_frames, image_cond=None, image_strength=1.0):
-        mm.soft_empty_cache()
-
+    def process(self, model, positive, negative, steps, cfg, seed, height, width, num_frames, image_cond=None, image_strength=1.0,
+                trim_text_tokens=True, cfg_sigma_min=0.0, cfg_sigma_max=1.0,
+                step_cache_threshold=0.0, mlp_chunk_mb=0, batch_cfg=False):
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
 
@@ -447,7 +571,11 @@ class MochiSampler:
                 "sigma_schedule": linear_quadratic_schedule(steps, 0.025),
                 "cfg_schedule": [cfg] * steps,
                 "num_inference_steps": steps,
-                "batch_cfg": False,
+                "batch_cfg": batch_cfg,
+                "cfg_interval": (cfg_sigma_min, cfg_sigma_max),
+                "step_cache_threshold": step_cache_threshold,
+                "mlp_chunk_bytes": mlp_chunk_mb * 1024**2 if mlp_chunk_mb > 0 else None,
+                "text_length_buckets": T5_LENGTH_BUCKETS if trim_text_tokens else None,
             },
             "positive_embeds": positive,
             "negative_embeds": negative,
@@ -471,8 +599,6 @@ class MochiSampler:
             }
         
         latents = model.run(args)
-    
-        mm.soft_empty_cache()
 
         return ({"samples": latents},)
     
@@ -516,6 +642,9 @@ class MochiDecode:
             self.tile_sample_min_height = samples.shape[3] // 3
             self.tile_sample_min_width = samples.shape[4] // 3
         
+        MEMORY_BUDGET.prepare("decode", [vae], device=device, workspace_bytes=decode_workspace_bytes(samples.shape))
+        samples = samples.to(device)
+
         # Reste du code avec context manager bf16
         with torch.cuda.amp.autocast(dtype=torch.bfloat16):
             if enable_vae_tiling:
@@ -722,7 +851,11 @@ class MochiDecodeSpatialTiling:
 
         B, C, T, H, W = samples.shape
 
-        vae.to(device)
+        if enable_vae_tiling:
+            workspace_bytes = decode_workspace_bytes((B, C, min(per_batch, T), H, W), num_tiles_h, num_tiles_w)
+        else:
+            workspace_bytes = decode_workspace_bytes(samples.shape)
+        MEMORY_BUDGET.prepare("decode", [vae], device=device, workspace_bytes=workspace_bytes)
         decoded_list = []
         with torch.autocast(mm.get_autocast_device(device), dtype=torch.bfloat16):
             if enable_vae_tiling:
@@ -744,7 +877,6 @@ class MochiDecodeSpatialTiling:
                 logging.info("Decoding without tiling...")
                 frames = vae(samples)
         frames = torch.cat(decoded_list, dim=2)
-        vae.to(offload_device)
 
         frames = frames.float()
         frames = (frames + 1.0) / 2.0
@@ -761,6 +893,7 @@ NODE_CLASS_MAPPINGS = {
     "MochiDecode": MochiDecode,
     "MochiDecodeOptimized": OptimizedMochiDecode,
     "MochiTextEncode": MochiTextEncode,
+    "MochiTextEncodeBatch": MochiTextEncodeBatch,
     "MochiModelLoader": MochiModelLoader,
     "MochiVAELoader": MochiVAELoader,
     "MochiDecodeSpatialTiling": MochiDecodeSpatialTiling,
@@ -772,6 +905,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "MochiDecode": "Mochi Decode",
     "MochiDecodeOptimized": "Mochi Decode Optimized",
     "MochiTextEncode": "Mochi TextEncode",
+    "MochiTextEncodeBatch": "Mochi TextEncode Batch",
     "MochiModelLoader": "Mochi Model Loader",
     "MochiVAELoader": "Mochi VAE Loader",
     "MochiDecodeSpatialTiling": "Mochi VAE Decode Spatial Tiling",
@@ -0,0 +1,248 @@
+"""Quantize the Mochi DiT offline, on CPU.
+
+Reads the bf16 DiT safetensors and writes a checkpoint the loader nodes read: GGUF blocks in
+the format of mz_gguf_loader, or scaled fp8 (FP8Linear weights with per-channel scales).
+Each linear layer of the transformer blocks gets its own precision. A calibration pass over a
+tiny latent records the inputs of every layer, and the relative output error of each candidate
+precision on those inputs decides which layers get more bits when a size budget is given.
+
+    python quantize_dit.py mochi_preview_dit_bf16.safetensors mochi_dit_mixed_GGUF.safetensors \\
+        --qtypes Q4_0,Q5_1,Q8_0 --budget_gb 8
+    python quantize_dit.py mochi_preview_dit_bf16.safetensors mochi_dit_scaled_fp8.safetensors --format fp8
+
+Without --budget_gb every layer gets the first precision of --qtypes and no calibration runs.
+"""
+import argparse
+import heapq
+import json
+import logging
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file, save_file
+
+from fp8_optimization import FP8_DTYPES, FP8Linear
+from mochi_preview.dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from mochi_preview.dit.joint_model.utils import compute_packed_indices
+from mz_gguf_loader import GGML_QUANT_SIZES, QUANTIZERS, dequantize_blocks, quant_shape_to_byte_shape, quantize_blocks
+
+log = logging.getLogger(__name__)
+
+# Noise levels the calibration forward runs at.
+CALIBRATION_SIGMAS = (0.9, 0.5, 0.1)
+
+
+def quantized_linears(model: nn.Module) -> Dict[str, nn.Linear]:
+    """The layers that get a precision of their own: the linears of the transformer blocks."""
+    return {name: module for name, module in model.named_modules() if isinstance(module, nn.Linear) and "blocks" in name}
+
+
+def layer_bytes(linear: nn.Linear, precision: str) -> int:
+    """Checkpoint bytes of the weight and bias of linear in precision."""
+    out_features, in_features = linear.weight.shape
+    bias = 0 if linear.bias is None else out_features * 2
+    if precision == "bf16":
+        return out_features * in_features * 2 + bias
+    if precision == "fp8":
+        return out_features * in_features + out_features * 4 + bias
+    rows, row_bytes = quant_shape_to_byte_shape((out_features, in_features), precision)
+    return rows * row_bytes + bias
+
+
+def quantize_linear(linear: nn.Linear, precision: str) -> Tuple[Dict[str, torch.Tensor], torch.Tensor]:
+    """Checkpoint tensors of linear in precision, by name within the layer, and the weight they dequantize to."""
+    weight = linear.weight.detach()
+    bias = linear.bias.detach() if linear.bias is not None else None
+    if precision == "bf16":
+        tensors = {"weight": weight.to(torch.bfloat16)}
+        if bias is not None:
+            tensors["bias"] = bias.to(torch.bfloat16)
+        return tensors, tensors["weight"].float()
+    if precision == "fp8":
+        layer = FP8Linear.from_linear(linear, out_dtype=torch.bfloat16)
+        return dict(layer.state_dict()), layer.weight.float() * layer.scale_weight
+    qweight = quantize_blocks(weight, precision)
+    tensors = {f"{precision}_qweight": qweight}
+    if bias is not None:
+        # WQLinear_GGUF keeps its bias in float16.
+        tensors["bias"] = bias.to(torch.float16)
+    return tensors, dequantize_blocks(qweight, precision, torch.float32)
+
+
+@torch.no_grad()
+def collect_layer_inputs(
+    model: AsymmDiTJoint, linears: Dict[str, nn.Linear], args: argparse.Namespace
+) -> Dict[str, torch.Tensor]:
+    """Run the calibration forwards and keep up to args.calibration_tokens input rows per layer."""
+    generator = torch.Generator().manual_seed(args.seed)
+    if args.calibration_embeds:
+        embeds = load_file(args.calibration_embeds)
+        y_feat, y_mask = embeds["embeds"][:1].float(), embeds["attention_mask"][:1].bool()
+    else:
+        # Stand-in for T5 features, real prompt embeddings calibrate the text stream better.
+        y_feat = torch.randn(1, MOCHI_PREVIEW_CONFIG["t5_token_length"], MOCHI_PREVIEW_CONFIG["t5_feat_dim"], generator=generator) * 0.2
+        y_mask = torch.zeros(1, y_feat.size(1), dtype=torch.bool)
+        y_mask[:, :32] = True
+    latent_frames = (args.calibration_frames - 1) // 6 + 1
+    x = torch.randn(1, MOCHI_PREVIEW_CONFIG["in_channels"], latent_frames, args.calibration_height // 8,
+                    args.calibration_width // 8, generator=generator)
+    num_visual_tokens = latent_frames * (args.calibration_height // 16) * (args.calibration_width // 16)
+
+    inputs: Dict[str, List[torch.Tensor]] = {name: [] for name in linears}
+    hooks = [
+        linear.register_forward_pre_hook(
+            lambda module, args_, name=name: inputs[name].append(args_[0].detach().reshape(-1, module.in_features).float())
+        )
+        for name, linear in linears.items()
+    ]
+    try:
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            packed_indices = compute_packed_indices(num_visual_tokens, [y_mask])
+            conditioning = model.prepare_conditioning(y_feat, y_mask, packed_indices=packed_indices)
+            for sigma in CALIBRATION_SIGMAS:
+                model(x, torch.tensor([sigma]), conditioning=conditioning)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    sampled = {}
+    for name, chunks in inputs.items():
+        rows = torch.cat(chunks)
+        if rows.size(0) > args.calibration_tokens:
+            rows = rows[torch.randperm(rows.size(0), generator=generator)[:args.calibration_tokens]]
+        sampled[name] = rows
+    return sampled
+
+
+def allocate(options: Dict[str, List[Tuple[int, float]]], budget: int) -> Dict[str, int]:
+    """Greedily pick an option per layer to minimize the summed error within budget bytes.
+
+    Args:
+        options: Per layer, (bytes, error) of each precision sorted by bytes.
+        budget: Bytes available for all layers.
+
+    Returns:
+        Index of the chosen option per layer.
+    """
+    # Upgrades that cost bytes without lowering the error are never worth taking.
+    useful = {}
+    for name, layer_options in options.items():
+        kept = [0]
+        for i, (_, error) in enumerate(layer_options[1:], 1):
+            if error < layer_options[kept[-1]][1]:
+                kept.append(i)
+        useful[name] = kept
+
+    choice = {name: 0 for name in options}
+    total = sum(layer_options[0][0] for layer_options in options.values())
+    if total > budget:
+        raise ValueError(f"The smallest options take {total} bytes, over the budget of {budget}")
+
+    def push(heap, name):
+        position = useful[name].index(choice[name])
+        if position + 1 < len(useful[name]):
+            current, upgrade = options[name][choice[name]], options[name][useful[name][position + 1]]
+            gain = (current[1] - upgrade[1]) / max(upgrade[0] - current[0], 1)
+            heapq.heappush(heap, (-gain, name, useful[name][position + 1]))
+
+    heap = []
+    for name in options:
+        push(heap, name)
+    while heap:
+        _, name, upgrade = heapq.heappop(heap)
+        extra = options[name][upgrade][0] - options[name][choice[name]][0]
+        if total + extra > budget:
+            continue
+        total += extra
+        choice[name] = upgrade
+        push(heap, name)
+    return choice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="bf16 DiT safetensors")
+    parser.add_argument("output", help="Quantized safetensors to write")
+    parser.add_argument("--format", choices=["gguf", "fp8"], default="gguf")
+    parser.add_argument("--qtypes", default="Q4_0,Q5_1,Q8_0",
+                        help=f"GGUF precisions to choose from, from {','.join(QUANTIZERS)} and bf16. "
+                             "The fp8 format chooses between fp8 and bf16")
+    parser.add_argument("--budget_gb", type=float, default=None, help="Size of the whole checkpoint")
+    parser.add_argument("--calibration_embeds", default=None,
+                        help="safetensors with 'embeds' (1, L, 4096) and 'attention_mask' (1, L) of a real prompt")
+    parser.add_argument("--calibration_frames", type=int, default=7)
+    parser.add_argument("--calibration_height", type=int, default=128)
+    parser.add_argument("--calibration_width", type=int, default=128)
+    parser.add_argument("--calibration_tokens", type=int, default=512, help="Input rows kept per layer")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.format == "fp8":
+        precisions = ["fp8", "bf16"]
+    else:
+        precisions = [p.strip() for p in args.qtypes.split(",")]
+        unknown = [p for p in precisions if p != "bf16" and p not in QUANTIZERS]
+        if unknown:
+            known = [q for q in GGML_QUANT_SIZES if q not in QUANTIZERS]
+            raise SystemExit(f"Can't quantize to {unknown}, choose from {list(QUANTIZERS)} and bf16 ({known} are load-only)")
+
+    log.info(f"Loading {args.input}...")
+    state_dict = load_file(args.input)
+    if any(tensor.dtype in FP8_DTYPES for tensor in state_dict.values()):
+        log.warning("The input has fp8 weights, quantize from the bf16 checkpoint for the best quality")
+    with torch.device("meta"):
+        model = AsymmDiTJoint(**MOCHI_PREVIEW_CONFIG, attention_mode="sdpa")
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    linears = quantized_linears(model)
+    fixed_bytes = sum(
+        tensor.numel() * 2 for key, tensor in state_dict.items() if key.rpartition(".")[0] not in linears
+    )
+
+    choice = {name: precisions[0] for name in linears}
+    if args.budget_gb is not None:
+        log.info(f"Calibrating {len(linears)} layers on {args.calibration_frames} frames "
+                 f"of {args.calibration_height}x{args.calibration_width}...")
+        inputs = collect_layer_inputs(model, linears, args)
+        options = {}
+        for name, linear in linears.items():
+            x = inputs[name]
+            weight = linear.weight.detach().float()
+            reference = x @ weight.t()
+            layer_options = []
+            for precision in precisions:
+                _, dequantized = quantize_linear(linear, precision)
+                error = ((x @ (dequantized - weight).t()).pow(2).sum() / reference.pow(2).sum().clamp(min=1e-12)).item()
+                layer_options.append((layer_bytes(linear, precision), error, precision))
+            layer_options.sort()
+            options[name] = layer_options
+            log.debug(f"{name}: " + ", ".join(f"{p} {e:.2e}" for _, e, p in layer_options))
+        budget = int(args.budget_gb * 1024**3) - fixed_bytes
+        smallest = fixed_bytes + sum(o[0][0] for o in options.values())
+        if smallest > args.budget_gb * 1024**3:
+            raise SystemExit(f"The checkpoint takes at least {smallest / 1024**3:.2f} GB with {precisions}, "
+                             f"over the budget of {args.budget_gb} GB")
+        picked = allocate({name: [(b, e) for b, e, _ in o] for name, o in options.items()}, budget)
+        choice = {name: options[name][index][2] for name, index in picked.items()}
+        total_error = sum(options[name][index][1] for name, index in picked.items())
+        log.info(f"Summed relative output error of the chosen precisions: {total_error:.3e}")
+
+    out = {}
+    for key, tensor in state_dict.items():
+        if key.rpartition(".")[0] not in linears:
+            out[key] = tensor.to(torch.bfloat16)
+    for name, linear in linears.items():
+        tensors, _ = quantize_linear(linear, choice[name])
+        out.update({f"{name}.{key}": tensor.contiguous() for key, tensor in tensors.items()})
+
+    counts = {p: list(choice.values()).count(p) for p in precisions}
+    size = sum(tensor.numel() * tensor.element_size() for tensor in out.values())
+    log.info(f"Layers per precision: {counts}, {size / 1024**3:.2f} GB")
+    save_file(out, args.output, metadata={"format": args.format, "precisions": json.dumps(choice)})
+    log.info(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Split a Mochi DiT safetensors checkpoint into one shard per transformer block.
+
+Writes a directory with block_00.safetensors ... block_47.safetensors, base.safetensors with
+the embedders and the final layer, and dit_index.json giving the shard, dtype, quantization,
+shape and byte range of every tensor. Works for bf16, fp8, scaled fp8 and GGUF checkpoints
+(see quantize_dit.py), tensors are copied as they are.
+
+    python shard_dit.py mochi_preview_dit_bf16.safetensors mochi_preview_dit_bf16_sharded
+
+Point the model loader at any of the shards to load the whole directory: the shards are read
+concurrently, and stream_into_module(..., prefix="blocks.3.") loads a single block.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+from typing import Dict, Optional
+
+from safetensors.torch import save_file
+
+from fp8_optimization import FP8_DTYPES
+from mochi_preview.checkpoint_loader import SHARD_FORMAT, SHARD_INDEX, SafetensorsFile, read_safetensors_header
+
+log = logging.getLogger(__name__)
+
+BLOCK_PATTERN = re.compile(r"^blocks\.(\d+)\.")
+
+
+def shard_of(name: str) -> str:
+    """Shard of a tensor: "blocks.<i>" for the transformer blocks, "base" for everything else."""
+    match = BLOCK_PATTERN.match(name)
+    return f"blocks.{match.group(1)}" if match else "base"
+
+
+def shard_file(shard: str) -> str:
+    return "base.safetensors" if shard == "base" else f"block_{int(shard.split('.')[1]):02d}.safetensors"
+
+
+def quantization_of(name: str, checkpoint: SafetensorsFile) -> Optional[str]:
+    """GGUF qtype, "fp8_scaled" or "fp8" of a tensor, None when it's stored unquantized."""
+    module_name, _, tensor_name = name.rpartition(".")
+    if tensor_name.endswith("_qweight"):
+        return tensor_name[:-len("_qweight")]
+    if tensor_name == "scale_weight" or (tensor_name == "weight" and f"{module_name}.scale_weight" in checkpoint):
+        return "fp8_scaled"
+    if checkpoint.tensors[name][0] in FP8_DTYPES:
+        return "fp8"
+    return None
+
+
+def convert(input_path: str, output_dir: str) -> Dict:
+    """Write the shards and index of input_path to output_dir, one shard in memory at a time.
+
+    Returns:
+        The index.
+    """
+    checkpoint = SafetensorsFile(input_path)
+    shards: Dict[str, list] = {}
+    for name in sorted(checkpoint, key=checkpoint.order):
+        shards.setdefault(shard_of(name), []).append(name)
+    order = ["base"] + sorted((s for s in shards if s != "base"), key=lambda s: int(s.split(".")[1]))
+
+    os.makedirs(output_dir, exist_ok=True)
+    index = {"format": SHARD_FORMAT, "metadata": checkpoint.metadata, "shards": {}, "tensors": {}}
+    for shard in order:
+        path = os.path.join(output_dir, shard_file(shard))
+        save_file({name: checkpoint[name].contiguous() for name in shards[shard]}, path,
+                  metadata={"format": SHARD_FORMAT, "shard": shard})
+        index["shards"][shard] = shard_file(shard)
+        header, _ = read_safetensors_header(path)
+        for name in shards[shard]:
+            dtype, shape, start, end = header[name]
+            index["tensors"][name] = {
+                "shard": shard,
+                "dtype": dtype,
+                "quantization": quantization_of(name, checkpoint),
+                "shape": list(shape),
+                "data_offsets": [start, end],
+            }
+        log.info(f"Wrote {path} ({len(shards[shard])} tensors)")
+    checkpoint.close()
+
+    with open(os.path.join(output_dir, SHARD_INDEX), "w") as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="DiT safetensors")
+    parser.add_argument("output_dir", help="Directory to write the shards and index to")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    index = convert(args.input, args.output_dir)
+    quantization = [info["quantization"] or info["dtype"] for info in index["tensors"].values()]
+    counts = {q: quantization.count(q) for q in sorted(set(quantization))}
+    log.info(f"Wrote {len(index['shards'])} shards to {args.output_dir}, tensors by precision: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+"""The tests run from the repository root:
+    python -m pytest -q
+Tests of the modules importing ComfyUI are skipped unless it is on the path, e.g. with PYTHONPATH=<ComfyUI>.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_collect_directory(path, parent):
+    # The repository root is the ComfyUI node package and its __init__ imports ComfyUI, so
+    # collect it as a plain directory instead of a package pytest would import.
+    if path == parent.config.rootpath and (path / "__init__.py").is_file():
+        return pytest.Dir.from_parent(parent, path=path)
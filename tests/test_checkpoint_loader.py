@@ -0,0 +1,70 @@
+import pytest
+import torch
+import torch.nn as nn
+from safetensors.torch import save_file
+
+from mochi_preview.checkpoint_loader import SafetensorsFile, stream_into_module
+
+
+def tiny_model():
+    # Parameters and buffers, num_batches_tracked is an int64 one.
+    model = nn.Sequential(nn.Linear(16, 32), nn.BatchNorm1d(32), nn.Linear(32, 8, bias=False))
+    model[1].running_mean.normal_()
+    model[1].num_batches_tracked.fill_(7)
+    return model
+
+
+@pytest.fixture
+def state_dict():
+    torch.manual_seed(0)
+    return tiny_model().state_dict()
+
+
+@pytest.fixture(params=["state dict", "safetensors"])
+def checkpoint(request, state_dict, tmp_path):
+    if request.param == "state dict":
+        yield state_dict
+    else:
+        path = str(tmp_path / "tiny.safetensors")
+        save_file(state_dict, path)
+        checkpoint = SafetensorsFile(path)
+        yield checkpoint
+        checkpoint.close()
+
+
+@pytest.mark.parametrize("window_bytes", [1, 1 << 30])
+def test_matches_load_state_dict(checkpoint, state_dict, window_bytes):
+    expected = tiny_model()
+    expected.load_state_dict(state_dict)
+    with torch.device("meta"):
+        model = tiny_model()
+    stats = stream_into_module(model, checkpoint, lambda name: (None, torch.device("cpu")), workers=2,
+                               window_bytes=window_bytes)
+
+    assert stats.tensors == len(state_dict)
+    loaded = model.state_dict()
+    assert loaded.keys() == expected.state_dict().keys()
+    for name, tensor in expected.state_dict().items():
+        assert loaded[name].dtype == tensor.dtype and torch.equal(loaded[name], tensor), name
+    assert all(isinstance(p, nn.Parameter) for p in model.parameters())
+    assert not model[1].running_mean.requires_grad
+
+
+def test_placement_converts(checkpoint, state_dict):
+    with torch.device("meta"):
+        model = tiny_model()
+    placement = lambda name: (torch.bfloat16 if name.endswith("weight") else None, torch.device("cpu"))
+    stream_into_module(model, checkpoint, placement)
+    assert model[0].weight.dtype == torch.bfloat16
+    assert torch.equal(model[0].weight, state_dict["0.weight"].to(torch.bfloat16))
+    assert model[0].bias.dtype == torch.float32
+
+
+def test_missing_and_misshapen_tensors_raise(state_dict):
+    with torch.device("meta"):
+        model = tiny_model()
+    placement = lambda name: (None, torch.device("cpu"))
+    with pytest.raises(KeyError, match="2.weight"):
+        stream_into_module(model, {k: v for k, v in state_dict.items() if k != "2.weight"}, placement)
+    with pytest.raises(ValueError, match="2.weight"):
+        stream_into_module(model, {**state_dict, "2.weight": torch.zeros(8, 31)}, placement)
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+import torch
+
+pytest.importorskip("folder_paths", reason="embedding_cache.py needs ComfyUI")
+
+from mochi_preview.embedding_cache import EmbeddingCache
+
+LENGTH, DIM = 32, 16
+
+
+def entry(valid, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    mask = torch.zeros(1, LENGTH, dtype=torch.bool)
+    mask[:, :valid] = True
+    # Encoders leave values on the padding, the cache drops them.
+    return {"embeds": torch.randn(1, LENGTH, DIM, generator=generator), "attention_mask": mask}
+
+
+def assert_same_valid_tokens(cached, original):
+    mask = original["attention_mask"]
+    assert cached["embeds"].shape == original["embeds"].shape
+    assert torch.equal(cached["attention_mask"], mask)
+    assert torch.equal(cached["embeds"][mask], original["embeds"][mask])
+
+
+def test_memory_hit():
+    cache = EmbeddingCache(None)
+    original = entry(5)
+    cache.put("a", original)
+    cached = cache.get("a")
+    assert torch.equal(cached["embeds"], original["embeds"])
+    assert cache.memory_hits == 1 and cache.get("b") is None and cache.misses == 1
+    # Callers get copies, changing one leaves the entry alone.
+    cached["embeds"].zero_()
+    assert torch.equal(cache.get("a")["embeds"], original["embeds"])
+
+
+def test_disk_round_trip_pads_to_the_original_length(tmp_path):
+    original = entry(7)
+    EmbeddingCache(str(tmp_path)).put("ab12", original)
+    assert os.path.exists(tmp_path / "ab" / "ab12.safetensors")
+
+    cache = EmbeddingCache(str(tmp_path))
+    cached = cache.get("ab12")
+    assert cache.disk_hits == 1
+    assert_same_valid_tokens(cached, original)
+    assert not cached["embeds"][:, 7:].any()
+    # Read once, then served from memory.
+    cache.get("ab12")
+    assert cache.memory_hits == 1
+
+
+def test_disk_entries_past_the_cap_are_evicted_oldest_first(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put("aa", entry(LENGTH))
+    file_bytes = os.path.getsize(cache.path("aa"))
+    cache = EmbeddingCache(str(tmp_path), max_disk_bytes=2 * file_bytes)
+    os.utime(cache.path("aa"), ns=(1, 1))
+    cache.put("bb", entry(LENGTH, seed=1))
+    os.utime(cache.path("bb"), ns=(2, 2))
+    cache.put("cc", entry(LENGTH, seed=2))
+
+    assert not os.path.exists(cache.path("aa"))
+    assert os.path.exists(cache.path("bb")) and os.path.exists(cache.path("cc"))
+    assert sum(os.path.getsize(cache.path(key)) for key in ["bb", "cc"]) <= cache.max_disk_bytes
+
+
+def test_memory_entries_are_least_recently_used():
+    cache = EmbeddingCache(None, max_entries=2)
+    for key in ["a", "b"]:
+        cache.put(key, entry(3))
+    cache.get("a")
+    cache.put("c", entry(3))
+    assert list(cache.entries) == ["a", "c"]
@@ -0,0 +1,100 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from fp8_optimization import FP8Linear, fp8_max, scaled_mm_support
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    return ((actual.float() - expected.float()).norm() / expected.float().norm()).item()
+
+
+def spread_linear(in_features=256, out_features=128, device="cpu") -> nn.Linear:
+    """bf16 linear whose output channels span two orders of magnitude, like trained weights."""
+    torch.manual_seed(0)
+    linear = nn.Linear(in_features, out_features, device=device, dtype=torch.bfloat16)
+    with torch.no_grad():
+        linear.weight.mul_(torch.logspace(-1, 1, out_features, device=device, dtype=torch.bfloat16)[:, None])
+    return linear
+
+
+def test_forward_matches_reference_on_cpu():
+    fp8 = FP8Linear.from_linear(spread_linear())
+    x = torch.randn(2, 7, 256, dtype=torch.bfloat16)
+    with torch.no_grad():
+        out = fp8(x)
+        assert out.shape == (2, 7, 128) and out.dtype == torch.bfloat16
+        assert torch.equal(out, fp8.forward_reference(x))
+
+
+def test_reference_dequantizes_weights_and_inputs():
+    fp8 = FP8Linear.from_linear(spread_linear())
+    x = torch.randn(5, 256, dtype=torch.bfloat16)
+    x[0] = 0  # All-zero tokens keep a finite scale.
+    with torch.no_grad():
+        scale_input = x.float().abs().amax(dim=1, keepdim=True).div(fp8_max(torch.float8_e4m3fn)).clamp(min=1e-12)
+        x_dq = (x.float() / scale_input).to(torch.float8_e4m3fn).float() * scale_input
+        w_dq = fp8.weight.float() * fp8.scale_weight
+        expected = F.linear(x_dq, w_dq, fp8.bias.float()).to(torch.bfloat16)
+        torch.testing.assert_close(fp8.forward_reference(x), expected, atol=0, rtol=0)
+        assert torch.isfinite(fp8(x)).all()
+
+
+def test_reference_ignores_autocast():
+    fp8 = FP8Linear.from_linear(spread_linear())
+    x = torch.randn(5, 256, dtype=torch.bfloat16)
+    with torch.no_grad():
+        expected = fp8.forward_reference(x)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            assert torch.equal(fp8.forward_reference(x), expected)
+
+
+def test_from_linear_keeps_fp8_weights():
+    linear = spread_linear()
+    linear.weight.data = linear.weight.data.to(torch.float8_e4m3fn)
+    fp8 = FP8Linear.from_linear(linear, per_channel=True)
+    assert fp8.weight.dtype == torch.float8_e4m3fn
+    assert torch.equal(fp8.weight.view(torch.uint8), linear.weight.view(torch.uint8))
+    assert not fp8.per_channel and fp8.scale_weight.shape == (1, 1) and fp8.scale_weight.item() == 1.0
+    x = torch.randn(5, 256, dtype=torch.bfloat16)
+    with torch.no_grad():
+        expected = F.linear(x.float(), linear.weight.float(), linear.bias.float())
+        assert relative_error(fp8(x), expected) < 0.05
+
+
+def test_per_channel_scales_beat_tensorwise():
+    linear = spread_linear()
+    tensorwise = FP8Linear.from_linear(linear, per_channel=False)
+    per_channel = FP8Linear.from_linear(linear, per_channel=True)
+    assert tensorwise.scale_weight.shape == (1, 1)
+    assert per_channel.scale_weight.shape == (128, 1)
+
+    # Every channel uses the fp8 range: its largest weight maps to the fp8 max.
+    amax = per_channel.weight.float().abs().amax(dim=1)
+    assert torch.equal(amax, torch.full_like(amax, fp8_max(torch.float8_e4m3fn)))
+
+    weight = linear.weight.float()
+    tensorwise_error = relative_error(tensorwise.weight.float() * tensorwise.scale_weight, weight)
+    per_channel_error = relative_error(per_channel.weight.float() * per_channel.scale_weight, weight)
+    # e4m3 keeps 3 mantissa bits, a relative rounding error of at most 2^-4.
+    assert per_channel_error < 2**-4
+    assert per_channel_error <= tensorwise_error
+
+    x = torch.randn(64, 256, dtype=torch.bfloat16)
+    with torch.no_grad():
+        expected = linear(x)
+        assert relative_error(per_channel(x), expected) <= relative_error(tensorwise(x), expected)
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available() or scaled_mm_support(torch.device("cuda")) is None,
+    reason="needs a GPU with fp8 matmuls",
+)
+@pytest.mark.parametrize("per_channel", [False, True])
+def test_scaled_mm_matches_reference(per_channel):
+    fp8 = FP8Linear.from_linear(spread_linear(device="cuda"), per_channel=per_channel)
+    x = torch.randn(64, 256, device="cuda", dtype=torch.bfloat16)
+    with torch.no_grad():
+        # Only the accumulation order differs from the reference.
+        torch.testing.assert_close(fp8(x), fp8.forward_reference(x), atol=0.05, rtol=0.02)
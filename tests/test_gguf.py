@@ -0,0 +1,239 @@
+import numpy as np
+import pytest
+import torch
+
+import mz_gguf_loader
+from mz_gguf_loader import DequantCache, WQLinear_GGUF, dequantize_blocks, enable_dequant_cache, quantize_blocks
+
+
+def gguf_linear(in_features, out_features, qtype="Q8_0"):
+    torch.manual_seed(0)
+    layer = WQLinear_GGUF(in_features, out_features, True, "cpu", qtype=qtype)
+    getattr(layer, f"{qtype}_qweight").copy_(quantize_blocks(torch.randn(out_features, in_features), qtype))
+    layer.bias.normal_()
+    return layer
+
+
+def weight(values):
+    """A cached weight of 4 * values bytes."""
+    return lambda: torch.zeros(values)
+
+
+def test_pin_keeps_the_first_layers():
+    cache = DequantCache(8 * 4, policy="pin")
+    for _ in range(3):
+        for key in "abc":
+            cache.get(key, weight(4))
+    # a and b fill the budget and stay, c never fits.
+    assert list(cache.entries) == ["a", "b"]
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 5, 0)
+    assert cache.bytes == 8 * 4
+    assert cache.admits("a", 4 * 4) and not cache.admits("c", 4 * 4)
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = DequantCache(8 * 4, policy="lru")
+    cache.get("a", weight(4))
+    cache.get("b", weight(4))
+    cache.get("a", weight(4))
+    cache.get("c", weight(4))  # Evicts b, a was used more recently.
+    assert list(cache.entries) == ["a", "c"]
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 3, 1)
+    assert cache.bytes == 8 * 4
+    assert cache.admits("b", 8 * 4) and not cache.admits("b", 9 * 4)
+
+
+@pytest.mark.parametrize("policy", ["pin", "lru"])
+def test_weights_larger_than_the_budget_are_not_kept(policy):
+    cache = DequantCache(8 * 4, policy=policy)
+    cache.get("a", weight(4))
+    out = cache.get("big", weight(9))
+    assert out.numel() == 9
+    assert list(cache.entries) == ["a"] and cache.evictions == 0
+
+
+def test_hits_return_the_cached_tensor():
+    cache = DequantCache(8 * 4)
+    first = cache.get("a", weight(4))
+    assert cache.get("a", lambda: pytest.fail("dequantized again")) is first
+    cache.clear()
+    assert not cache.entries and cache.bytes == 0 and cache.hits == 1
+
+
+def test_layers_share_the_cache():
+    model = torch.nn.Sequential(gguf_linear(64, 32), gguf_linear(32, 16))
+    # Room for the first layer's bf16 weight only.
+    cache = enable_dequant_cache(model, 64 * 32 * 2)
+    assert all(layer.dequant_cache is cache for layer in model)
+    x = torch.randn(3, 64, dtype=torch.bfloat16)
+    expected = model(x)
+    assert torch.equal(model(x), expected)
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert list(cache.entries) == [(id(model[0]), torch.bfloat16, x.device)]
+    assert enable_dequant_cache(model, 0) is None
+
+
+@pytest.mark.parametrize("tile_rows", [1, 7, 32, 100])
+def test_tiled_forward_matches_full_dequant(tile_rows):
+    layer = gguf_linear(64, 48)
+    x = torch.randn(2, 5, 64)
+    expected = layer(x)
+    layer.tile_rows = tile_rows
+    torch.testing.assert_close(layer(x), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_tiles_the_layers_the_cache_does_not_hold(monkeypatch):
+    layer = gguf_linear(64, 48)
+    x = torch.randn(3, 64)
+    expected = layer(x)
+    layer.tile_rows = 16
+    layer.dequant_cache = DequantCache(64 * 48 * 4 - 1)
+    dequantized = []
+    dequantize = layer.dequantize
+    monkeypatch.setattr(layer, "dequantize", lambda *args: dequantized.append(args) or dequantize(*args))
+    torch.testing.assert_close(layer(x), expected, rtol=1e-5, atol=1e-5)
+    assert len(dequantized) == 3
+    assert not layer.dequant_cache.entries and layer.dequant_cache.misses == 1
+
+
+def test_chunked_dequantization_matches_one_chunk(monkeypatch):
+    qweight = getattr(gguf_linear(64, 48, "Q4_0"), "Q4_0_qweight")
+    expected = dequantize_blocks(qweight, "Q4_0", torch.float32)
+    # 3 blocks of 32 values per chunk, the last chunk is shorter.
+    monkeypatch.setattr(mz_gguf_loader, "DEQUANT_CHUNK_VALUES", 96)
+    assert torch.equal(dequantize_blocks(qweight, "Q4_0", torch.float32), expected)
+
+
+# Reference of ggml's block layouts (ggml-quants.c), one block per row of bytes.
+
+
+def _np_f16(blocks, offset):
+    return blocks[:, offset:offset + 2].copy().view(np.float16)[:, 0].astype(np.float32)
+
+
+def _np_qh_bits(blocks, offset):
+    """(n, 32) bits of the little-endian uint32 at offset."""
+    qh = blocks[:, offset:offset + 4].copy().view("<u4")
+    return (qh >> np.arange(32, dtype=np.uint32)) & 1
+
+
+def _np_scale_min_k4(j, q):
+    """get_scale_min_k4"""
+    if j < 4:
+        return q[:, j] & 63, q[:, j + 4] & 63
+    return (q[:, j + 4] & 0xF) | ((q[:, j - 4] >> 6) << 4), (q[:, j + 4] >> 4) | ((q[:, j] >> 6) << 4)
+
+
+def np_dequantize(blocks, qtype):
+    n = blocks.shape[0]
+    y = np.zeros((n, mz_gguf_loader.GGML_QUANT_SIZES[qtype][0]), dtype=np.float32)
+    if qtype in ("Q4_0", "Q4_1", "Q5_0", "Q5_1"):
+        d = _np_f16(blocks, 0)[:, None]
+        m = _np_f16(blocks, 2)[:, None] if qtype.endswith("_1") else None
+        qs = blocks[:, -16:].astype(np.int32)
+        x0, x1 = qs & 0x0F, qs >> 4
+        if qtype.startswith("Q5"):
+            bits = _np_qh_bits(blocks, 4 if m is not None else 2).astype(np.int32)
+            x0, x1 = x0 | (bits[:, :16] << 4), x1 | (bits[:, 16:] << 4)
+        x = np.concatenate([x0, x1], axis=1)
+        y[:] = x * d + m if m is not None else (x - (8 if qtype == "Q4_0" else 16)) * d
+    elif qtype == "Q8_0":
+        y[:] = blocks[:, 2:].copy().view(np.int8) * _np_f16(blocks, 0)[:, None]
+    elif qtype in ("Q4_K", "Q5_K"):
+        d, dmin, scales = _np_f16(blocks, 0), _np_f16(blocks, 2), blocks[:, 4:16].astype(np.int32)
+        qh = blocks[:, 16:48].astype(np.int32)
+        ql = blocks[:, 16:144] if qtype == "Q4_K" else blocks[:, 48:176]
+        for i, j in enumerate(range(0, 256, 64)):
+            q = ql[:, i * 32:(i + 1) * 32].astype(np.int32)
+            for k, values in enumerate((q & 0xF, q >> 4)):
+                sc, mn = _np_scale_min_k4(2 * i + k, scales)
+                if qtype == "Q5_K":
+                    values = values + np.where(qh & (1 << (2 * i + k)), 16, 0)
+                y[:, j + 32 * k:j + 32 * (k + 1)] = (d * sc)[:, None] * values - (dmin * mn)[:, None]
+    elif qtype == "Q6_K":
+        ql, qh = blocks[:, :128].astype(np.int32), blocks[:, 128:192].astype(np.int32)
+        sc, d = blocks[:, 192:208].copy().view(np.int8).astype(np.float32), _np_f16(blocks, 208)
+        for half in range(2):
+            l, h, s = ql[:, 64 * half:], qh[:, 32 * half:], sc[:, 8 * half:]
+            for part, (low, shift) in enumerate(
+                [(l[:, :32] & 0xF, 0), (l[:, 32:64] & 0xF, 2), (l[:, :32] >> 4, 4), (l[:, 32:64] >> 4, 6)]
+            ):
+                q = (low | (((h[:, :32] >> shift) & 3) << 4)) - 32
+                for is_ in range(2):
+                    cols = slice(128 * half + 32 * part + 16 * is_, 128 * half + 32 * part + 16 * (is_ + 1))
+                    y[:, cols] = d[:, None] * s[:, is_ + 2 * part, None] * q[:, 16 * is_:16 * (is_ + 1)]
+    return y
+
+
+def np_quantize(x, qtype):
+    """quantize_row_*_ref of the round-to-nearest qtypes."""
+    x = x.astype(np.float32)
+    n = x.shape[0]
+    half = lambda v: v.astype(np.float16).reshape(n, 1).view(np.uint8)
+    inverse = lambda d: np.where(d == 0, 0, 1 / np.where(d == 0, 1, d)).astype(np.float32)
+    if qtype == "Q8_0":
+        d = np.abs(x).max(axis=1) / 127
+        q = np.trunc(x * inverse(d)[:, None] + np.copysign(0.5, x)).astype(np.int8)  # roundf
+        return np.concatenate([half(d), q.view(np.uint8)], axis=1)
+    if qtype.endswith("_0"):
+        levels = 8 if qtype == "Q4_0" else 16
+        signed_max = x[np.arange(n), np.abs(x).argmax(axis=1)]
+        d = signed_max / -levels
+        q = np.minimum(2 * levels - 1, np.trunc(x * inverse(d)[:, None] + levels + 0.5)).astype(np.uint8)
+        header = [half(d)]
+    else:
+        levels = 16 if qtype == "Q4_1" else 32
+        lo = x.min(axis=1)
+        d = (x.max(axis=1) - lo) / (levels - 1)
+        q = np.minimum(levels - 1, np.trunc((x - lo[:, None]) * inverse(d)[:, None] + 0.5)).astype(np.uint8)
+        header = [half(d), half(lo)]
+    if qtype.startswith("Q5"):
+        qh = (((q >> 4) & 1).astype(np.uint32) << np.arange(32, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+        header.append(qh.astype("<u4").reshape(n, 1).view(np.uint8))
+    qs = (q[:, :16] & 0x0F) | ((q[:, 16:] & 0x0F) << 4)
+    return np.concatenate(header + [qs], axis=1)
+
+
+def random_blocks(qtype, n=64):
+    """Random blocks of qtype with small fp16 scales."""
+    block_size, type_size = mz_gguf_loader.GGML_QUANT_SIZES[qtype]
+    generator = torch.Generator().manual_seed(0)
+    blocks = torch.randint(0, 256, (n, type_size), dtype=torch.uint8, generator=generator)
+    for offset in {"Q6_K": (208,)}.get(qtype, (0, 2) if qtype.endswith(("_1", "_K")) else (0,)):
+        scales = torch.rand(n, 1, generator=generator) * 0.01
+        blocks[:, offset:offset + 2] = scales.half().view(torch.uint8)
+    return blocks
+
+
+@pytest.mark.parametrize("qtype", list(mz_gguf_loader.DEQUANTIZERS))
+def test_dequantize_matches_ggml_layout(qtype):
+    blocks = random_blocks(qtype)
+    out = dequantize_blocks(blocks.reshape(4, -1), qtype, torch.float32)
+    expected = np_dequantize(blocks.numpy(), qtype).reshape(4, -1)
+    # Q4_0 is multiplied in float16 like the original loader, ggml multiplies in float32.
+    rtol = 2**-11 if qtype == "Q4_0" else 1e-6
+    np.testing.assert_allclose(out.numpy(), expected, rtol=rtol, atol=1e-7)
+
+
+@pytest.mark.parametrize("qtype", list(mz_gguf_loader.QUANTIZERS))
+def test_quantize_round_trip(qtype):
+    block_size, _ = mz_gguf_loader.GGML_QUANT_SIZES[qtype]
+    torch.manual_seed(0)
+    weight = torch.randn(8, 4 * block_size)
+    qweight = quantize_blocks(weight, qtype)
+    blocks = np_quantize(weight.reshape(-1, block_size).numpy(), qtype)
+    np.testing.assert_array_equal(qweight.reshape(-1, blocks.shape[1]).numpy(), blocks)
+    out = dequantize_blocks(qweight, qtype, torch.float32)
+    np.testing.assert_allclose(out.reshape(-1, block_size).numpy(), np_dequantize(blocks, qtype), rtol=2**-11, atol=1e-7)
+    # Round to nearest: within half a step of the block, a whole step for the value the
+    # _0 qtypes clamp opposite their signed maximum, plus the fp16 rounding of the scale and min.
+    blocks = weight.reshape(-1, block_size)
+    absmax = blocks.abs().amax(dim=1, keepdim=True)
+    levels = {"Q4_0": 8, "Q4_1": 15, "Q5_0": 16, "Q5_1": 31, "Q8_0": 127}[qtype]
+    if qtype.endswith("_1"):
+        step = (blocks.amax(dim=1, keepdim=True) - blocks.amin(dim=1, keepdim=True)) / levels
+    else:
+        step = absmax / levels
+    rounding = 1.0 if qtype in ("Q4_0", "Q5_0") else 0.5
+    error = (out.reshape(-1, block_size) - blocks).abs()
+    assert (error <= rounding * step + 2**-11 * (levels * step + absmax)).all()
@@ -0,0 +1,63 @@
+import logging
+
+import pytest
+import torch.nn as nn
+
+pytest.importorskip("comfy.model_management", reason="memory_budget.py needs ComfyUI")
+
+from mochi_preview.memory_budget import MemoryBudget, module_bytes
+from mochi_preview.residency import ModelResidency
+
+# Bytes of the parameters of one model below.
+MODEL_BYTES = 4 * (64 * 64 + 64)
+
+
+@pytest.fixture
+def residency():
+    # Room for two models on the host.
+    return ModelResidency(MemoryBudget(host_budget=2 * MODEL_BYTES + 1))
+
+
+def load(residency, key, loads=None):
+    def loader():
+        if loads is not None:
+            loads.append(key)
+        return nn.Linear(64, 64)
+
+    return residency.load(key, loader, name=key)
+
+
+def test_module_bytes():
+    assert module_bytes([nn.Linear(64, 64)]) == {"cpu": MODEL_BYTES}
+
+
+def test_least_recently_used_is_evicted_past_the_host_budget(residency, caplog):
+    a, b = load(residency, "a"), load(residency, "b")
+    assert load(residency, "a") is a
+    with caplog.at_level(logging.INFO, logger="mochi_preview.memory_budget"):
+        load(residency, "c")
+    assert set(residency.entries) == {"a", "c"}
+    assert b not in residency.budget.components
+    evictions = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Evicted")]
+    assert len(evictions) == 1 and evictions[0].startswith("Evicted b from host memory")
+
+
+def test_evicted_model_is_loaded_again(residency):
+    loads = []
+    for key in ["a", "b", "c", "a"]:
+        load(residency, key, loads)
+    assert loads == ["a", "b", "c", "a"]
+    assert residency.hits == 0 and residency.misses == 4
+
+
+def test_kept_models_are_not_evicted(residency):
+    a = load(residency, "a")
+    load(residency, "b")
+    residency.load("c", lambda: nn.Linear(64, 64), name="c", keep=[a])
+    assert set(residency.entries) == {"a", "c"}
+
+
+def test_clear_evicts_through_the_budget(residency):
+    a = load(residency, "a")
+    residency.clear()
+    assert residency.entries == {} and a not in residency.budget.components
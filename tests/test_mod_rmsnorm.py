@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from mochi_preview.dit.joint_model import mod_rmsnorm
+from mochi_preview.dit.joint_model.mod_rmsnorm import ModulatedRMSNorm, modulated_rmsnorm
+
+B, N, D = 2, 64, 256
+
+
+@pytest.fixture(params=[torch.float32, torch.bfloat16])
+def inputs(request):
+    torch.manual_seed(0)
+    x = (torch.randn(B, N, D) * 3).to(request.param)
+    scale = (torch.randn(B, D) * 0.5).to(request.param)
+    return x, scale
+
+
+@pytest.fixture(autouse=True, params=["one chunk", "chunks of 5 tokens"])
+def chunks(request, monkeypatch):
+    if request.param != "one chunk":
+        monkeypatch.setattr(mod_rmsnorm, "CHUNK_BYTES", 4 * B * D * 5)
+
+
+def reference(x, scale, eps=1e-6):
+    """The whole formula in fp64."""
+    x = x.double()
+    return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + eps) * (1 + scale.double().unsqueeze(1))
+
+
+def test_no_grad_matches_eager(inputs):
+    x, scale = inputs
+    eager = modulated_rmsnorm(x, scale)
+    with torch.no_grad():
+        out = modulated_rmsnorm(x, scale)
+    assert out.dtype == x.dtype
+    assert torch.equal(out, eager)
+
+
+def test_rounds_once(inputs):
+    x, scale = inputs
+    if x.dtype == torch.float32:
+        pytest.skip("computed in fp32, there is nothing to round")
+    with torch.no_grad():
+        out = modulated_rmsnorm(x, scale)
+    expected = reference(x, scale)
+    # Within one rounding of the exact result, an fp32 error can only flip ties.
+    ulp = torch.finfo(x.dtype).eps * expected.abs().clamp(min=torch.finfo(x.dtype).tiny)
+    assert ((out.double() - expected).abs() <= ulp).all()
+    # As close as the fp32 autograd.Function, which also rounds once.
+    assert (out.double() - expected).abs().max() <= (ModulatedRMSNorm.forward(None, x, scale).double() - expected).abs().max()
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from mochi_preview.dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from mochi_preview.dit.joint_model.utils import compute_packed_indices
+
+SIGMAS = [1.0, 0.7, 0.2]
+# The blocks expect Mochi's MLP width of 8192.
+CONFIG = {**MOCHI_PREVIEW_CONFIG, "depth": 2, "hidden_size_x": 384, "hidden_size_y": 192, "num_heads": 6,
+          "mlp_ratio_x": 4.0 * 3072 / 384}
+
+
+@pytest.fixture(scope="module")
+def dit():
+    torch.manual_seed(0)
+    dit = AsymmDiTJoint(**CONFIG, attention_mode="sdpa").eval()
+    with torch.no_grad():
+        # Some parameters are left uninitialized for the checkpoint.
+        for name, param in dit.named_parameters():
+            param.fill_(1.0) if "norm" in name else param.normal_(0, 0.02)
+    return dit
+
+
+@pytest.fixture(scope="module")
+def conditioning(dit):
+    mask = torch.zeros(1, 256, dtype=torch.bool)
+    mask[:, :10] = True
+    with torch.no_grad():
+        return dit.prepare_conditioning(torch.randn(1, 256, 4096), mask, compute_packed_indices(2 * 4 * 4, [mask]))
+
+
+@pytest.fixture(scope="module")
+def latents():
+    return torch.randn(1, 12, 2, 8, 8)
+
+
+@torch.no_grad()
+def test_matches_per_forward_modulation(dit, conditioning, latents):
+    # The blocks run in bf16, as in the sampler.
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        modulation = dit.precompute_modulation(SIGMAS, conditioning)
+        assert len(modulation) == len(SIGMAS)
+        for step, sigma in enumerate(SIGMAS):
+            expected = dit(latents, torch.tensor([sigma]), conditioning=conditioning)
+            out = dit(latents, torch.tensor([sigma]), conditioning=conditioning, modulation=modulation, step=step)
+            assert (out - expected).abs().max() <= 0.02 * expected.abs().max()
+
+
+def test_schedule_is_checked_once(dit, conditioning):
+    with pytest.raises(ValueError, match="sigmas in"):
+        dit.precompute_modulation([1.0, 1.5], conditioning)
+    with pytest.raises(ValueError, match="sigmas in"):
+        dit.precompute_modulation([], conditioning)
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("step", [None, -1, len(SIGMAS)])
+def test_step_must_index_the_table(dit, conditioning, latents, step):
+    modulation = dit.precompute_modulation(SIGMAS, conditioning)
+    with pytest.raises(ValueError, match="needs a step"):
+        dit(latents, torch.tensor([0.0]), conditioning=conditioning, modulation=modulation, step=step)
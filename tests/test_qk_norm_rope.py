@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from mochi_preview.dit.joint_model.layers import RMSNorm
+from mochi_preview.dit.joint_model.rope_mixed import compute_mixed_rotation, create_position_matrix
+from mochi_preview.dit.joint_model.temporal_rope import apply_qk_norm_rotary_emb_, apply_rotary_emb_qk_real
+
+NUM_HEADS = 4
+HEAD_DIM = 128
+T, PH, PW = 2, 4, 6
+N = T * PH * PW
+
+
+@pytest.fixture
+def inputs():
+    torch.manual_seed(0)
+    q_norm = RMSNorm(HEAD_DIM).to(torch.bfloat16)
+    k_norm = RMSNorm(HEAD_DIM).to(torch.bfloat16)
+    with torch.no_grad():
+        q_norm.weight.uniform_(0.5, 1.5)
+        k_norm.weight.uniform_(0.5, 1.5)
+    freqs = torch.rand(3, NUM_HEADS, HEAD_DIM // 2)
+    pos = create_position_matrix(T, pH=PH, pW=PW, device="cpu", dtype=torch.float32)
+    rope_cos, rope_sin = compute_mixed_rotation(freqs=freqs, pos=pos)
+    # Same layout as in prepare_qkv: (3, B=1, N, heads, head_dim) view of the qkv_x linear output.
+    qkv_x = torch.randn(1, N, 3 * NUM_HEADS * HEAD_DIM, dtype=torch.bfloat16) * 4
+    qkv_x = qkv_x.view(1, N, 3, NUM_HEADS, HEAD_DIM).permute(2, 0, 1, 3, 4)
+    return q_norm, k_norm, rope_cos, rope_sin, qkv_x
+
+
+def reference(qkv_x, q_norm, k_norm, rope_cos, rope_sin):
+    """RMSNorm and rotation in fp32, the exact values the fused op rounds once."""
+    out = []
+    for x, norm in zip(qkv_x[:2, 0].float(), (q_norm, k_norm)):
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + norm.eps) * norm.weight.float()
+        x_even, x_odd = x[..., 0::2], x[..., 1::2]
+        out.append(torch.stack([x_even * rope_cos - x_odd * rope_sin, x_even * rope_sin + x_odd * rope_cos], dim=-1).flatten(-2))
+    return torch.stack(out, dim=1)  # (N, 2, heads, D), like packed[:, :2]
+
+
+def pair_magnitude(x: torch.Tensor) -> torch.Tensor:
+    """|(even, odd)| of every rotated pair, broadcast to both elements; the rotation preserves it."""
+    magnitude = x[..., 0::2].hypot(x[..., 1::2])
+    return torch.stack([magnitude, magnitude], dim=-1).flatten(-2)
+
+
+def test_fused_matches_fp32_reference_and_unfused_path(inputs):
+    q_norm, k_norm, rope_cos, rope_sin, qkv_x = inputs
+    packed = torch.full((N, 3, NUM_HEADS, HEAD_DIM), 7.0, dtype=torch.bfloat16)
+    norm_weight = torch.stack([q_norm.weight, k_norm.weight])
+    with torch.no_grad():
+        apply_qk_norm_rotary_emb_(qkv_x[:2, 0], norm_weight, rope_cos, rope_sin, out=packed.transpose(0, 1)[:2], eps=q_norm.eps)
+        expected = reference(qkv_x, q_norm, k_norm, rope_cos, rope_sin)
+
+        q_x, k_x, _ = qkv_x.unbind(0)
+        unfused = torch.stack([
+            apply_rotary_emb_qk_real(q_norm(q_x), rope_cos, rope_sin)[0],
+            apply_rotary_emb_qk_real(k_norm(k_x), rope_cos, rope_sin)[0],
+        ], dim=1)
+
+    # Errors are bounded relative to the magnitude of each rotated pair: an element where
+    # the rotation cancels out keeps the absolute error of its inputs. A wrong index into
+    # the packed qkv, a swapped pair or a missing norm weight is off by about the magnitude.
+    magnitude = pair_magnitude(expected)
+    # The fused op rounds once to bf16 (8 significant bits): within one ulp, as the fp32
+    # operation order may differ on a rounding boundary. 1% off in a single element fails.
+    assert ((packed[:, :2].float() - expected).abs() <= magnitude * 2**-7).all()
+    # The replaced path rounds after the norm, after each product and after the sum.
+    assert ((unfused.float() - expected).abs() <= magnitude * 2**-6).all()
+    # The value slot of the packed tensor isn't touched.
+    assert (packed[:, 2] == 7.0).all()
@@ -0,0 +1,57 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from mz_gguf_loader import QUANTIZERS
+from quantize_dit import allocate, layer_bytes, quantize_linear
+
+
+def chosen(options, choice, field):
+    return sum(options[name][index][field] for name, index in choice.items())
+
+
+def test_allocate_respects_the_budget():
+    generator = torch.Generator().manual_seed(0)
+    options = {}
+    for layer in range(20):
+        size = int(torch.randint(100, 1000, (1,), generator=generator))
+        error = float(torch.rand(1, generator=generator))
+        # Twice the bytes per option, a quarter of the error.
+        options[f"blocks.{layer}"] = [(size * 2**i, error / 4**i) for i in range(3)]
+    smallest = sum(layer_options[0][0] for layer_options in options.values())
+    errors = []
+    for budget in (smallest, smallest * 2, smallest * 3, smallest * 4):
+        choice = allocate(options, budget)
+        assert chosen(options, choice, 0) <= budget
+        errors.append(chosen(options, choice, 1))
+    assert errors == sorted(errors, reverse=True) and errors[0] > errors[-1]
+    # Room for everything: every layer gets its most precise option.
+    assert set(allocate(options, smallest * 4).values()) == {2}
+
+
+def test_allocate_skips_dominated_options():
+    # Option 1 costs bytes without lowering the error.
+    options = {"a": [(10, 1.0), (20, 1.0), (30, 0.5)], "b": [(10, 1.0), (15, 0.9)]}
+    assert allocate(options, 30) == {"a": 0, "b": 1}
+    assert allocate(options, 40) == {"a": 2, "b": 0}
+    assert allocate(options, 45) == {"a": 2, "b": 1}
+
+
+def test_allocate_prefers_the_larger_gain_per_byte():
+    options = {"a": [(10, 1.0), (20, 0.5)], "b": [(10, 1.0), (20, 0.1)]}
+    assert allocate(options, 30) == {"a": 0, "b": 1}
+
+
+def test_allocate_raises_when_the_smallest_options_do_not_fit():
+    with pytest.raises(ValueError, match="over the budget"):
+        allocate({"a": [(10, 1.0)], "b": [(10, 1.0), (20, 0.5)]}, 19)
+
+
+@pytest.mark.parametrize("bias", [True, False])
+@pytest.mark.parametrize("precision", ["bf16", "fp8", *QUANTIZERS])
+def test_layer_bytes_matches_quantize_linear(precision, bias):
+    torch.manual_seed(0)
+    linear = nn.Linear(64, 48, bias=bias)
+    tensors, weight = quantize_linear(linear, precision)
+    assert layer_bytes(linear, precision) == sum(t.numel() * t.element_size() for t in tensors.values())
+    assert weight.shape == linear.weight.shape
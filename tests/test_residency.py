@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import torch.nn as nn
+
+pytest.importorskip("comfy.model_management", reason="residency.py needs ComfyUI")
+
+from mochi_preview.memory_budget import MemoryBudget
+from mochi_preview.residency import ModelResidency, checkpoint_identity, freeze
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    path = tmp_path / "dit.safetensors"
+    path.write_bytes(b"weights")
+    return str(path)
+
+
+@pytest.fixture
+def residency():
+    return ModelResidency(MemoryBudget(host_budget=1 << 30))
+
+
+def load(residency, checkpoint, loads, compile_args=None):
+    def loader():
+        loads.append(checkpoint)
+        return nn.Linear(4, 4)
+
+    key = ("dit", checkpoint_identity(checkpoint), freeze(compile_args))
+    return residency.load(key, loader, name=os.path.basename(checkpoint))
+
+
+def test_same_key_returns_the_loaded_model(residency, checkpoint):
+    loads = []
+    model = load(residency, checkpoint, loads, {"mode": "default", "fullgraph": False})
+    assert load(residency, checkpoint, loads, {"fullgraph": False, "mode": "default"}) is model
+    assert len(loads) == 1
+    assert residency.hits == 1 and residency.misses == 1
+
+
+def test_changed_mtime_reloads(residency, checkpoint):
+    loads = []
+    model = load(residency, checkpoint, loads)
+    stat = os.stat(checkpoint)
+    os.utime(checkpoint, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert load(residency, checkpoint, loads) is not model
+    assert len(loads) == 2
+
+
+def test_changed_arguments_reload(residency, checkpoint):
+    loads = []
+    model = load(residency, checkpoint, loads)
+    assert load(residency, checkpoint, loads, {"mode": "max-autotune"}) is not model
+    assert len(loads) == 2
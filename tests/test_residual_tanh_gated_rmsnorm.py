@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from mochi_preview.dit.joint_model import mod_rmsnorm
+from mochi_preview.dit.joint_model.residual_tanh_gated_rmsnorm import residual_tanh_gated_rmsnorm
+
+B, N, D = 2, 64, 256
+
+
+@pytest.fixture(params=[torch.float32, torch.bfloat16])
+def inputs(request):
+    torch.manual_seed(0)
+    x = torch.randn(B, N, D).to(request.param)
+    x_res = (torch.randn(B, N, D) * 3).to(request.param)
+    gate = torch.randn(B, D).to(request.param)
+    return x, x_res, gate
+
+
+@pytest.fixture(autouse=True, params=["one chunk", "chunks of 5 tokens"])
+def chunks(request, monkeypatch):
+    if request.param != "one chunk":
+        monkeypatch.setattr(mod_rmsnorm, "CHUNK_BYTES", 4 * B * D * 5)
+
+
+def reference(x, x_res, gate, eps=1e-6):
+    """The whole formula in fp64, rounded once to x.dtype."""
+    x_res = x_res.double()
+    x_normed = x_res * torch.rsqrt(x_res.pow(2).mean(-1, keepdim=True) + eps) * torch.tanh(gate.double()).unsqueeze(1)
+    return (x.double() + x_normed).to(x.dtype)
+
+
+def test_in_place_matches_eager(inputs):
+    x, x_res, gate = inputs
+    eager = residual_tanh_gated_rmsnorm(x, x_res, gate)
+    with torch.no_grad():
+        x_copy, x_res_copy = x.clone(), x_res.clone()
+        in_place = residual_tanh_gated_rmsnorm(x_copy, x_res_copy, gate)
+    assert in_place.data_ptr() == x_copy.data_ptr()
+    assert torch.equal(x_res_copy, x_res)
+    assert torch.equal(in_place, eager)
+
+
+def test_rounds_once(inputs):
+    x, x_res, gate = inputs
+    if x.dtype == torch.float32:
+        pytest.skip("computed in fp32, there is nothing to round")
+    with torch.no_grad():
+        out = residual_tanh_gated_rmsnorm(x.clone(), x_res, gate)
+    expected = reference(x, x_res, gate)
+    # Within one rounding of the exact result, an fp32 error can only flip ties.
+    ulp = torch.finfo(x.dtype).eps * expected.double().abs().clamp(min=torch.finfo(x.dtype).tiny)
+    assert ((out.double() - expected.double()).abs() <= ulp).all()
@@ -0,0 +1,88 @@
+import pytest
+import torch
+
+pytest.importorskip("comfy.model_management", reason="T2VSynthMochiModel needs ComfyUI")
+
+from mochi_preview.dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from mochi_preview.memory_budget import MEMORY_BUDGET
+from mochi_preview.t2v_synth_mochi import T2VSynthMochiModel
+
+STEPS = 3
+SIGMAS = [1.0, 0.6, 0.3, 0.0]
+# The blocks expect Mochi's MLP width of 8192.
+CONFIG = {**MOCHI_PREVIEW_CONFIG, "depth": 2, "hidden_size_x": 384, "hidden_size_y": 192, "num_heads": 6,
+          "mlp_ratio_x": 4.0 * 3072 / 384}
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    # __init__ loads a full size checkpoint, build a small model instead.
+    t2v = object.__new__(T2VSynthMochiModel)
+    t2v.device = t2v.offload_device = torch.device("cpu")
+    t2v.dit = AsymmDiTJoint(**CONFIG, attention_mode="sdpa").eval()
+    with torch.no_grad():
+        # Some parameters are left uninitialized for the checkpoint.
+        for name, param in t2v.dit.named_parameters():
+            param.fill_(1.0) if "norm" in name else param.normal_(0, 0.02)
+    t2v.dequant_cache = None
+    t2v.vae_mean, t2v.vae_std = torch.zeros(12), torch.ones(12)
+    MEMORY_BUDGET.register(t2v, "DiT", modules=lambda t2v: [t2v.dit])
+    return t2v
+
+
+def embeds(*valid, seed=0):
+    """Conditioning of one prompt per entry of valid, with that many tokens."""
+    generator = torch.Generator().manual_seed(seed)
+    mask = torch.zeros(len(valid), 256, dtype=torch.bool)
+    for i, n in enumerate(valid):
+        mask[i, :n] = True
+    return {"embeds": torch.randn(len(valid), 256, 4096, generator=generator), "attention_mask": mask}
+
+
+def run(model, positive, negative, batch_cfg=False):
+    args = {
+        "height": 64,
+        "width": 64,
+        "num_frames": 7,
+        "seed": 3,
+        "mochi_args": {
+            "sigma_schedule": SIGMAS,
+            "cfg_schedule": [4.5] * STEPS,
+            "num_inference_steps": STEPS,
+            "batch_cfg": batch_cfg,
+        },
+        "positive_embeds": positive,
+        "negative_embeds": negative,
+    }
+    with torch.no_grad():
+        return model.run(args)
+
+
+def test_prepare_conditioning_keeps_the_prompts(model):
+    cond = model.prepare_conditioning(embeds(12, 20), num_frames=7, height=64, width=64)
+    assert cond.batch_size == 2
+    assert cond.y_pool.shape == (2, CONFIG["hidden_size_x"])
+
+
+@pytest.mark.parametrize("batch_cfg", [False, True])
+def test_one_latent_per_prompt(model, batch_cfg):
+    positive, negative = embeds(12, 20), embeds(3, seed=1)
+    samples = run(model, positive, negative, batch_cfg)
+    assert samples.shape == (2, 12, 2, 8, 8)
+    # The first latent has the noise of a single prompt run with the same seed.
+    single = run(model, {key: value[:1] for key, value in positive.items()}, negative, batch_cfg)
+    scale = single.abs().max()
+    assert (samples[:1] - single).abs().max() <= 0.02 * scale
+    assert (samples[1] - samples[0]).abs().max() > 0.1 * scale
+
+
+def test_batch_cfg_matches_separate_forwards(model):
+    positive, negative = embeds(12, 20), embeds(3, seed=1)
+    separate, batched = run(model, positive, negative), run(model, positive, negative, batch_cfg=True)
+    assert (separate - batched).abs().max() <= 0.02 * separate.abs().max()
+
+
+def test_negative_batch_must_match(model):
+    with pytest.raises(ValueError, match="1 or 2 prompts"):
+        run(model, embeds(12, 20), embeds(3, 4, 5, seed=1))
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from fp8_optimization import FP8Linear
+from mochi_preview.checkpoint_loader import (
+    SafetensorsFile,
+    ShardedCheckpoint,
+    is_sharded_checkpoint,
+    open_checkpoint,
+    stream_into_module,
+)
+from mochi_preview.dit.joint_model.asymm_models_joint import MOCHI_PREVIEW_CONFIG, AsymmDiTJoint
+from mz_gguf_loader import quantize_blocks
+import shard_dit
+
+DEPTH = 3
+HIDDEN = 384
+# The blocks expect Mochi's MLP width of 8192.
+CONFIG = {**MOCHI_PREVIEW_CONFIG, "depth": DEPTH, "hidden_size_x": HIDDEN, "hidden_size_y": HIDDEN // 2,
+          "mlp_ratio_x": 4.0 * 3072 / HIDDEN}
+
+
+@pytest.fixture(scope="module")
+def checkpoints(tmp_path_factory):
+    """A small DiT checkpoint with bf16, scaled fp8 and Q8_0 layers, and its shards."""
+    tmp = tmp_path_factory.mktemp("dit")
+    torch.manual_seed(0)
+    model = AsymmDiTJoint(**CONFIG, attention_mode="sdpa")
+    state_dict = {name: tensor.to(torch.bfloat16) for name, tensor in model.state_dict().items()}
+    fp8 = FP8Linear.from_linear(model.blocks[0].attn.qkv_x, out_dtype=torch.bfloat16)
+    state_dict.update({f"blocks.0.attn.qkv_x.{name}": tensor for name, tensor in fp8.state_dict().items()})
+    del state_dict["blocks.1.attn.qkv_x.weight"]
+    state_dict["blocks.1.attn.qkv_x.Q8_0_qweight"] = quantize_blocks(model.blocks[1].attn.qkv_x.weight.detach(), "Q8_0")
+    monolithic = str(tmp / "dit.safetensors")
+    save_file(state_dict, monolithic)
+    sharded_dir = str(tmp / "dit_sharded")
+    shard_dit.convert(monolithic, sharded_dir)
+    return monolithic, sharded_dir
+
+
+def test_round_trip_is_bit_exact(checkpoints):
+    monolithic, sharded_dir = checkpoints
+    expected = SafetensorsFile(monolithic)
+    sharded = ShardedCheckpoint(sharded_dir)
+    assert set(sharded) == set(expected)
+    for name in expected:
+        actual, tensor = sharded[name], expected[name]
+        assert actual.dtype == tensor.dtype and actual.shape == tensor.shape, name
+        assert torch.equal(actual.view(torch.uint8), tensor.view(torch.uint8)), name
+    sharded.close()
+    expected.close()
+
+
+def test_quantization_labels(checkpoints):
+    _, sharded_dir = checkpoints
+    sharded = ShardedCheckpoint(sharded_dir)
+    assert sharded.quantization["blocks.0.attn.qkv_x.weight"] == "fp8_scaled"
+    assert sharded.quantization["blocks.0.attn.qkv_x.scale_weight"] == "fp8_scaled"
+    assert sharded.quantization["blocks.1.attn.qkv_x.Q8_0_qweight"] == "Q8_0"
+    assert sharded.quantization["blocks.2.attn.qkv_x.weight"] is None
+    sharded.close()
+
+
+def test_partial_load_opens_one_shard(checkpoints):
+    monolithic, sharded_dir = checkpoints
+    sharded = ShardedCheckpoint(sharded_dir)
+    with torch.device("meta"):
+        block = AsymmDiTJoint(**CONFIG, attention_mode="sdpa").blocks[2]
+    stream_into_module(block, sharded, lambda name: (None, torch.device("cpu")), prefix="blocks.2.")
+    assert list(sharded._mmaps) == [os.path.join(sharded_dir, "block_02.safetensors")]
+    expected = SafetensorsFile(monolithic)
+    assert torch.equal(block.mlp_x.w1.weight, expected["blocks.2.mlp_x.w1.weight"])
+    sharded.close()
+    expected.close()
+
+
+def test_only_listed_files_are_sharded(checkpoints, tmp_path):
+    monolithic, sharded_dir = checkpoints
+    other = os.path.join(sharded_dir, "other.safetensors")
+    save_file({"x": torch.zeros(1)}, other)
+    try:
+        assert is_sharded_checkpoint(sharded_dir)
+        assert is_sharded_checkpoint(os.path.join(sharded_dir, "dit_index.json"))
+        assert is_sharded_checkpoint(os.path.join(sharded_dir, "block_01.safetensors"))
+        assert not is_sharded_checkpoint(other)
+        assert isinstance(open_checkpoint(other, None), SafetensorsFile)
+        assert not is_sharded_checkpoint(monolithic)
+    finally:
+        os.remove(other)
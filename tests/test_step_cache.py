@@ -0,0 +1,50 @@
+import torch
+
+from mochi_preview.dit.joint_model.step_cache import StepCache
+
+STEPS = 6
+
+
+def schedule(cache, inputs):
+    """Which steps compute the blocks, storing a residual after each computed step."""
+    computed = []
+    for step, x in enumerate(inputs):
+        computed.append(cache.should_compute(x, step))
+        if computed[-1]:
+            cache.store(x, x + 1)
+    return computed
+
+
+def test_first_and_last_steps_are_computed():
+    cache = StepCache(float("inf"), num_steps=STEPS)
+    x = torch.randn(1, 16, 8)
+    assert schedule(cache, [x] * STEPS) == [True, False, False, False, False, True]
+    assert (cache.hits, cache.misses) == (4, 2)
+
+
+def test_steps_under_the_threshold_are_skipped():
+    cache = StepCache(0.1, num_steps=STEPS)
+    x = torch.randn(1, 16, 8)
+    # 1% relative change per step, 10 steps before the threshold.
+    inputs = [x * (1 + 0.01 * step) for step in range(STEPS)]
+    assert schedule(cache, inputs) == [True, False, False, False, False, True]
+    torch.testing.assert_close(cache.apply(x), x + 1)
+
+
+def test_accumulated_change_forces_a_recompute():
+    cache = StepCache(0.25, num_steps=STEPS)
+    x = torch.rand(1, 16, 8) + 1
+    # 10% relative change per step: the third change since a computed step crosses 0.25.
+    inputs = [x * 1.1**step for step in range(STEPS)]
+    assert schedule(cache, inputs) == [True, False, False, True, False, True]
+    assert cache.accumulated == 0.0
+
+
+def test_summary_bounds_the_kept_input():
+    cache = StepCache(0.1, summary_tokens=100)
+    x = torch.randn(2, 1000, 8)
+    summary = cache.summarize(x)
+    assert summary.shape == (2, 100, 8)
+    assert torch.equal(summary, x[:, ::10])
+    assert cache.summarize(x[:, :50]).shape == (2, 50, 8)
+    assert cache.summarize(x[:, :101]).size(1) <= 100